@@ -59,6 +59,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'storyapp.middleware.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -92,10 +93,26 @@ WSGI_APPLICATION = 'aistorywall.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# SQLite connection settings, applied to every new connection (see
+# storyapp/signals.py). WAL lets requests read while background threads and
+# workers write; writers wait up to SQLITE_BUSY_TIMEOUT seconds for the lock
+# instead of failing with "database is locked".
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '20'))
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT,
+        },
+        # Tests use a file too, as the shared in-memory database does not
+        # support WAL or busy waiting between threads
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -142,14 +159,239 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Generated images and PDFs are stored through the 'generated' storage. Set
+# GENERATED_STORAGE=s3 to keep them in an S3-compatible bucket so several web
+# nodes can share them (requires `pip install django-storages[s3]`); point
+# AWS_S3_ENDPOINT_URL at MinIO to run against a local stand-in.
+GENERATED_STORAGE = os.getenv('GENERATED_STORAGE', 'filesystem')
+if GENERATED_STORAGE == 's3':
+    GENERATED_STORAGE_CONFIG = {
+        'BACKEND': 'storages.backends.s3.S3Storage',
+        'OPTIONS': {
+            'bucket_name': os.getenv('AWS_STORAGE_BUCKET_NAME', 'aistorywall'),
+            'endpoint_url': os.getenv('AWS_S3_ENDPOINT_URL') or None,
+            'region_name': os.getenv('AWS_S3_REGION_NAME') or None,
+            'access_key': os.getenv('AWS_ACCESS_KEY_ID') or None,
+            'secret_key': os.getenv('AWS_SECRET_ACCESS_KEY') or None,
+            'custom_domain': os.getenv('AWS_S3_CUSTOM_DOMAIN') or None,
+            'querystring_auth': os.getenv('AWS_QUERYSTRING_AUTH', 'True').lower() in ('1', 'true', 'yes'),
+            'file_overwrite': False,
+        },
+    }
+else:
+    # Stores under MEDIA_ROOT and serves from MEDIA_URL
+    GENERATED_STORAGE_CONFIG = {'BACKEND': 'django.core.files.storage.FileSystemStorage'}
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'generated': GENERATED_STORAGE_CONFIG,
+}
+
+# Node-local cache of intermediate PDF renders (page fragments and print
+# resolution images); safe to delete at any time
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', str(BASE_DIR / 'cache' / 'render'))
+
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # For development
 
 # OpenAI API settings
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+# Alternative API endpoint, e.g. a local stand-in (empty uses api.openai.com)
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', '')
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '60'))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '50'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '30'))
+# Cached health status is trusted for this many seconds
+OPENAI_HEALTH_TTL = float(os.getenv('OPENAI_HEALTH_TTL', '60'))
+OPENAI_HEALTH_TIMEOUT = float(os.getenv('OPENAI_HEALTH_TIMEOUT', '5'))
+# Seconds between background health probes (0 disables the prober)
+OPENAI_HEALTH_PROBE_INTERVAL = float(os.getenv('OPENAI_HEALTH_PROBE_INTERVAL', '0'))
+
+# Stream story continuations to the browser over Server-Sent Events
+STREAM_CONTINUATIONS = os.getenv('STREAM_CONTINUATIONS', 'True').lower() in ('1', 'true', 'yes')
+# A continuation whose stream is not opened within this many seconds is
+# generated server-side instead (0 disables)
+STREAM_CLAIM_TIMEOUT = float(os.getenv('STREAM_CLAIM_TIMEOUT', '30'))
+
+# Story context sent to GPT: the last N turns are sent verbatim, older turns
+# as a rolling summary, and the whole prompt is kept within the token budget
+STORY_CONTEXT_RECENT_TURNS = int(os.getenv('STORY_CONTEXT_RECENT_TURNS', '3'))
+STORY_CONTEXT_TOKEN_BUDGET = int(os.getenv('STORY_CONTEXT_TOKEN_BUDGET', '1500'))
+STORY_SUMMARY_MAX_WORDS = int(os.getenv('STORY_SUMMARY_MAX_WORDS', '150'))
 
 # Replicate API settings for Stable Diffusion
 REPLICATE_API_TOKEN = os.getenv('REPLICATE_API_TOKEN', '')
+# Alternative API endpoint, e.g. a local stand-in (empty uses api.replicate.com)
+REPLICATE_API_BASE_URL = os.getenv('REPLICATE_API_BASE_URL', '')
+# Seconds between status checks of a running prediction
+REPLICATE_POLL_INTERVAL = float(os.getenv('REPLICATE_POLL_INTERVAL', '0.5'))
+REPLICATE_IMAGE_MODEL = os.getenv('REPLICATE_IMAGE_MODEL', 'stability-ai/sdxl-lightning')
+REPLICATE_IMAGE_MODEL_VERSION = os.getenv('REPLICATE_IMAGE_MODEL_VERSION', 'latest')
+# Seconds a resolved model version is reused before it is looked up again
+REPLICATE_VERSION_CACHE_TTL = float(os.getenv('REPLICATE_VERSION_CACHE_TTL', '3600'))
+
+# Generated images are streamed to storage in chunks of this many bytes.
+# Sync Replicate calls and downloads share a keep-alive session with up to
+# HTTP_POOL_MAXSIZE connections to each of HTTP_POOL_HOSTS hosts; outputs of
+# predictions with num_outputs > 1 are downloaded by IMAGE_DOWNLOAD_WORKERS
+# threads at once.
+IMAGE_DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv('IMAGE_DOWNLOAD_CONNECT_TIMEOUT', '5'))
+IMAGE_DOWNLOAD_READ_TIMEOUT = float(os.getenv('IMAGE_DOWNLOAD_READ_TIMEOUT', '30'))
+IMAGE_DOWNLOAD_CHUNK_SIZE = int(os.getenv('IMAGE_DOWNLOAD_CHUNK_SIZE', str(64 * 1024)))
+IMAGE_DOWNLOAD_WORKERS = int(os.getenv('IMAGE_DOWNLOAD_WORKERS', '4'))
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '10'))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '32'))
+
+# Content-addressed cache of generated images (stored under MEDIA_ROOT/cache)
+IMAGE_CACHE_ENABLED = os.getenv('IMAGE_CACHE_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# Reuse images whose prompts share at least this fraction of words (0 disables)
+IMAGE_CACHE_SIMILARITY = float(os.getenv('IMAGE_CACHE_SIMILARITY', '0'))
+IMAGE_CACHE_SIMILARITY_CANDIDATES = int(os.getenv('IMAGE_CACHE_SIMILARITY_CANDIDATES', '200'))
+# While Replicate's circuit breaker is open, a cached image stands in for a
+# new one only if its prompt shares at least this fraction of words (same
+# measure as IMAGE_CACHE_SIMILARITY; 0 disables the stand-in)
+IMAGE_FALLBACK_SIMILARITY = float(os.getenv('IMAGE_FALLBACK_SIMILARITY', '0.6'))
+
+# Image readiness event streams: how often a stream checks the cache for
+# changes, how often it re-reads the database regardless, and how long a
+# single stream stays open before the browser reconnects
+IMAGE_EVENTS_POLL_INTERVAL = float(os.getenv('IMAGE_EVENTS_POLL_INTERVAL', '0.5'))
+IMAGE_EVENTS_DB_RECHECK = float(os.getenv('IMAGE_EVENTS_DB_RECHECK', '5'))
+IMAGE_EVENTS_MAX_DURATION = float(os.getenv('IMAGE_EVENTS_MAX_DURATION', '300'))
+
+# Serve create_story/continue_story with the async views in
+# storyapp/async_views.py (requires an ASGI server)
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False').lower() in ('1', 'true', 'yes')
+# Connection pool shared by async Replicate calls and image downloads
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', '100'))
+ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', '60'))
+
+# Worker threads of the per-turn pipelines in a process: one pool for the
+# image steps and one for GPT steps and summary updates. continue_story
+# waits at most TURN_TEXT_TIMEOUT seconds for the continuation; a later one
+# is still saved when it arrives.
+TURN_PIPELINE_WORKERS = int(os.getenv('TURN_PIPELINE_WORKERS', '8'))
+TURN_TEXT_WORKERS = int(os.getenv('TURN_TEXT_WORKERS', '4'))
+TURN_TEXT_TIMEOUT = float(os.getenv('TURN_TEXT_TIMEOUT', '90'))
+
+# Durable job queue: when enabled, image generation is queued in the
+# database and processed by `python manage.py run_worker`
+IMAGE_JOBS_DURABLE = os.getenv('IMAGE_JOBS_DURABLE', 'False').lower() in ('1', 'true', 'yes')
+JOB_WORKER_CONCURRENCY = int(os.getenv('JOB_WORKER_CONCURRENCY', '4'))
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '120'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Base retry delay in seconds, doubled on every failed attempt
+JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', '10'))
+
+# Story finalization: how long to wait for the last turn's images before
+# rendering the PDF without them
+STORY_FINALIZE_TIMEOUT = float(os.getenv('STORY_FINALIZE_TIMEOUT', '180'))
+# Stories still waiting or rendering this many seconds after that deadline
+# are finalized again by `manage.py resume_finalizations`
+STORY_FINALIZE_STALE_AFTER = float(os.getenv('STORY_FINALIZE_STALE_AFTER', '600'))
+
+# Images embedded in the comic PDF are downscaled to this resolution and
+# re-encoded as JPEG (PDF_IMAGE_DPI=0 embeds the original files)
+PDF_IMAGE_DPI = int(os.getenv('PDF_IMAGE_DPI', '150'))
+PDF_IMAGE_QUALITY = int(os.getenv('PDF_IMAGE_QUALITY', '80'))
+
+# Smaller copies of generated images written for responsive pages (srcset),
+# in JPEG plus WebP/AVIF where Pillow supports them
+IMAGE_DERIVATIVE_WIDTHS = [int(width) for width in os.getenv('IMAGE_DERIVATIVE_WIDTHS', '256,512').split(',') if width]
+IMAGE_DERIVATIVE_QUALITY = int(os.getenv('IMAGE_DERIVATIVE_QUALITY', '80'))
+
+# Pool of pre-generated story intros (plot text and plot image) per theme.
+# A refill is started when a theme drops below INTRO_POOL_LOW_WATER; it is
+# run by a worker job with IMAGE_JOBS_DURABLE, otherwise in a background
+# thread. `python manage.py fill_intro_pool` fills the pools directly.
+INTRO_POOL_ENABLED = os.getenv('INTRO_POOL_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+INTRO_POOL_SIZE = int(os.getenv('INTRO_POOL_SIZE', '5'))
+INTRO_POOL_LOW_WATER = int(os.getenv('INTRO_POOL_LOW_WATER', '2'))
+
+# Cache used for pages of completed stories, the theme list and shared
+# counters: 'locmem' (per process), 'file' or 'redis' (shared by processes)
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem').lower()
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', ''),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', str(BASE_DIR / 'cache' / 'django')),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://127.0.0.1:6379/0'),
+}
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND][0],
+        'LOCATION': os.getenv('CACHE_LOCATION', CACHE_BACKENDS[CACHE_BACKEND][1]),
+    }
+}
+
+# Seconds cached pages and fragments are kept
+PAGE_CACHE_TIMEOUT = int(os.getenv('PAGE_CACHE_TIMEOUT', '86400'))
+
+# Metrics served at /metrics in the Prometheus text format. With several
+# worker processes, set METRICS_DIR to a directory shared by them (and
+# emptied on deploys): each process writes its samples there every
+# METRICS_FLUSH_INTERVAL seconds, so a scrape of any process sees them all.
+# Empty reports only the scraped process. If METRICS_TOKEN is set, scrapes
+# must send it as a bearer token.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Limits on calls to OpenAI and Replicate, shared by all processes through
+# the cache (see storyapp/limits.py; use a shared CACHE_BACKEND with several
+# workers). Budgets are per minute, counted in LIMITER_WINDOW-second windows;
+# 0 disables a budget. The concurrency limit starts at *_MAX_CONCURRENCY and
+# is lowered when calls are throttled (HTTP 429) or slower than
+# *_LATENCY_TARGET seconds. Calls wait up to LIMITER_MAX_WAIT seconds for room.
+LIMITER_ENABLED = os.getenv('LIMITER_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+LIMITER_WINDOW = int(os.getenv('LIMITER_WINDOW', '10'))
+LIMITER_MAX_WAIT = float(os.getenv('LIMITER_MAX_WAIT', '15'))
+LIMITER_DECREASE_COOLDOWN = float(os.getenv('LIMITER_DECREASE_COOLDOWN', '5'))
+# Seconds after which the in-flight count of crashed processes is forgotten
+LIMITER_SLOT_TTL = int(os.getenv('LIMITER_SLOT_TTL', '300'))
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', '500'))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', '40000'))
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '32'))
+OPENAI_LATENCY_TARGET = float(os.getenv('OPENAI_LATENCY_TARGET', '20'))
+REPLICATE_RPM = int(os.getenv('REPLICATE_RPM', '600'))
+REPLICATE_MAX_CONCURRENCY = int(os.getenv('REPLICATE_MAX_CONCURRENCY', '16'))
+REPLICATE_LATENCY_TARGET = float(os.getenv('REPLICATE_LATENCY_TARGET', '60'))
+
+# Retries and circuit breakers around OpenAI and Replicate calls (see
+# storyapp/resilience.py). Timeouts, connection errors and HTTP 408/429/5xx
+# are retried with jittered exponential backoff; after
+# BREAKER_FAILURE_THRESHOLD such failures within BREAKER_FAILURE_WINDOW
+# seconds a service is skipped (cached or placeholder content is used) for
+# BREAKER_RESET_TIMEOUT seconds before a probe call is let through.
+UPSTREAM_RETRY_ATTEMPTS = int(os.getenv('UPSTREAM_RETRY_ATTEMPTS', '3'))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv('UPSTREAM_RETRY_BASE_DELAY', '0.5'))
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv('UPSTREAM_RETRY_MAX_DELAY', '8'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_FAILURE_WINDOW = int(os.getenv('BREAKER_FAILURE_WINDOW', '60'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+# Per-attempt timeouts: a chat completion, a single Replicate API request,
+# and a whole prediction from creation to result
+OPENAI_CALL_TIMEOUT = float(os.getenv('OPENAI_CALL_TIMEOUT', '30'))
+REPLICATE_REQUEST_TIMEOUT = float(os.getenv('REPLICATE_REQUEST_TIMEOUT', '10'))
+REPLICATE_PREDICTION_TIMEOUT = float(os.getenv('REPLICATE_PREDICTION_TIMEOUT', '120'))
+
+# Webhook-driven predictions: instead of polling, image requests create a
+# Replicate prediction and return at once; Replicate POSTs the result to
+# REPLICATE_WEBHOOK_URL (the public base URL of this site) and the image is
+# attached there. Webhooks are checked against REPLICATE_WEBHOOK_SECRET (the
+# `whsec_...` signing secret) and rejected when their timestamp is more than
+# REPLICATE_WEBHOOK_TOLERANCE seconds off. `python manage.py
+# reconcile_predictions` completes predictions whose webhook has not arrived
+# within PREDICTION_RECONCILE_AFTER seconds.
+REPLICATE_WEBHOOKS = os.getenv('REPLICATE_WEBHOOKS', 'False').lower() in ('1', 'true', 'yes')
+REPLICATE_WEBHOOK_URL = os.getenv('REPLICATE_WEBHOOK_URL', '')
+REPLICATE_WEBHOOK_SECRET = os.getenv('REPLICATE_WEBHOOK_SECRET', '')
+REPLICATE_WEBHOOK_TOLERANCE = int(os.getenv('REPLICATE_WEBHOOK_TOLERANCE', '300'))
+PREDICTION_RECONCILE_AFTER = float(os.getenv('PREDICTION_RECONCILE_AFTER', '60'))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, Theme, Story, StoryResponse
+from .models import User, Theme, Story, StoryResponse, Job, CachedImage, StoryIntro, Prediction
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -13,8 +13,8 @@ class ThemeAdmin(admin.ModelAdmin):
 
 @admin.register(Story)
 class StoryAdmin(admin.ModelAdmin):
-    list_display = ('character_name', 'theme', 'user', 'created_at', 'email_sent')
-    list_filter = ('theme', 'email_sent', 'created_at')
+    list_display = ('character_name', 'theme', 'user', 'created_at', 'finalize_status', 'email_sent')
+    list_filter = ('theme', 'finalize_status', 'email_sent', 'created_at')
     search_fields = ('character_name', 'user__email')
 
 @admin.register(StoryResponse)
@@ -22,3 +22,25 @@ class StoryResponseAdmin(admin.ModelAdmin):
     list_display = ('story', 'created_at')
     list_filter = ('created_at',)
     search_fields = ('user_input', 'ai_response')
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'run_after', 'worker', 'created_at')
+    list_filter = ('kind', 'status')
+    search_fields = ('last_error', 'worker')
+
+@admin.register(CachedImage)
+class CachedImageAdmin(admin.ModelAdmin):
+    list_display = ('key', 'path', 'size', 'hits', 'last_used_at')
+    search_fields = ('key', 'prompt')
+
+@admin.register(StoryIntro)
+class StoryIntroAdmin(admin.ModelAdmin):
+    list_display = ('id', 'theme', 'created_at')
+    list_filter = ('theme',)
+
+@admin.register(Prediction)
+class PredictionAdmin(admin.ModelAdmin):
+    list_display = ('replicate_id', 'kind', 'status', 'story', 'created_at', 'completed_at')
+    list_filter = ('kind', 'status')
+    search_fields = ('replicate_id', 'error')
@@ -0,0 +1,301 @@
+# Async implementations of the story views, used when ASYNC_VIEWS is enabled.
+#
+# These views await GPT and Replicate on shared async connection pools, so an
+# ASGI worker can hold many story turns that are waiting on upstream APIs
+# without tying up a thread for each. Image generation continues as tasks on
+# the worker's event loop after the view has responded, so these views must be
+# served by an ASGI server (e.g. `uvicorn aistorywall.asgi:application`).
+# GET requests only render templates and are delegated to the sync views.
+# The Server-Sent Events views are async generators, so under ASGI every
+# event is sent as soon as it is yielded instead of after the whole stream.
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import redirect
+from django.urls import reverse
+
+from . import events, jobs, views
+from .context import build_story_context, start_summary_update
+from .derivatives import image_fields
+from .intro_pool import claim_intro
+from .forms import StoryForm, StoryResponseForm
+from .models import Job, Story, StoryResponse, User
+from .storage import file_url
+
+# Strong references to running background tasks, so they are not garbage
+# collected before they finish
+_background_tasks = set()
+
+
+def spawn(coro):
+    """Run a coroutine in the background on the current event loop."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def aget_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f"No {queryset.model._meta.object_name} matches the given query.")
+
+
+async def agenerate_and_attach(story_id, response_id, field, coro):
+    """Await an image coroutine and store its path on a response."""
+    image_path = await coro
+    await sync_to_async(views.attach_image(story_id, response_id, field))(image_path)
+
+
+async def acreate_story(request):
+    """Create a new story."""
+    if request.method != 'POST':
+        return await sync_to_async(views.create_story)(request)
+
+    # Check if user is in session
+    user_id = await sync_to_async(request.session.get)('user_id')
+    if not user_id:
+        return redirect('index')
+
+    user = await aget_or_404(User.objects.all(), id=user_id)
+
+    form = StoryForm(request.POST)
+    if not await sync_to_async(form.is_valid)():
+        return await sync_to_async(views.create_story)(request)
+
+    theme = form.cleaned_data['theme']
+    character_name = form.cleaned_data['character_name']
+
+    plot_text = None
+    plot_image_fields = {}
+    try:
+        # Use a pre-generated intro for the theme if one is available
+        intro = await sync_to_async(claim_intro)(theme, character_name)
+        if intro is not None:
+            story = await Story.objects.acreate(user=user, theme=theme, character_name=character_name, **intro)
+            return redirect('continue_story', story_id=story.id)
+
+        # Generate story plot using GPT
+        plot_text = await views.agenerate_story_plot(theme.description, character_name)
+
+        if not settings.IMAGE_JOBS_DURABLE:
+            plot_image_path = await views.agenerate_plot_image(plot_text)
+            plot_image_fields = await sync_to_async(image_fields, thread_sensitive=False)('plot_image_path', plot_image_path)
+    except Exception as e:
+        print(f"Error creating story: {e}")
+        await sync_to_async(messages.error)(request, f"Error creating story: {str(e)}")
+
+        # Create story without image if generation fails; the plot is
+        # generated here if the failure came before it
+        if plot_text is None:
+            plot_text = await views.agenerate_story_plot(theme.description, character_name)
+        plot_image_fields = {}
+
+    story = await Story.objects.acreate(
+        user=user,
+        theme=theme,
+        character_name=character_name,
+        plot_text=plot_text,
+        **plot_image_fields
+    )
+    if settings.IMAGE_JOBS_DURABLE:
+        await sync_to_async(jobs.enqueue)(Job.KIND_PLOT_IMAGE, story=story)
+
+    return redirect('continue_story', story_id=story.id)
+
+
+async def acontinue_story(request, story_id):
+    """Continue an existing story."""
+    if request.method != 'POST':
+        return await sync_to_async(views.continue_story)(request, story_id)
+
+    # Check if user is in session
+    user_id = await sync_to_async(request.session.get)('user_id')
+    if not user_id:
+        return redirect('index')
+
+    story = await aget_or_404(Story.objects.select_related('theme'), id=story_id)
+
+    form = StoryResponseForm(request.POST)
+    if not await sync_to_async(form.is_valid)():
+        if views.wants_json(request):
+            return JsonResponse({'errors': form.errors}, status=400)
+        return await sync_to_async(views.continue_story)(request, story_id)
+
+    user_input = form.cleaned_data['user_input']
+    streaming = settings.STREAM_CONTINUATIONS and views.wants_json(request)
+
+    responses = [
+        resp async for resp in StoryResponse.objects.filter(story=story).order_by('created_at')
+    ]
+
+    # Create the response row first so every step can attach to it
+    response = await sync_to_async(views.create_response)(story, user_input)
+
+    # The user panel only depends on the user input, so it renders while
+    # GPT writes the continuation
+    requested_at = time.time()
+    if settings.IMAGE_JOBS_DURABLE:
+        await sync_to_async(jobs.enqueue)(Job.KIND_USER_IMAGE, story=story, response=response)
+    else:
+        spawn(agenerate_and_attach(
+            story.id, response.id, 'user_img_path',
+            views.agenerate_user_image(user_input, story.character_name, queued_at=requested_at),
+        ))
+
+    if streaming:
+        views.schedule_stream_fallback(story, response)
+        return JsonResponse({
+            'response_id': response.id,
+            'stream_url': reverse('stream_story_response', args=[response.id]),
+        })
+
+    story_context = build_story_context(story, responses, user_input)
+    ai_response = await views.agenerate_ai_response(story_context)
+    await StoryResponse.objects.filter(id=response.id).aupdate(ai_response=ai_response)
+    start_summary_update(story.id)
+
+    if settings.IMAGE_JOBS_DURABLE:
+        await sync_to_async(jobs.enqueue)(Job.KIND_AI_IMAGE, story=story, response=response)
+    else:
+        spawn(agenerate_and_attach(
+            story.id, response.id, 'ai_img_path',
+            views.agenerate_ai_image(ai_response, queued_at=requested_at),
+        ))
+
+    # If we have 10 responses, generate PDF and send email
+    if story.turn_count >= 10:
+        await sync_to_async(views.complete_story)(story)
+        return redirect('story_complete', story_id=story.id)
+
+    # Redirect to refresh the page and show the new response
+    return redirect('continue_story', story_id=story.id)
+
+
+def event_stream(events_iterator):
+    """Server-Sent Events response that proxies must not buffer."""
+    response = StreamingHttpResponse(events_iterator, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def astream_story_response(request, response_id):
+    """Async version of views.stream_story_response."""
+    if not await sync_to_async(request.session.get)('user_id'):
+        return HttpResponse(status=403)
+
+    response = await aget_or_404(StoryResponse.objects.select_related('story__theme'), id=response_id)
+    story = response.story
+
+    def event(data, name=None):
+        prefix = f"event: {name}\n" if name else ""
+        return f"{prefix}data: {json.dumps(data)}\n\n"
+
+    def done_event(ai_response, turn_count):
+        data = {'response_id': response.id, 'ai_response': ai_response}
+        if turn_count >= 10:
+            data['redirect_url'] = reverse('story_complete', args=[story.id])
+        return event(data, name='done')
+
+    async def stream():
+        turn_count = story.turn_count
+        if response.ai_response:
+            yield done_event(response.ai_response, turn_count)
+            return
+
+        # Only one connection generates the text; reconnects wait for it
+        if not await cache.aadd(views.stream_lock_key(response.id), True, timeout=settings.OPENAI_TIMEOUT * 2):
+            deadline = time.monotonic() + settings.OPENAI_TIMEOUT * 2
+            while time.monotonic() < deadline:
+                ai_response = await StoryResponse.objects.filter(id=response.id).values_list(
+                    'ai_response', flat=True).afirst()
+                if ai_response:
+                    yield done_event(ai_response, turn_count)
+                    return
+                yield ": waiting\n\n"
+                await asyncio.sleep(1)
+            return
+
+        previous = [
+            resp async for resp in StoryResponse.objects.filter(story=story, id__lt=response.id).order_by('created_at')
+        ]
+        story_context = build_story_context(story, previous, response.user_input)
+
+        chunks = []
+        tokens = views.astream_ai_response(story_context)
+        try:
+            async for chunk in tokens:
+                chunks.append(chunk)
+                yield event({'token': chunk})
+        finally:
+            # A client that disconnects mid-stream still gets its turn saved
+            async for chunk in tokens:
+                chunks.append(chunk)
+            ai_response = ''.join(chunks).strip()
+            await sync_to_async(views.finish_streamed_turn)(story, response, ai_response, turn_count)
+        yield done_event(ai_response, turn_count)
+
+    return event_stream(stream())
+
+
+async def astory_image_events(request, story_id):
+    """Async version of views.story_image_events.
+
+    Statuses are read with the async ORM and changes are awaited with
+    events.await_change, so an open stream holds no thread.
+    """
+    if not await sync_to_async(request.session.get)('user_id'):
+        return HttpResponse(status=403)
+    plot_image_path = await aget_or_404(Story.objects.values_list('plot_image_path', flat=True), id=story_id)
+
+    def event(data, name):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    async def statuses_of(response_ids=None):
+        return [views.image_status(row) async for row in views.image_status_rows(story_id, response_ids)]
+
+    async def stream():
+        yield "retry: 3000\n\n"
+        deadline = time.monotonic() + settings.IMAGE_EVENTS_MAX_DURATION
+        version = await events.acurrent_version(story_id)
+        plot_pending = not plot_image_path
+        # Last status sent for every response that is still missing an image
+        pending = {}
+        statuses = await statuses_of()
+
+        while True:
+            for status in statuses:
+                if status != pending.get(status['response_id']):
+                    yield event(status, 'image')
+                if status['user_img_ready'] and status['ai_img_ready']:
+                    pending.pop(status['response_id'], None)
+                else:
+                    pending[status['response_id']] = status
+
+            if not pending:
+                yield event({'story_id': story_id}, 'complete')
+                return
+            if time.monotonic() > deadline:
+                return
+
+            new_version = await events.await_change(story_id, version, settings.IMAGE_EVENTS_DB_RECHECK)
+            if new_version == version:
+                yield ": keepalive\n\n"
+            version = new_version
+
+            if plot_pending:
+                plot_image = await Story.objects.filter(id=story_id).values_list('plot_image_path', flat=True).afirst()
+                if plot_image:
+                    plot_pending = False
+                    yield event({'plot_image_path': plot_image, 'plot_image_url': file_url(plot_image)}, 'plot')
+            statuses = await statuses_of(list(pending))
+
+    return event_stream(stream())
@@ -0,0 +1,78 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import events
+from .models import Theme
+
+# Cached data is stored under keys that embed a version counter. Writes bump
+# the counter (see signals.py), which orphans every key built from the old
+# version; orphaned entries simply expire.
+
+
+def _version_key(name):
+    return f"version:{name}"
+
+
+def get_version(name):
+    return cache.get(_version_key(name), 0)
+
+
+def bump_version(name):
+    """Invalidate everything cached under the versioned name."""
+    key = _version_key(name)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def themes_version():
+    return get_version('themes')
+
+
+def get_themes():
+    """All themes, cached until a theme is saved or deleted."""
+    key = f"themes:{themes_version()}"
+    themes = cache.get(key)
+    if themes is None:
+        themes = list(Theme.objects.order_by('id'))
+        cache.set(key, themes, timeout=settings.PAGE_CACHE_TIMEOUT)
+    return themes
+
+
+def story_page_key(story_id):
+    # Model writes bump the story version; image and finalization updates
+    # are made with queryset updates and are seen through the event version
+    return f"story-page:{story_id}:{get_version(f'story:{story_id}')}:{events.current_version(story_id)}"
+
+
+def get_story_page(request, story_id):
+    """Cached page of a completed story, looked up once per request."""
+    if not hasattr(request, '_story_page'):
+        request._story_page = cache.get(story_page_key(story_id))
+    return request._story_page
+
+
+def set_story_page(story_id, content):
+    """Cache the rendered page of a completed story and return the entry."""
+    entry = {
+        'content': content,
+        'etag': f'"{hashlib.md5(content, usedforsecurity=False).hexdigest()}"',
+        'last_modified': timezone.now().replace(microsecond=0),
+    }
+    cache.set(story_page_key(story_id), entry, timeout=settings.PAGE_CACHE_TIMEOUT)
+    return entry
+
+
+def story_page_etag(request, story_id):
+    entry = get_story_page(request, story_id)
+    return entry['etag'] if entry else None
+
+
+def story_page_last_modified(request, story_id):
+    entry = get_story_page(request, story_id)
+    return entry['last_modified'] if entry else None
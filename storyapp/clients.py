@@ -0,0 +1,247 @@
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from openai import AsyncOpenAI, OpenAI
+from requests.adapters import HTTPAdapter
+
+from . import limits, metrics, resilience
+
+# Process-wide client registry. Building an OpenAI client sets up a new HTTP
+# connection pool, so we build it once per process and share it between
+# requests and background threads (the client is thread safe).
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Cached result of the last health probe, reported by the readiness endpoint.
+# The probe runs from that endpoint or the background prober; story requests
+# never wait on it or read it.
+_health = {'ok': None, 'checked_at': 0.0, 'error': None, 'latency': None}
+_health_lock = threading.Lock()
+_prober = None
+
+# Async clients are bound to the event loop they were created on, so the
+# async registry is kept per loop. Under ASGI there is one long-lived loop
+# per worker and every async view shares its pools.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _build_openai_client():
+    """Create an OpenAI client with a pooled keep-alive HTTP transport."""
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=settings.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=settings.OPENAI_TIMEOUT,
+    )
+    return OpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        base_url=settings.OPENAI_BASE_URL or None,
+        http_client=http_client,
+        timeout=settings.OPENAI_TIMEOUT,
+        # Retries are made by storyapp.resilience, behind its circuit breaker
+        max_retries=0,
+    )
+
+
+def get_openai_client():
+    """Return the shared OpenAI client, or None if no API key is configured.
+
+    The health probe only feeds the readiness endpoint. Outages are handled
+    by the OpenAI circuit breaker in storyapp.resilience, which fails calls
+    fast and closes again as soon as a probe call succeeds.
+    """
+    if not settings.OPENAI_API_KEY or not settings.OPENAI_API_KEY.strip():
+        print("WARNING: OPENAI_API_KEY is not set or empty")
+        return None
+
+    client = _clients.get('openai')
+    if client is None:
+        with _clients_lock:
+            client = _clients.get('openai')
+            if client is None:
+                client = _build_openai_client()
+                _clients['openai'] = client
+        start_health_prober()
+    return client
+
+
+def _async_registry():
+    loop = asyncio.get_running_loop()
+    registry = _async_clients.get(loop)
+    if registry is None:
+        registry = _async_clients[loop] = {}
+    return registry
+
+
+def get_async_openai_client():
+    """Return the AsyncOpenAI client shared by async views on this event loop.
+
+    Returns None under the same conditions as get_openai_client.
+    """
+    if not settings.OPENAI_API_KEY or not settings.OPENAI_API_KEY.strip():
+        print("WARNING: OPENAI_API_KEY is not set or empty")
+        return None
+
+    registry = _async_registry()
+    client = registry.get('openai')
+    if client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=settings.OPENAI_TIMEOUT,
+        )
+        client = registry['openai'] = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL or None,
+            http_client=http_client,
+            timeout=settings.OPENAI_TIMEOUT,
+            max_retries=0,
+        )
+    return client
+
+
+def get_async_http_client():
+    """Return the pooled httpx.AsyncClient used for Replicate and downloads."""
+    registry = _async_registry()
+    client = registry.get('http')
+    if client is None:
+        client = registry['http'] = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.ASYNC_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.ASYNC_HTTP_MAX_CONNECTIONS,
+            ),
+            timeout=settings.ASYNC_HTTP_TIMEOUT,
+            follow_redirects=True,
+        )
+    return client
+
+
+def get_http_session():
+    """Return the requests.Session shared by sync Replicate calls and image downloads.
+
+    Its connections are kept alive per host (up to HTTP_POOL_MAXSIZE each),
+    so repeated calls to the API and the image CDN skip the TCP and TLS
+    handshakes.
+    """
+    session = _clients.get('http')
+    if session is None:
+        with _clients_lock:
+            session = _clients.get('http')
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_HOSTS, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _clients['http'] = session
+    return session
+
+
+def estimate_chat_tokens(messages, max_tokens):
+    """Tokens a chat completion may use: about four characters per prompt token plus the completion."""
+    return sum(len(message['content']) for message in messages) // 4 + 1 + max_tokens
+
+
+def _complete(client, call, messages, max_tokens, **kwargs):
+    with limits.limit('openai', tokens=estimate_chat_tokens(messages, max_tokens)) as slot:
+        with metrics.timer('storyapp_gpt_request_seconds', call=call):
+            response = client.chat.completions.create(
+                model="gpt-4", messages=messages, max_tokens=max_tokens,
+                timeout=settings.OPENAI_CALL_TIMEOUT, **kwargs
+            )
+        if response.usage is not None:
+            slot.use_tokens(response.usage.total_tokens)
+    metrics.count_tokens(call, response.usage)
+    return response
+
+
+async def _acomplete(client, call, messages, max_tokens, **kwargs):
+    async with limits.alimit('openai', tokens=estimate_chat_tokens(messages, max_tokens)) as slot:
+        with metrics.timer('storyapp_gpt_request_seconds', call=call):
+            response = await client.chat.completions.create(
+                model="gpt-4", messages=messages, max_tokens=max_tokens,
+                timeout=settings.OPENAI_CALL_TIMEOUT, **kwargs
+            )
+        if response.usage is not None:
+            await slot.ause_tokens(response.usage.total_tokens)
+    metrics.count_tokens(call, response.usage)
+    return response
+
+
+def create_chat_completion(client, call, messages, max_tokens, **kwargs):
+    """Create a GPT-4 chat completion, timed and counted as `call`.
+
+    Every attempt stays within the OpenAI limits; transient failures are
+    retried and CircuitOpen is raised while OpenAI is known to be down.
+    """
+    return resilience.call('openai', _complete, client, call, messages, max_tokens, **kwargs)
+
+
+async def acreate_chat_completion(client, call, messages, max_tokens, **kwargs):
+    """Async version of create_chat_completion."""
+    return await resilience.acall('openai', _acomplete, client, call, messages, max_tokens, **kwargs)
+
+
+def openai_health():
+    """Return the cached OpenAI health status without probing."""
+    with _health_lock:
+        status = dict(_health)
+    age = time.monotonic() - status['checked_at']
+    status['fresh'] = status['ok'] is not None and age < settings.OPENAI_HEALTH_TTL
+    return status
+
+
+def refresh_openai_health(force=False):
+    """Probe OpenAI if the cached status has expired and return the result.
+
+    The probe lists models, which costs no tokens, instead of running a
+    completion.
+    """
+    status = openai_health()
+    if status['fresh'] and not force:
+        return status
+
+    if not settings.OPENAI_API_KEY or not settings.OPENAI_API_KEY.strip():
+        ok, error, latency = False, 'OPENAI_API_KEY is not set', None
+    else:
+        client = _clients.get('openai') or _build_openai_client()
+        _clients.setdefault('openai', client)
+        start_time = time.monotonic()
+        try:
+            client.with_options(timeout=settings.OPENAI_HEALTH_TIMEOUT).models.list()
+            ok, error = True, None
+        except Exception as e:
+            print(f"OpenAI health probe failed: {type(e).__name__}: {e}")
+            ok, error = False, f"{type(e).__name__}: {e}"
+        latency = time.monotonic() - start_time
+
+    with _health_lock:
+        _health.update(ok=ok, checked_at=time.monotonic(), error=error, latency=latency)
+    return openai_health()
+
+
+def start_health_prober():
+    """Start the background health prober if an interval is configured."""
+    global _prober
+    interval = settings.OPENAI_HEALTH_PROBE_INTERVAL
+    if not interval or _prober is not None:
+        return
+
+    def probe_loop():
+        while True:
+            refresh_openai_health(force=True)
+            time.sleep(interval)
+
+    with _clients_lock:
+        if _prober is None:
+            _prober = threading.Thread(target=probe_loop, name='openai-health-prober', daemon=True)
+            _prober.start()
@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.db import close_old_connections
+
+from .clients import create_chat_completion, get_openai_client
+from .models import Story, StoryResponse
+from .pipeline import get_executor
+
+
+def estimate_tokens(text):
+    """Rough token count for English text (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def format_turn(response):
+    return f"User: {response.user_input}\nAI: {response.ai_response}\n"
+
+
+def build_story_context(story, responses, user_input):
+    """Build the GPT prompt context for the next turn within a token budget.
+
+    The last STORY_CONTEXT_RECENT_TURNS turns are kept verbatim and older
+    turns are represented by the rolling summary stored on the story, so the
+    prompt size stays flat however long the story gets. Turns that are older
+    than the recent window but not yet folded into the summary (the summary
+    is updated in the background) are included verbatim. If the result is
+    still over STORY_CONTEXT_TOKEN_BUDGET, the oldest verbatim turns are
+    dropped first and the summary is shortened after that.
+    """
+    responses = [response for response in responses if response.ai_response]
+    recent_count = settings.STORY_CONTEXT_RECENT_TURNS
+    summarized = min(story.summarized_turns, max(0, len(responses) - recent_count))
+    turns = [format_turn(response) for response in responses[summarized:]]
+    summary = story.context_summary if summarized else ''
+
+    header = f"Theme: {story.theme.name}\nCharacter: {story.character_name}\nPlot: {story.plot_text}\n"
+    current = f"User: {user_input}\n"
+
+    def assemble():
+        summary_text = f"Story so far: {summary}\n" if summary else ''
+        return header + summary_text + ''.join(turns) + current
+
+    budget = settings.STORY_CONTEXT_TOKEN_BUDGET
+    story_context = assemble()
+    while estimate_tokens(story_context) > budget and len(turns) > 1:
+        turns.pop(0)
+        story_context = assemble()
+    if estimate_tokens(story_context) > budget and summary:
+        excess = (estimate_tokens(story_context) - budget) * 4
+        summary = summary[excess:]
+        story_context = assemble()
+    return story_context
+
+
+def summarize_turns(previous_summary, responses):
+    """Fold the given turns into the running summary using GPT."""
+    new_events = ''.join(format_turn(response) for response in responses)
+    max_words = settings.STORY_SUMMARY_MAX_WORDS
+
+    client = get_openai_client()
+    if client is not None:
+        try:
+            prompt = (
+                f"Here is the summary of a children's comic book story so far:\n{previous_summary or '(nothing yet)'}\n\n"
+                f"Update the summary to include these new events:\n{new_events}\n"
+                f"Keep the important characters, places and plot points. Use at most {max_words} words."
+            )
+            response = create_chat_completion(client, 'summary', [
+                {"role": "system", "content": "You summarize stories concisely."},
+                {"role": "user", "content": prompt}
+            ], max_tokens=max_words * 2)
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"Error summarizing story: {e}")
+
+    # Without GPT keep the first sentence of every turn, newest last
+    sentences = [previous_summary] if previous_summary else []
+    for response in responses:
+        sentences.append(response.ai_response.split('. ')[0].strip().rstrip('.') + '.')
+    words = ' '.join(sentences).split()
+    return ' '.join(words[-max_words:])
+
+
+def update_story_summary(story_id):
+    """Fold turns that left the recent window into the story's summary.
+
+    The summary is only written if no other update has moved it on in the
+    meantime. Returns True if the summary changed.
+    """
+    story = Story.objects.only('context_summary', 'summarized_turns').get(id=story_id)
+    responses = list(
+        StoryResponse.objects.filter(story_id=story_id).exclude(ai_response='')
+        .order_by('created_at').only('user_input', 'ai_response')
+    )
+    target = len(responses) - settings.STORY_CONTEXT_RECENT_TURNS
+    if target <= story.summarized_turns:
+        return False
+
+    summary = summarize_turns(story.context_summary, responses[story.summarized_turns:target])
+    updated = Story.objects.filter(id=story_id, summarized_turns=story.summarized_turns).update(
+        context_summary=summary, summarized_turns=target
+    )
+    return bool(updated)
+
+
+def start_summary_update(story_id):
+    """Update the story summary in the background after a turn is saved."""
+    def run():
+        try:
+            update_story_summary(story_id)
+        except Exception as e:
+            print(f"Error updating story summary: {type(e).__name__}: {e}")
+        finally:
+            close_old_connections()
+    return get_executor('text').submit(run)
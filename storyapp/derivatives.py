@@ -0,0 +1,77 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image
+
+from .storage import generated_storage, save_file
+
+# Browser formats in order of preference. JPEG is always written so the
+# <img> fallback has a srcset too; the others depend on the Pillow build.
+WEB_FORMATS = [
+    ('avif', 'AVIF', 'image/avif'),
+    ('webp', 'WEBP', 'image/webp'),
+    ('jpeg', 'JPEG', 'image/jpeg'),
+]
+
+# Model field holding the derivatives of each image path field
+VARIANTS_FIELD = {
+    'plot_image_path': 'plot_image_variants',
+    'user_img_path': 'user_img_variants',
+    'ai_img_path': 'ai_img_variants',
+}
+
+
+def supported_formats():
+    Image.init()
+    return [(name, pil_format, mime) for name, pil_format, mime in WEB_FORMATS if pil_format in Image.SAVE]
+
+
+def derivative_path(relative_path, width, name):
+    stem = os.path.splitext(relative_path)[0]
+    extension = 'jpg' if name == 'jpeg' else name
+    return f"{stem}_{width}w.{extension}"
+
+
+def ingest_image(relative_path):
+    """Write smaller web versions of a saved image next to it.
+
+    Every width in IMAGE_DERIVATIVE_WIDTHS below the source width is written
+    in every supported format, plus the full width for formats other than
+    JPEG (the original serves as the full-size JPEG). Returns a dict for the
+    image's *_variants field: the source size and, per format, a list of
+    [width, path] pairs for srcset. Returns an empty dict on failure, in
+    which case pages fall back to the original image.
+    """
+    if not relative_path:
+        return {}
+    try:
+        with generated_storage().open(relative_path, 'rb') as source, Image.open(source) as image:
+            image = image.convert('RGB')
+            variants = {'width': image.width, 'height': image.height, 'sources': {}}
+            widths = sorted(width for width in settings.IMAGE_DERIVATIVE_WIDTHS if width < image.width)
+            resized = {
+                width: image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+                for width in widths
+            }
+            resized[image.width] = image
+
+            for name, pil_format, mime in supported_formats():
+                sources = []
+                for width in widths + ([] if name == 'jpeg' else [image.width]):
+                    buffer = BytesIO()
+                    resized[width].save(buffer, pil_format, quality=settings.IMAGE_DERIVATIVE_QUALITY)
+                    path = save_file(derivative_path(relative_path, width, name), buffer.getvalue())
+                    sources.append([width, path])
+                if name == 'jpeg':
+                    sources.append([image.width, relative_path])
+                variants['sources'][name] = sources
+        return variants
+    except Exception as e:
+        print(f"Error creating web images for {relative_path}: {type(e).__name__}: {e}")
+        return {}
+
+
+def image_fields(field, relative_path):
+    """Model field values for an image path and its derivatives."""
+    return {field: relative_path, VARIANTS_FIELD[field]: ingest_image(relative_path)}
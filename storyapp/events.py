@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Wakes up event streams in this process as soon as an image is attached.
+# Changes made by other processes (e.g. run_worker) are seen through the
+# version counter in the shared cache, or the periodic database re-check.
+_condition = threading.Condition()
+
+
+def _version_key(story_id):
+    return f"story-images:{story_id}"
+
+
+def publish(story_id):
+    """Signal that an image of a story has been attached."""
+    key = _version_key(story_id)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+    with _condition:
+        _condition.notify_all()
+
+
+def current_version(story_id):
+    return cache.get(_version_key(story_id), 0)
+
+
+def wait_for_change(story_id, version, timeout):
+    """Block until the story's image version differs from `version`.
+
+    Returns the new version, or the unchanged one if `timeout` passed.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        latest = current_version(story_id)
+        remaining = deadline - time.monotonic()
+        if latest != version or remaining <= 0:
+            return latest
+        with _condition:
+            _condition.wait(min(remaining, settings.IMAGE_EVENTS_POLL_INTERVAL))
+
+
+async def acurrent_version(story_id):
+    return await cache.aget(_version_key(story_id), 0)
+
+
+async def await_change(story_id, version, timeout):
+    """Async version of wait_for_change.
+
+    Only the cache is polled, every IMAGE_EVENTS_POLL_INTERVAL seconds, so
+    no thread is held while waiting.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        latest = await acurrent_version(story_id)
+        remaining = deadline - time.monotonic()
+        if latest != version or remaining <= 0:
+            return latest
+        await asyncio.sleep(min(remaining, settings.IMAGE_EVENTS_POLL_INTERVAL))
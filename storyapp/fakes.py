@@ -0,0 +1,324 @@
+"""Local stand-ins for the OpenAI and Replicate HTTP APIs.
+
+The servers answer just the endpoints this app calls, after a configurable
+delay and with a configurable failure rate, so the whole story flow can be
+exercised and load tested without network access or API credits. Point
+OPENAI_BASE_URL and REPLICATE_API_BASE_URL at `server.url` to use them.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+SENTENCES = [
+    "The stars flickered as the ship drifted past the silent moon.",
+    "A hidden door creaked open, revealing a staircase of glowing crystal.",
+    "Far below, the city hummed with a thousand curious voices.",
+    "Nobody expected the map to start drawing itself.",
+    "With a grin, the little robot pressed the big red button.",
+]
+
+
+def parse_latency(spec):
+    """Return a function sampling delays in seconds from a latency spec.
+
+    Specs are `SECONDS` or `constant:SECONDS` for a fixed delay,
+    `uniform:LOW,HIGH`, `normal:MEAN,STDDEV` and `lognormal:MEDIAN,SIGMA`
+    (a long-tailed distribution close to real API latencies).
+    """
+    spec = str(spec).strip()
+    name, _, args = spec.partition(':') if ':' in spec else ('constant', '', spec)
+    values = [float(value) for value in args.split(',')]
+    if name == 'constant' and len(values) == 1:
+        return lambda: values[0]
+    if name == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(*values)
+    if name == 'normal' and len(values) == 2:
+        return lambda: max(0.0, random.gauss(*values))
+    if name == 'lognormal' and len(values) == 2:
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma)
+    raise ValueError(f"Invalid latency spec: {spec!r}")
+
+
+class FakeServer:
+    """A threaded HTTP server on a free local port with request counters."""
+
+    def __init__(self, latency='0', failure_rate=0.0, host='127.0.0.1', port=0):
+        self.sample_latency = parse_latency(latency)
+        self.failure_rate = failure_rate
+        self.stats = {'requests': 0, 'failures': 0, 'connections': 0}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                server.count('connections')
+
+            def do_GET(self):
+                server.dispatch(self, 'GET')
+
+            def do_POST(self):
+                server.dispatch(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def should_fail(self):
+        failed = random.random() < self.failure_rate
+        if failed:
+            self.count('failures')
+        return failed
+
+    def dispatch(self, handler, method):
+        self.count('requests')
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = json.loads(handler.rfile.read(length) or b'null') if length else None
+        for route_method, pattern, view in self.routes():
+            match = re.fullmatch(pattern, handler.path.split('?')[0])
+            if route_method == method and match:
+                view(handler, body, *match.groups())
+                return
+        self.send_json(handler, {'detail': 'Not found'}, status=404)
+
+    def routes(self):
+        return []
+
+    def send_json(self, handler, data, status=200):
+        payload = json.dumps(data).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+
+class FakeOpenAIServer(FakeServer):
+    """Chat completions (plain and streamed) and the model list."""
+
+    def routes(self):
+        return [
+            ('GET', r'/v1/models', self.models),
+            ('POST', r'/v1/chat/completions', self.chat_completion),
+        ]
+
+    def models(self, handler, body):
+        self.send_json(handler, {'object': 'list', 'data': [{'id': 'gpt-4', 'object': 'model', 'owned_by': 'fake'}]})
+
+    def completion_text(self, max_tokens):
+        words = ' '.join(random.choice(SENTENCES) for _ in range(6)).split()
+        return ' '.join(words[:max(1, min(len(words), max_tokens or 100))])
+
+    def chat_completion(self, handler, body):
+        delay = self.sample_latency()
+        if self.should_fail():
+            time.sleep(delay)
+            self.send_json(handler, {'error': {'message': 'Injected failure', 'type': 'server_error'}}, status=500)
+            return
+
+        text = self.completion_text(body.get('max_tokens'))
+        completion_id = f"chatcmpl-fake{random.getrandbits(48):x}"
+        base = {'id': completion_id, 'created': int(time.time()), 'model': body.get('model', 'gpt-4')}
+        if not body.get('stream'):
+            time.sleep(delay)
+            self.send_json(handler, dict(base, object='chat.completion', choices=[{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': text},
+                'finish_reason': 'stop',
+            }], usage={'prompt_tokens': 100, 'completion_tokens': len(text.split()), 'total_tokens': 100 + len(text.split())}))
+            return
+
+        # Streamed responses spread the delay over the tokens
+        words = text.split(' ')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        for i, word in enumerate(words):
+            time.sleep(delay / len(words))
+            chunk = dict(base, object='chat.completion.chunk', choices=[{
+                'index': 0,
+                'delta': {'content': word if i == 0 else f' {word}'},
+                'finish_reason': None,
+            }])
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            handler.wfile.flush()
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.close_connection = True
+
+
+class FakeReplicateServer(FakeServer):
+    """Model versions, predictions that finish after the sampled latency, and image files.
+
+    A failed prediction ends with status `failed`, as a model error would.
+    Predictions created with a `webhook` are POSTed to it once they finish,
+    signed with `webhook_secret`; a `webhook_loss_rate` share of them is
+    never delivered.
+    """
+
+    VERSION_ID = 'fake0000000000000000000000000000000000000000000000000000000000000'
+
+    def __init__(self, *args, webhook_secret=None, webhook_loss_rate=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.webhook_secret = webhook_secret
+        self.webhook_loss_rate = webhook_loss_rate
+        self.stats.update(webhooks=0, webhook_failures=0, poll_failures=0)
+        # The next `fail_polls` status requests are answered with HTTP 503
+        self.fail_polls = 0
+        self.predictions = {}
+        self._ids = itertools.count(1)
+        self._images = {}
+
+    def routes(self):
+        return [
+            ('GET', r'/v1/models/([^/]+)/([^/]+)/versions/([^/]+)', self.version),
+            ('POST', r'/v1/predictions', self.create_prediction),
+            ('GET', r'/v1/predictions/([^/]+)', self.get_prediction),
+            ('POST', r'/v1/predictions/([^/]+)/cancel', self.cancel_prediction),
+            ('GET', r'/files/(\d+)x(\d+)/[^/]+\.jpg', self.image),
+        ]
+
+    def version(self, handler, body, owner, name, version_id):
+        self.send_json(handler, {
+            'id': self.VERSION_ID,
+            'created_at': '2024-01-01T00:00:00Z',
+            'cog_version': '0.8.0',
+            'openapi_schema': {},
+        })
+
+    def prediction_json(self, prediction):
+        now = time.time()
+        data = {key: value for key, value in prediction.items() if not key.startswith('_')}
+        if prediction['status'] == 'canceled':
+            return data
+        if now >= prediction['_ready_at']:
+            if prediction['_failed']:
+                data.update(status='failed', error='Injected failure')
+            else:
+                data.update(status='succeeded', output=prediction['_output'])
+            data['completed_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(prediction['_ready_at']))
+        else:
+            data['status'] = 'processing'
+        return data
+
+    def create_prediction(self, handler, body):
+        prediction_id = f"fake{next(self._ids)}"
+        model_input = body.get('input') or {}
+        size = f"{model_input.get('width', 512)}x{model_input.get('height', 512)}"
+        prediction = {
+            'id': prediction_id,
+            'version': body.get('version'),
+            'input': model_input,
+            'output': None,
+            'logs': '',
+            'error': None,
+            'metrics': {},
+            'status': 'starting',
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'started_at': None,
+            'completed_at': None,
+            'urls': {
+                'get': f"{self.url}/v1/predictions/{prediction_id}",
+                'cancel': f"{self.url}/v1/predictions/{prediction_id}/cancel",
+            },
+            '_ready_at': time.time() + self.sample_latency(),
+            '_failed': self.should_fail(),
+            '_output': [f"{self.url}/files/{size}/{prediction_id}.jpg"],
+        }
+        self.predictions[prediction_id] = prediction
+        self.send_json(handler, self.prediction_json(prediction), status=201)
+
+        if body.get('webhook') and random.random() >= self.webhook_loss_rate:
+            timer = threading.Timer(prediction['_ready_at'] - time.time(), self.send_webhook,
+                                    [prediction_id, body['webhook']])
+            timer.daemon = True
+            timer.start()
+
+    def send_webhook(self, prediction_id, url):
+        """POST a finished prediction to its webhook, signed the way Replicate signs it."""
+        from .predictions import webhook_signature
+
+        body = json.dumps(self.prediction_json(self.predictions[prediction_id])).encode()
+        headers = {'Content-Type': 'application/json'}
+        if self.webhook_secret:
+            webhook_id, timestamp = f"msg_{prediction_id}", str(int(time.time()))
+            signature = webhook_signature(self.webhook_secret, webhook_id, timestamp, body)
+            headers.update({
+                'webhook-id': webhook_id,
+                'webhook-timestamp': timestamp,
+                'webhook-signature': f"v1,{signature}",
+            })
+        try:
+            urllib.request.urlopen(urllib.request.Request(url, data=body, headers=headers), timeout=30).close()
+            self.count('webhooks')
+        except OSError:
+            self.count('webhook_failures')
+
+    def get_prediction(self, handler, body, prediction_id):
+        with self._lock:
+            fail = self.fail_polls > 0
+            self.fail_polls -= fail
+        if fail:
+            self.count('poll_failures')
+            self.send_json(handler, {'detail': 'Injected failure'}, status=503)
+            return
+        prediction = self.predictions.get(prediction_id)
+        if prediction is None:
+            self.send_json(handler, {'detail': 'Not found'}, status=404)
+            return
+        self.send_json(handler, self.prediction_json(prediction))
+
+    def cancel_prediction(self, handler, body, prediction_id):
+        prediction = self.predictions.get(prediction_id)
+        if prediction is None:
+            self.send_json(handler, {'detail': 'Not found'}, status=404)
+            return
+        prediction['status'] = 'canceled'
+        self.send_json(handler, self.prediction_json(prediction))
+
+    def image(self, handler, body, width, height):
+        size = (min(int(width), 2048), min(int(height), 2048))
+        content = self._images.get(size)
+        if content is None:
+            buffer = BytesIO()
+            Image.new('RGB', size, (200, 200, 200)).save(buffer, 'JPEG', quality=80)
+            content = self._images[size] = buffer.getvalue()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'image/jpeg')
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
@@ -0,0 +1,149 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from . import events, jobs
+from .models import Job, Story, StoryResponse
+from .pdf import generate_pdf
+
+
+def image_progress(story, responses):
+    """Return (ready, total) image counts for a story and its loaded responses."""
+    total = 1 + 2 * len(responses)
+    ready = int(bool(story.plot_image_path))
+    ready += sum(bool(response.user_img_path) + bool(response.ai_img_path) for response in responses)
+    return ready, total
+
+
+def images_ready(story_id):
+    """True once the plot and every turn of the story have their images."""
+    if not Story.objects.filter(id=story_id, plot_image_path__isnull=False).exists():
+        return False
+    return not StoryResponse.objects.filter(story_id=story_id).filter(
+        Q(user_img_path__isnull=True) | Q(ai_img_path__isnull=True)
+    ).exists()
+
+
+def finalize_deadline(story):
+    """Time after which the PDF is rendered even if images are missing."""
+    return story.finalize_requested_at.timestamp() + settings.STORY_FINALIZE_TIMEOUT
+
+
+def start_finalization(story):
+    """Start building and emailing the comic PDF in the background.
+
+    Only the first call for a story starts anything. The PDF is rendered once
+    every image is attached or STORY_FINALIZE_TIMEOUT has passed, by a job
+    when IMAGE_JOBS_DURABLE is set and by a thread in this process otherwise.
+    Returns True if finalization was started.
+    """
+    started = Story.objects.filter(id=story.id, finalize_status=Story.FINALIZE_NOT_STARTED).update(
+        finalize_status=Story.FINALIZE_WAITING, finalize_requested_at=timezone.now()
+    )
+    if not started:
+        return False
+    events.publish(story.id)
+
+    if settings.IMAGE_JOBS_DURABLE:
+        jobs.enqueue(Job.KIND_FINALIZE_STORY, story=story)
+    else:
+        threading.Thread(
+            target=run_finalization, args=(story.id,), name=f"finalize-story-{story.id}", daemon=True
+        ).start()
+    return True
+
+
+def run_finalization(story_id):
+    """Wait for the story's images, then render and send the PDF."""
+    try:
+        story = Story.objects.only('finalize_requested_at').get(id=story_id)
+        deadline = finalize_deadline(story)
+        version = events.current_version(story_id)
+        while not images_ready(story_id) and time.time() < deadline:
+            timeout = min(deadline - time.time(), settings.IMAGE_EVENTS_DB_RECHECK)
+            version = events.wait_for_change(story_id, version, timeout)
+        render_and_send(story_id)
+    except Exception as e:
+        print(f"Error finalizing story {story_id}: {type(e).__name__}: {e}")
+    finally:
+        close_old_connections()
+
+
+def render_and_send(story_id):
+    """Render the PDF and email it, unless another runner already has.
+
+    Returns True if this call did the work. Errors mark the story failed and
+    are re-raised, so a durable job retries.
+    """
+    from .views import send_email
+
+    claimed = Story.objects.filter(
+        id=story_id, finalize_status__in=[Story.FINALIZE_WAITING, Story.FINALIZE_FAILED]
+    ).update(finalize_status=Story.FINALIZE_RENDERING)
+    if not claimed:
+        return False
+    events.publish(story_id)
+
+    start_time = time.time()
+    try:
+        story = Story.objects.select_related('theme', 'user').get(id=story_id)
+        if not images_ready(story_id):
+            print(f"Finalizing story {story_id} with missing images")
+        generate_pdf(story)
+        if not story.email_sent:
+            send_email(story)
+    except Exception:
+        Story.objects.filter(id=story_id).update(finalize_status=Story.FINALIZE_FAILED)
+        events.publish(story_id)
+        raise
+
+    Story.objects.filter(id=story_id).update(finalize_status=Story.FINALIZE_DONE)
+    events.publish(story_id)
+    print(f"Story {story_id} finalized in {time.time() - start_time:.2f} seconds")
+    return True
+
+
+def resume_stalled_finalizations(stale_after=None):
+    """Finalize again the stories whose runner died, e.g. in a restart.
+
+    A story still waiting or rendering `stale_after` seconds
+    (STORY_FINALIZE_STALE_AFTER by default) past its deadline is set back
+    to waiting, with the deadline moved to now, and rendered again: by a job
+    when IMAGE_JOBS_DURABLE is set and right here otherwise. Returns the ids
+    of the stories resumed.
+    """
+    if stale_after is None:
+        stale_after = settings.STORY_FINALIZE_STALE_AFTER
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.STORY_FINALIZE_TIMEOUT + stale_after)
+    stalled = Story.objects.filter(
+        finalize_status__in=[Story.FINALIZE_WAITING, Story.FINALIZE_RENDERING], finalize_requested_at__lt=cutoff
+    ).only('finalize_status', 'finalize_requested_at')
+
+    resumed = []
+    for story in stalled:
+        # Conditional, so two sweeps never resume the same story twice
+        claimed = Story.objects.filter(
+            id=story.id, finalize_status=story.finalize_status, finalize_requested_at=story.finalize_requested_at
+        ).update(
+            finalize_status=Story.FINALIZE_WAITING,
+            finalize_requested_at=now - timedelta(seconds=settings.STORY_FINALIZE_TIMEOUT),
+        )
+        if not claimed:
+            continue
+        print(f"Resuming finalization of story {story.id}, {story.finalize_status} since {story.finalize_requested_at}")
+        resumed.append(story.id)
+
+        if settings.IMAGE_JOBS_DURABLE:
+            jobs.enqueue(Job.KIND_FINALIZE_STORY, story=story)
+            continue
+        try:
+            render_and_send(story.id)
+        except Exception as e:
+            print(f"Error finalizing story {story.id}: {type(e).__name__}: {e}")
+    return resumed
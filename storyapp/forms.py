@@ -20,6 +20,14 @@ class StoryForm(forms.ModelForm):
             'character_name': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Character name'}),
         }
 
+    def __init__(self, *args, themes=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if themes is not None:
+            # Render the theme choices from an already loaded (cached) list
+            self.fields['theme'].choices = [('', self.fields['theme'].empty_label)] + [
+                (theme.id, str(theme)) for theme in themes
+            ]
+
 
 class StoryResponseForm(forms.ModelForm):
     class Meta:
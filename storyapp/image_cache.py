@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import CachedImage
+from .storage import copy_file, generated_storage, sharded_name
+
+# In-process hit/miss counters
+_stats = {'hits': 0, 'similar_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+# Parameters that change the generated image, besides the prompt
+KEY_PARAMS = ('width', 'height', 'guidance_scale', 'negative_prompt', 'num_outputs')
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def cache_stats():
+    """Return a snapshot of the hit/miss counters of this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def normalize_prompt(prompt):
+    """Normalize case, whitespace and trailing punctuation of a prompt."""
+    return re.sub(r'\s+', ' ', prompt.lower()).strip().rstrip('.!?,;: ')
+
+
+def _hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def cache_keys(model_input, version_id):
+    """Return (key, params_key) for a Replicate input and model version."""
+    params = {name: model_input.get(name) for name in KEY_PARAMS}
+    params['version'] = version_id
+    params_key = _hash(params)
+    key = _hash({'params': params_key, 'prompt': normalize_prompt(model_input['prompt'])})
+    return key, params_key
+
+
+def _words(prompt):
+    return set(re.findall(r'\w+', prompt))
+
+
+def _similarity(a, b):
+    a, b = _words(a), _words(b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _most_similar(prompt, params_key):
+    """The most recently used entry with these parameters whose prompt is closest, and its score."""
+    prompt = normalize_prompt(prompt)
+    candidates = CachedImage.objects.filter(params_key=params_key).order_by('-last_used_at')
+    best, best_score = None, -1.0
+    for candidate in candidates[:settings.IMAGE_CACHE_SIMILARITY_CANDIDATES]:
+        score = _similarity(prompt, candidate.prompt)
+        if score > best_score:
+            best, best_score = candidate, score
+    return best, best_score
+
+
+def lookup(model_input, version_id):
+    """Find a cached image for these inputs.
+
+    Exact matches on the normalized prompt are tried first. If
+    IMAGE_CACHE_SIMILARITY is set, the most recently used entries with the
+    same parameters are then compared by word overlap (Jaccard) and the best
+    one at or above the threshold is returned.
+    """
+    if not settings.IMAGE_CACHE_ENABLED:
+        return None
+
+    key, params_key = cache_keys(model_input, version_id)
+    entry = CachedImage.objects.filter(key=key).first()
+    counter = 'hits'
+
+    threshold = settings.IMAGE_CACHE_SIMILARITY
+    if entry is None and threshold:
+        best, best_score = _most_similar(model_input['prompt'], params_key)
+        if best is not None and best_score >= threshold:
+            entry, counter = best, 'similar_hits'
+
+    if entry is None or not generated_storage().exists(entry.path):
+        _count('misses')
+        return None
+
+    CachedImage.objects.filter(id=entry.id).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    _count(counter)
+    return entry
+
+
+def closest(model_input, version_id):
+    """The cached image with the same parameters and the most similar prompt.
+
+    Stands in for a new image while generation is unavailable, but only if
+    its prompt scores at least IMAGE_FALLBACK_SIMILARITY, so a panel of an
+    unrelated scene is never put into a story.
+    """
+    threshold = settings.IMAGE_FALLBACK_SIMILARITY
+    if not settings.IMAGE_CACHE_ENABLED or not threshold:
+        return None
+    entry, score = _most_similar(model_input['prompt'], cache_keys(model_input, version_id)[1])
+    if entry is None or score < threshold or not generated_storage().exists(entry.path):
+        return None
+    CachedImage.objects.filter(id=entry.id).update(last_used_at=timezone.now())
+    return entry
+
+
+def materialize(entry, relative_path):
+    """Copy a cached image to `relative_path` and return the stored name."""
+    return copy_file(entry.path, relative_path)
+
+
+def store(model_input, version_id, relative_path):
+    """Add a freshly generated image (a name in the generated storage) to the cache."""
+    if not settings.IMAGE_CACHE_ENABLED:
+        return None
+
+    key, params_key = cache_keys(model_input, version_id)
+    cache_path = sharded_name('cache', f"{key}{os.path.splitext(relative_path)[1]}")
+    storage = generated_storage()
+    if not storage.exists(cache_path):
+        cache_path = copy_file(relative_path, cache_path)
+
+    try:
+        entry = CachedImage.objects.create(
+            key=key,
+            params_key=params_key,
+            prompt=normalize_prompt(model_input['prompt']),
+            path=cache_path,
+            size=storage.size(cache_path),
+            last_used_at=timezone.now(),
+        )
+    except IntegrityError:
+        # Another worker stored the same image first
+        return None
+
+    _count('stores')
+    evict()
+    return entry
+
+
+def evict(max_bytes=None):
+    """Delete least recently used entries until the cache fits its size limit."""
+    max_bytes = max_bytes if max_bytes is not None else settings.IMAGE_CACHE_MAX_BYTES
+    total = CachedImage.objects.aggregate(total=Sum('size'))['total'] or 0
+    if total <= max_bytes:
+        return 0
+
+    evicted = 0
+    for entry in CachedImage.objects.order_by('last_used_at').iterator():
+        if total <= max_bytes:
+            break
+        generated_storage().delete(entry.path)
+        entry.delete()
+        total -= entry.size
+        evicted += 1
+
+    _count('evictions', evicted)
+    return evicted
@@ -0,0 +1,422 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import replicate
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from replicate.exceptions import ModelError
+
+from . import image_cache, limits, metrics, resilience
+from .clients import get_async_http_client, get_http_session
+from .storage import PartialFile, sharded_name, save_file
+
+# Per-kind presets for every image the app generates. `{text}` is cut to
+# `max_chars` before it is formatted into the prompt template.
+IMAGE_PRESETS = {
+    'plot': {
+        'label': 'Plot',
+        'prompt': "Create a comic-style black and white storyboard with 3 panels showing: {text}",
+        'max_chars': 300,
+        'width': 768,
+        'height': 384,  # Wider format for 3 panels
+        'directory': 'plots',
+    },
+    'user': {
+        'label': 'User',
+        'prompt': "Comic-style black and white panel showing {character_name}: {text}",
+        'max_chars': 200,
+        'width': 512,
+        'height': 512,
+        'directory': 'responses',
+    },
+    'ai': {
+        'label': 'AI',
+        'prompt': "Black-and-white comic 2-panel scene showing: {text}",
+        'max_chars': 300,
+        'width': 768,
+        'height': 384,  # Wider format for 2 panels
+        'directory': 'responses',
+    },
+}
+
+DEFAULT_INPUT = {
+    'num_outputs': 1,
+    'guidance_scale': 7.5,
+    'negative_prompt': "color, detailed, complex, photorealistic",
+}
+
+REPLICATE_DEFAULT_BASE_URL = 'https://api.replicate.com'
+
+# Resolved model versions, keyed by "owner/name:version"
+_versions = {}
+_versions_lock = threading.Lock()
+
+# Threads downloading the outputs of predictions with num_outputs > 1
+_download_pool = None
+
+
+def replicate_client():
+    """Return the shared Replicate client, configured from the settings."""
+    client = replicate.default_client
+    client.api_token = settings.REPLICATE_API_TOKEN or None
+    client.poll_interval = settings.REPLICATE_POLL_INTERVAL
+    client.base_url = (settings.REPLICATE_API_BASE_URL or REPLICATE_DEFAULT_BASE_URL).rstrip('/')
+    return client
+
+
+def resolve_model_version(model=None, version=None):
+    """Return the Replicate Version object for a model, cached with a TTL.
+
+    Resolving a tag such as `latest` costs an API round trip, which
+    `replicate.run` pays on every call. The resolved version is reused until
+    REPLICATE_VERSION_CACHE_TTL expires.
+    """
+    model = model or settings.REPLICATE_IMAGE_MODEL
+    version = version or settings.REPLICATE_IMAGE_MODEL_VERSION
+    key = f"{model}:{version}"
+
+    now = time.monotonic()
+    cached = _versions.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    with _versions_lock:
+        cached = _versions.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        try:
+            resolved = replicate_client().models.get(model).versions.get(version)
+        except Exception as e:
+            if cached is None:
+                raise
+            # Keep using the version we know while Replicate cannot be reached
+            print(f"Error resolving {key}, reusing {cached[0].id}: {type(e).__name__}: {e}")
+            return cached[0]
+        _versions[key] = (resolved, time.monotonic() + settings.REPLICATE_VERSION_CACHE_TTL)
+        print(f"Resolved {key} to version {resolved.id}")
+        return resolved
+
+
+def build_prompt(kind, text, **fields):
+    """Format the prompt template of an image preset."""
+    preset = IMAGE_PRESETS[kind]
+    return preset['prompt'].format(text=text[:preset['max_chars']], **fields)
+
+
+def build_input(kind, prompt):
+    """Return the Replicate input for an image preset."""
+    preset = IMAGE_PRESETS[kind]
+    return dict(DEFAULT_INPUT, prompt=prompt, width=preset['width'], height=preset['height'])
+
+
+def generate_image(kind, text, queued_at=None, **fields):
+    """Generate an image of the given kind and save it to the generated storage.
+
+    `queued_at` is the epoch time at which the image was requested; it is
+    used to report how long the image waited before generation started.
+    Returns the stored file name, or None on failure.
+    """
+    if not settings.REPLICATE_API_TOKEN:
+        print(f"Cannot generate {kind} image: REPLICATE_API_TOKEN is not set")
+        return None
+
+    preset = IMAGE_PRESETS[kind]
+    prompt = build_prompt(kind, text, **fields)
+    print(f"{preset['label']} image prompt: {prompt}")
+
+    timings = {'queue': time.time() - queued_at if queued_at else 0.0}
+    try:
+        start_time = time.monotonic()
+        version = resolve_model_version()
+        timings['resolve'] = time.monotonic() - start_time
+
+        model_input = build_input(kind, prompt)
+        relative_path = sharded_name(preset['directory'], f"{kind}_{uuid.uuid4().hex}.jpg")
+
+        # Identical (or, if configured, similar) requests reuse a cached image
+        start_time = time.monotonic()
+        cached = image_cache.lookup(model_input, version.id)
+        if cached is not None:
+            relative_path = image_cache.materialize(cached, relative_path)
+            timings['cache'] = time.monotonic() - start_time
+            report_timings(kind, relative_path, timings)
+            return relative_path
+
+        start_time = time.monotonic()
+        with metrics.timer('storyapp_replicate_prediction_seconds', kind=kind):
+            output = run_prediction(version.id, model_input)
+        timings['inference'] = time.monotonic() - start_time
+
+        if not output:
+            print(f"No output received for {kind} image")
+            return None
+        print(f"Image generated, URL: {', '.join(output)}")
+
+        start_time = time.monotonic()
+        with metrics.timer('storyapp_image_download_seconds', kind=kind):
+            relative_path = download_images(output, relative_path)[0]
+        timings['download'] = time.monotonic() - start_time
+    except resilience.CircuitOpen as e:
+        return fallback_image(kind, model_input, version.id, relative_path, e)
+    except Exception as e:
+        print(f"Error generating {kind} image: {type(e).__name__}: {e}")
+        return None
+
+    try:
+        image_cache.store(model_input, version.id, relative_path)
+    except Exception as e:
+        print(f"Error caching {kind} image: {type(e).__name__}: {e}")
+
+    report_timings(kind, relative_path, timings)
+    return relative_path
+
+
+async def agenerate_image(kind, text, queued_at=None, **fields):
+    """Async version of generate_image for async views.
+
+    Predictions are created and polled through the Replicate HTTP API on the
+    shared async HTTP pool, and the image is downloaded on the same pool, so
+    no thread is held while the model runs. Database and disk work runs in
+    the thread pool.
+    """
+    if not settings.REPLICATE_API_TOKEN:
+        print(f"Cannot generate {kind} image: REPLICATE_API_TOKEN is not set")
+        return None
+
+    preset = IMAGE_PRESETS[kind]
+    prompt = build_prompt(kind, text, **fields)
+    print(f"{preset['label']} image prompt: {prompt}")
+
+    timings = {'queue': time.time() - queued_at if queued_at else 0.0}
+    http = get_async_http_client()
+    try:
+        start_time = time.monotonic()
+        version = await sync_to_async(resolve_model_version, thread_sensitive=False)()
+        timings['resolve'] = time.monotonic() - start_time
+
+        model_input = build_input(kind, prompt)
+        relative_path = sharded_name(preset['directory'], f"{kind}_{uuid.uuid4().hex}.jpg")
+
+        # Identical (or, if configured, similar) requests reuse a cached image
+        start_time = time.monotonic()
+        cached = await sync_to_async(image_cache.lookup)(model_input, version.id)
+        if cached is not None:
+            relative_path = await sync_to_async(image_cache.materialize, thread_sensitive=False)(cached, relative_path)
+            timings['cache'] = time.monotonic() - start_time
+            report_timings(kind, relative_path, timings)
+            return relative_path
+
+        start_time = time.monotonic()
+        with metrics.timer('storyapp_replicate_prediction_seconds', kind=kind):
+            output = await arun_prediction(http, version.id, model_input)
+        timings['inference'] = time.monotonic() - start_time
+
+        if not output:
+            print(f"No output received for {kind} image")
+            return None
+        print(f"Image generated, URL: {', '.join(output)}")
+
+        start_time = time.monotonic()
+        with metrics.timer('storyapp_image_download_seconds', kind=kind):
+            relative_path = (await adownload_images(http, output, relative_path))[0]
+        timings['download'] = time.monotonic() - start_time
+    except resilience.CircuitOpen as e:
+        return await sync_to_async(fallback_image)(kind, model_input, version.id, relative_path, e)
+    except Exception as e:
+        print(f"Error generating {kind} image: {type(e).__name__}: {e}")
+        return None
+
+    try:
+        await sync_to_async(image_cache.store)(model_input, version.id, relative_path)
+    except Exception as e:
+        print(f"Error caching {kind} image: {type(e).__name__}: {e}")
+
+    report_timings(kind, relative_path, timings)
+    return relative_path
+
+
+PREDICTION_DONE = ('succeeded', 'failed', 'canceled')
+
+
+def _prediction_timeout(prediction):
+    return resilience.PredictionTimeout(
+        f"Prediction {prediction['id']} still {prediction['status']} after {settings.REPLICATE_PREDICTION_TIMEOUT}s"
+    )
+
+
+def _replicate_json(session, method, url, **kwargs):
+    response = session.request(method, url, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+async def _areplicate_json(http, method, url, **kwargs):
+    response = await http.request(method, url, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+def run_prediction(version_id, model_input):
+    """Create a Replicate prediction and poll it until it has finished.
+
+    Every request is bounded by REPLICATE_REQUEST_TIMEOUT; a prediction that
+    is not done within REPLICATE_PREDICTION_TIMEOUT is canceled. Only single
+    requests are retried: a failed poll is polled again rather than starting
+    a second prediction, and a create that may have run is not repeated.
+    A prediction abandoned on an error is canceled.
+    """
+    client = replicate_client()
+    session = get_http_session()
+    headers = {'Authorization': f"Token {settings.REPLICATE_API_TOKEN}"}
+    timeout = settings.REPLICATE_REQUEST_TIMEOUT
+    deadline = time.monotonic() + settings.REPLICATE_PREDICTION_TIMEOUT
+    with limits.limit('replicate'):
+        prediction = resilience.call_once(
+            'replicate', _replicate_json, session, 'POST', f"{client.base_url}/v1/predictions",
+            json={'version': version_id, 'input': model_input}, headers=headers, timeout=timeout,
+        )
+        try:
+            while prediction['status'] not in PREDICTION_DONE:
+                if time.monotonic() >= deadline:
+                    resilience.record_failure('replicate')
+                    raise _prediction_timeout(prediction)
+                time.sleep(client.poll_interval)
+                prediction = resilience.call(
+                    'replicate', _replicate_json, session, 'GET', prediction['urls']['get'],
+                    headers=headers, timeout=timeout,
+                )
+        except Exception:
+            try:
+                session.post(prediction['urls']['cancel'], headers=headers, timeout=timeout)
+            except requests.RequestException as e:
+                print(f"Error canceling prediction {prediction['id']}: {e}")
+            raise
+
+    if prediction['status'] != 'succeeded':
+        raise ModelError(prediction.get('error') or prediction['status'])
+    return prediction['output']
+
+
+async def arun_prediction(http, version_id, model_input):
+    """Async version of run_prediction, polling without blocking a thread."""
+    client = replicate_client()
+    headers = {'Authorization': f"Token {settings.REPLICATE_API_TOKEN}"}
+    timeout = settings.REPLICATE_REQUEST_TIMEOUT
+    deadline = time.monotonic() + settings.REPLICATE_PREDICTION_TIMEOUT
+    async with limits.alimit('replicate'):
+        prediction = await resilience.acall_once(
+            'replicate', _areplicate_json, http, 'POST', f"{client.base_url}/v1/predictions",
+            json={'version': version_id, 'input': model_input}, headers=headers, timeout=timeout,
+        )
+        try:
+            while prediction['status'] not in PREDICTION_DONE:
+                if time.monotonic() >= deadline:
+                    resilience.record_failure('replicate')
+                    raise _prediction_timeout(prediction)
+                await asyncio.sleep(client.poll_interval)
+                prediction = await resilience.acall(
+                    'replicate', _areplicate_json, http, 'GET', prediction['urls']['get'],
+                    headers=headers, timeout=timeout,
+                )
+        except Exception:
+            try:
+                await http.post(prediction['urls']['cancel'], headers=headers, timeout=timeout)
+            except httpx.HTTPError as e:
+                print(f"Error canceling prediction {prediction['id']}: {e}")
+            raise
+
+    if prediction['status'] != 'succeeded':
+        raise ModelError(prediction.get('error') or prediction['status'])
+    return prediction['output']
+
+
+def fallback_image(kind, model_input, version_id, relative_path, error):
+    """Use a similar cached image while Replicate is unavailable; None (no image) if there is none."""
+    print(f"Cannot generate {kind} image: {error}")
+    entry = image_cache.closest(model_input, version_id)
+    if entry is None:
+        return None
+    relative_path = image_cache.materialize(entry, relative_path)
+    print(f"Using cached image {entry.path} for {kind} image {relative_path}")
+    return relative_path
+
+
+def output_names(relative_path, count):
+    """Names for `count` outputs of one prediction: the given name, then numbered siblings."""
+    base, extension = os.path.splitext(relative_path)
+    return [relative_path] + [f"{base}_{i}{extension}" for i in range(2, count + 1)]
+
+
+def download_timeout():
+    return (settings.IMAGE_DOWNLOAD_CONNECT_TIMEOUT, settings.IMAGE_DOWNLOAD_READ_TIMEOUT)
+
+
+def download_image(url, relative_path):
+    """Stream an image to the generated storage and return the name it was stored under.
+
+    The body is written in IMAGE_DOWNLOAD_CHUNK_SIZE pieces over the shared
+    keep-alive session, so memory use does not grow with the image size and
+    a failed download leaves no partial file behind.
+    """
+    with get_http_session().get(url, stream=True, timeout=download_timeout()) as response:
+        response.raise_for_status()
+        with PartialFile(relative_path) as f:
+            for chunk in response.iter_content(settings.IMAGE_DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+            return f.commit()
+
+
+def _download_executor():
+    global _download_pool
+    if _download_pool is None:
+        with _versions_lock:
+            if _download_pool is None:
+                _download_pool = ThreadPoolExecutor(
+                    max_workers=settings.IMAGE_DOWNLOAD_WORKERS, thread_name_prefix='image-download'
+                )
+    return _download_pool
+
+
+def download_images(urls, relative_path):
+    """Download every output of a prediction, in parallel if there are several; return their names."""
+    names = output_names(relative_path, len(urls))
+    if len(urls) == 1:
+        return [download_image(urls[0], names[0])]
+    return list(_download_executor().map(download_image, urls, names))
+
+
+async def adownload_image(http, url, relative_path):
+    """Async version of download_image on the shared async HTTP pool."""
+    timeout = httpx.Timeout(settings.IMAGE_DOWNLOAD_READ_TIMEOUT, connect=settings.IMAGE_DOWNLOAD_CONNECT_TIMEOUT)
+    async with http.stream('GET', url, timeout=timeout) as response:
+        response.raise_for_status()
+        f = await sync_to_async(PartialFile, thread_sensitive=False)(relative_path)
+        try:
+            async for chunk in response.aiter_bytes(settings.IMAGE_DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+            return await sync_to_async(f.commit, thread_sensitive=False)()
+        finally:
+            f.discard()
+
+
+async def adownload_images(http, urls, relative_path):
+    """Async version of download_images."""
+    names = output_names(relative_path, len(urls))
+    return await asyncio.gather(*(adownload_image(http, url, name) for url, name in zip(urls, names)))
+
+
+def save_image(relative_path, content):
+    """Store image bytes and return the name they were stored under."""
+    return save_file(relative_path, content)
+
+
+def report_timings(kind, relative_path, timings):
+    stages = ', '.join(f"{stage}={seconds:.2f}s" for stage, seconds in timings.items())
+    total = sum(seconds for stage, seconds in timings.items() if stage != 'queue')
+    print(f"{IMAGE_PRESETS[kind]['label']} image saved to {relative_path} in {total:.2f} seconds ({stages})")
@@ -0,0 +1,155 @@
+import re
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Count
+
+from . import jobs, metrics
+from .clients import create_chat_completion, get_openai_client
+from .derivatives import image_fields
+from .models import Job, StoryIntro, Theme
+
+# Intros are written for this made-up name, which is replaced by the real
+# character name when a story claims the intro
+PLACEHOLDER_NAME = 'Quillon'
+
+
+def available_intros():
+    """Number of intros waiting in the pool of every theme."""
+    return dict(Theme.objects.annotate(count=Count('intros')).values_list('name', 'count'))
+
+
+def pool_stats():
+    """Hit, miss, refill and generated counts of all processes, and the intros available per theme.
+
+    The counts are kept in storyapp.metrics, so they are shared through
+    METRICS_DIR and exported on /metrics like every other counter.
+    """
+    claims = metrics.totals('storyapp_intro_pool_claims_total', 'result')
+    stats = {
+        'hits': claims.get('hit', 0),
+        'misses': claims.get('miss', 0),
+        'refills': sum(metrics.totals('storyapp_intro_pool_refills_total', 'theme').values()),
+        'generated': sum(metrics.totals('storyapp_intro_pool_generated_total', 'theme').values()),
+    }
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else None
+    stats['available'] = available_intros()
+    return stats
+
+
+def personalize(plot_template, character_name):
+    """Put the character name into an intro written for PLACEHOLDER_NAME."""
+    return re.sub(rf"\b{re.escape(PLACEHOLDER_NAME)}\b", lambda match: character_name, plot_template)
+
+
+def claim_intro(theme, character_name):
+    """Take a pre-generated intro for a theme out of the pool.
+
+    Returns the Story field values (plot text and plot image) for the
+    character, or None if the pool is empty. Each intro is claimed by deleting
+    its row, so concurrent requests can never get the same one. A refill is
+    started when the pool runs low.
+    """
+    if not settings.INTRO_POOL_ENABLED:
+        return None
+
+    claimed = None
+    for intro in StoryIntro.objects.filter(theme=theme).order_by('created_at')[:3]:
+        deleted, _ = StoryIntro.objects.filter(id=intro.id).delete()
+        if deleted:
+            claimed = intro
+            break
+
+    metrics.inc('storyapp_intro_pool_claims_total', theme=theme.name, result='hit' if claimed else 'miss')
+    start_refill(theme)
+    if claimed is None:
+        return None
+    return {
+        'plot_text': personalize(claimed.plot_template, character_name),
+        'plot_image_path': claimed.plot_image_path,
+        'plot_image_variants': claimed.plot_image_variants,
+    }
+
+
+def _refill_lock_key(theme_id):
+    return f"intro-pool-refill:{theme_id}"
+
+
+def start_refill(theme):
+    """Refill a theme's pool in the background if it is below the low-water mark."""
+    if StoryIntro.objects.filter(theme=theme).count() >= settings.INTRO_POOL_LOW_WATER:
+        return False
+    if not cache.add(_refill_lock_key(theme.id), True, timeout=600):
+        return False  # A refill is already running
+
+    metrics.inc('storyapp_intro_pool_refills_total', theme=theme.name)
+    if settings.IMAGE_JOBS_DURABLE:
+        jobs.enqueue(Job.KIND_FILL_INTRO_POOL, payload={'theme_id': theme.id})
+    else:
+        threading.Thread(
+            target=run_refill, args=(theme.id,), name=f"intro-pool-{theme.id}", daemon=True
+        ).start()
+    return True
+
+
+def run_refill(theme_id):
+    try:
+        fill_pool(Theme.objects.get(id=theme_id))
+    except Exception as e:
+        print(f"Error refilling intro pool for theme {theme_id}: {type(e).__name__}: {e}")
+    finally:
+        cache.delete(_refill_lock_key(theme_id))
+        close_old_connections()
+
+
+def fill_pool(theme, size=None):
+    """Generate intros for a theme until its pool holds `size` of them.
+
+    Stops at the first failure, so an unavailable upstream costs one attempt.
+    Returns the number of intros added.
+    """
+    from .views import generate_plot_image, plot_messages
+
+    size = settings.INTRO_POOL_SIZE if size is None else size
+    client = get_openai_client()
+    if client is None:
+        print(f"Cannot fill intro pool for {theme}: OpenAI is not available")
+        return 0
+
+    added = 0
+    # Count again on every round, as other processes may be filling too
+    while StoryIntro.objects.filter(theme=theme).count() < size:
+        try:
+            response = create_chat_completion(
+                client, 'intro', plot_messages(theme.description, PLACEHOLDER_NAME), max_tokens=500
+            )
+            plot_template = response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"Error generating intro for {theme}: {e}")
+            break
+
+        plot_image_path = generate_plot_image(plot_template)
+        if not plot_image_path:
+            print(f"Failed to generate intro image for {theme}")
+            break
+
+        StoryIntro.objects.create(
+            theme=theme,
+            plot_template=plot_template,
+            **image_fields('plot_image_path', plot_image_path)
+        )
+        added += 1
+        metrics.inc('storyapp_intro_pool_generated_total', theme=theme.name)
+    print(f"Added {added} intros to the {theme} pool")
+    return added
+
+
+def pool_sizes():
+    """Gauge values of the pool of every theme."""
+    return {(('theme', name),): count for name, count in available_intros().items()}
+
+
+metrics.register_gauge('storyapp_intro_pool_available', pool_sizes)
@@ -0,0 +1,203 @@
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import events
+from .derivatives import image_fields
+from .models import Job, Story, StoryResponse
+from .pdf import prerender_turn
+
+
+class JobError(Exception):
+    """Raised by a job handler when the job should be retried."""
+
+
+class JobDeferred(Exception):
+    """Raised by a job handler to run the job again later without counting an attempt."""
+
+    def __init__(self, delay):
+        super().__init__(f"deferred for {delay} seconds")
+        self.delay = delay
+
+
+def enqueue(kind, story=None, response=None, payload=None, delay=0):
+    """Add a job to the durable queue."""
+    job = Job.objects.create(
+        kind=kind,
+        story=story,
+        response=response,
+        payload=payload or {},
+        max_attempts=settings.JOB_MAX_ATTEMPTS,
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+    print(f"Enqueued {job}")
+    return job
+
+
+def default_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_jobs(worker, limit, lease_seconds, kinds=None):
+    """Atomically claim up to `limit` runnable jobs for `worker`.
+
+    A job is runnable when it is pending and due, or when it is running but
+    its lease has expired (the worker that held it died or stalled). Each
+    candidate is claimed with a conditional UPDATE on its current status and
+    attempt count, so two workers can never claim the same job. An expired
+    job that has already used its last attempt is marked failed instead.
+    """
+    now = timezone.now()
+    candidates = Job.objects.filter(
+        Q(status=Job.STATUS_PENDING, run_after__lte=now)
+        | Q(status=Job.STATUS_RUNNING, lease_expires_at__lt=now)
+    )
+    if kinds:
+        candidates = candidates.filter(kind__in=kinds)
+
+    claimed = []
+    for job in candidates.order_by('run_after', 'id')[:limit * 2]:
+        current = Job.objects.filter(id=job.id, status=job.status, attempts=job.attempts)
+        if job.status == Job.STATUS_RUNNING and job.attempts >= job.max_attempts:
+            current.update(
+                status=Job.STATUS_FAILED,
+                last_error=f"lease expired on attempt {job.attempts}",
+                lease_expires_at=None,
+                modified_at=now,
+            )
+            continue
+        updated = current.update(
+            status=Job.STATUS_RUNNING,
+            attempts=F('attempts') + 1,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            worker=worker,
+            modified_at=now,
+        )
+        if updated:
+            job.refresh_from_db()
+            claimed.append(job)
+            if len(claimed) >= limit:
+                break
+    return claimed
+
+
+def _owned(job):
+    """Queryset matching `job` only while this claim still holds it."""
+    return Job.objects.filter(id=job.id, status=Job.STATUS_RUNNING, worker=job.worker, attempts=job.attempts)
+
+
+def extend_lease(job, lease_seconds):
+    """Push the lease of a running job forward. Returns False if it was lost."""
+    return bool(_owned(job).update(lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds)))
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome.
+
+    Failed jobs are retried with exponential backoff until `max_attempts`
+    is reached, then marked failed. Deferred jobs go back to the queue
+    without using up an attempt. Returns True when the job is done, None
+    when it was deferred and False when it failed.
+    """
+    handler = HANDLERS[job.kind]
+    try:
+        handler(job)
+    except JobDeferred as e:
+        _owned(job).update(
+            status=Job.STATUS_PENDING,
+            attempts=F('attempts') - 1,
+            lease_expires_at=None,
+            run_after=timezone.now() + timedelta(seconds=e.delay),
+        )
+        return None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"{job} attempt {job.attempts} failed: {error}")
+        if job.attempts >= job.max_attempts:
+            _owned(job).update(status=Job.STATUS_FAILED, last_error=error, lease_expires_at=None)
+        else:
+            delay = settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            _owned(job).update(
+                status=Job.STATUS_PENDING,
+                last_error=error,
+                lease_expires_at=None,
+                run_after=timezone.now() + timedelta(seconds=delay),
+            )
+        return False
+
+    _owned(job).update(status=Job.STATUS_DONE, last_error='', lease_expires_at=None)
+    return True
+
+
+def handle_plot_image(job):
+    from .views import generate_plot_image
+
+    story = Story.objects.get(id=job.story_id)
+    if story.plot_image_path:
+        return
+    plot_image_path = generate_plot_image(story.plot_text, queued_at=job.run_after.timestamp())
+    if not plot_image_path:
+        raise JobError("plot image generation returned no image")
+    Story.objects.filter(id=story.id).update(**image_fields('plot_image_path', plot_image_path))
+    events.publish(story.id)
+
+
+def handle_user_image(job):
+    from .views import generate_user_image
+
+    response = StoryResponse.objects.select_related('story').get(id=job.response_id)
+    if response.user_img_path:
+        return
+    user_img_path = generate_user_image(
+        response.user_input, response.story.character_name, queued_at=job.run_after.timestamp()
+    )
+    if not user_img_path:
+        raise JobError("user image generation returned no image")
+    StoryResponse.objects.filter(id=response.id).update(**image_fields('user_img_path', user_img_path))
+    events.publish(response.story_id)
+    prerender_turn(response.story_id, response.id)
+
+
+def handle_ai_image(job):
+    from .views import generate_ai_image
+
+    response = StoryResponse.objects.get(id=job.response_id)
+    if response.ai_img_path:
+        return
+    ai_img_path = generate_ai_image(response.ai_response, queued_at=job.run_after.timestamp())
+    if not ai_img_path:
+        raise JobError("AI image generation returned no image")
+    StoryResponse.objects.filter(id=response.id).update(**image_fields('ai_img_path', ai_img_path))
+    events.publish(response.story_id)
+    prerender_turn(response.story_id, response.id)
+
+
+def handle_finalize_story(job):
+    from .finalize import finalize_deadline, images_ready, render_and_send
+
+    story = Story.objects.get(id=job.story_id)
+    if story.finalize_status == Story.FINALIZE_DONE:
+        return
+    if not images_ready(story.id) and time.time() < finalize_deadline(story):
+        raise JobDeferred(settings.IMAGE_EVENTS_DB_RECHECK)
+    render_and_send(story.id)
+
+
+def handle_fill_intro_pool(job):
+    from .intro_pool import run_refill
+
+    run_refill(job.payload['theme_id'])
+
+
+HANDLERS = {
+    Job.KIND_PLOT_IMAGE: handle_plot_image,
+    Job.KIND_USER_IMAGE: handle_user_image,
+    Job.KIND_AI_IMAGE: handle_ai_image,
+    Job.KIND_FINALIZE_STORY: handle_finalize_story,
+    Job.KIND_FILL_INTRO_POOL: handle_fill_intro_pool,
+}
@@ -0,0 +1,237 @@
+"""Shared limits on calls to OpenAI and Replicate.
+
+Every call takes a concurrency slot and its share of the requests-per-minute
+and tokens-per-minute budgets before it is made. The counters live in the
+default cache, so all processes using a shared cache (file or redis) draw
+from the same budgets. Calls that do not fit wait for up to LIMITER_MAX_WAIT
+seconds before LimitExceeded is raised.
+
+The budgets are counted in windows of LIMITER_WINDOW seconds, each
+allowing its share of the per-minute budget; cache increments are atomic on
+every backend, which a continuously refilled token bucket would not be.
+The concurrency limit adapts AIMD-style: it grows by about one slot per
+limit's worth of calls that finish within the latency target, and halves
+(at most once per LIMITER_DECREASE_COOLDOWN) when a call is throttled with
+a 429 or exceeds the target.
+"""
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+
+class LimitExceeded(Exception):
+    """Raised when a call cannot get through the limits within LIMITER_MAX_WAIT."""
+
+
+def service_limits(service):
+    """Configured limits of a service ('openai' or 'replicate'); 0 disables a budget."""
+    prefix = service.upper()
+    return {
+        'rpm': getattr(settings, f'{prefix}_RPM', 0),
+        'tpm': getattr(settings, f'{prefix}_TPM', 0),
+        'max_concurrency': getattr(settings, f'{prefix}_MAX_CONCURRENCY', 0),
+        'latency_target': getattr(settings, f'{prefix}_LATENCY_TARGET', 0),
+    }
+
+
+def _incr(key, amount, timeout):
+    cache.add(key, 0, timeout=timeout)
+    try:
+        return cache.incr(key, amount)
+    except ValueError:
+        # Expired between add and incr
+        cache.set(key, amount, timeout=timeout)
+        return amount
+
+
+def _decr(key, amount):
+    try:
+        cache.decr(key, amount)
+    except ValueError:
+        pass
+
+
+def _budget_key(service, kind, window):
+    return f"limits:{service}:{kind}:{window}"
+
+
+def _take_budget(service, tokens):
+    """Take a request and `tokens` from the current window; return 0 or seconds to wait."""
+    limits = service_limits(service)
+    size = settings.LIMITER_WINDOW
+    now = time.time()
+    window = int(now // size)
+    taken = []
+    for kind, amount, per_minute in (('requests', 1, limits['rpm']), ('tokens', tokens, limits['tpm'])):
+        if not per_minute or not amount:
+            continue
+        key = _budget_key(service, kind, window)
+        used = _incr(key, amount, timeout=size * 2)
+        taken.append((key, amount))
+        # A call bigger than a whole window still runs in an empty window
+        if used > max(1, per_minute * size / 60) and used != amount:
+            for key, amount in taken:
+                _decr(key, amount)
+            # Spread the waiting calls over the start of the next window
+            return size - now % size + random.uniform(0, size / 10)
+    return 0
+
+
+def concurrency_limit(service):
+    """Current adaptive concurrency limit of a service (0 means unlimited)."""
+    maximum = service_limits(service)['max_concurrency']
+    if not maximum:
+        return 0
+    return cache.get(f"limits:{service}:concurrency", maximum)
+
+
+def _take_slot(service):
+    limit = concurrency_limit(service)
+    if not limit:
+        return True
+    key = f"limits:{service}:in_flight"
+    # Slots of a crashed process are released when the counter expires
+    if _incr(key, 1, timeout=settings.LIMITER_SLOT_TTL) <= max(1, int(limit)):
+        cache.touch(key, settings.LIMITER_SLOT_TTL)
+        return True
+    _decr(key, 1)
+    return False
+
+
+def _release_slot(service):
+    if concurrency_limit(service):
+        _decr(f"limits:{service}:in_flight", 1)
+
+
+def _adjust(service, latency, throttled):
+    """Grow the concurrency limit after a good call, shrink it after a throttled or slow one."""
+    limits = service_limits(service)
+    limit = concurrency_limit(service)
+    if not limit:
+        return
+    slow = limits['latency_target'] and latency > limits['latency_target']
+    if throttled or slow:
+        if not cache.add(f"limits:{service}:decreased", True, timeout=settings.LIMITER_DECREASE_COOLDOWN):
+            return
+        limit = max(1, limit / 2)
+        print(f"Concurrency limit for {service} lowered to {limit:.1f} ({'throttled' if throttled else 'slow'})")
+    else:
+        limit = min(limits['max_concurrency'], limit + 1 / limit)
+    cache.set(f"limits:{service}:concurrency", limit, timeout=None)
+
+
+def is_throttled(error):
+    """True for errors that mean the upstream is rate limiting us (HTTP 429)."""
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    message = str(error).lower()
+    return status == 429 or 'throttled' in message or 'rate limit' in message
+
+
+def _try_acquire(service, tokens):
+    """Take a slot and the budget for a call; return 0 or seconds to wait."""
+    if not _take_slot(service):
+        return random.uniform(0.05, 0.25)
+    wait = _take_budget(service, tokens)
+    if wait:
+        _release_slot(service)
+    return wait
+
+
+def _next_wait(service, tokens, deadline):
+    wait = _try_acquire(service, tokens)
+    if wait and time.monotonic() + wait > deadline:
+        metrics.inc('storyapp_limiter_rejections_total', service=service)
+        raise LimitExceeded(f"{service} limits still exceeded after {settings.LIMITER_MAX_WAIT}s")
+    return wait
+
+
+class Slot:
+    """A granted call; `use_tokens` corrects the token estimate with the actual usage."""
+
+    def __init__(self, service, tokens):
+        self.service = service
+        self.tokens = tokens
+
+    def use_tokens(self, tokens):
+        if not tokens or not service_limits(self.service)['tpm']:
+            return
+        window = int(time.time() // settings.LIMITER_WINDOW)
+        key = _budget_key(self.service, 'tokens', window)
+        if tokens > self.tokens:
+            _incr(key, tokens - self.tokens, timeout=settings.LIMITER_WINDOW * 2)
+        elif tokens < self.tokens:
+            _decr(key, self.tokens - tokens)
+        self.tokens = tokens
+
+    async def ause_tokens(self, tokens):
+        """Async version of use_tokens."""
+        await sync_to_async(self.use_tokens, thread_sensitive=False)(tokens)
+
+
+class _Call:
+    def __init__(self, service, started):
+        self.service = service
+        self.started = started
+        metrics.observe('storyapp_limiter_wait_seconds', time.monotonic() - started, service=service)
+        self.call_started = time.monotonic()
+
+    def finish(self, error):
+        throttled = error is not None and is_throttled(error)
+        if throttled:
+            metrics.inc('storyapp_limiter_throttled_total', service=self.service)
+        _release_slot(self.service)
+        _adjust(self.service, time.monotonic() - self.call_started, throttled)
+
+
+@contextmanager
+def limit(service, tokens=0):
+    """Run a block as one call to `service` within its limits, waiting for room if needed."""
+    if not settings.LIMITER_ENABLED:
+        yield Slot(service, tokens)
+        return
+    started = time.monotonic()
+    deadline = started + settings.LIMITER_MAX_WAIT
+    while wait := _next_wait(service, tokens, deadline):
+        time.sleep(wait)
+    call = _Call(service, started)
+    error = None
+    try:
+        yield Slot(service, tokens)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        call.finish(error)
+
+
+@asynccontextmanager
+async def alimit(service, tokens=0):
+    """Async version of limit; waits without blocking the event loop.
+
+    The cache is only used from worker threads, since its calls block on
+    the redis and file backends.
+    """
+    if not settings.LIMITER_ENABLED:
+        yield Slot(service, tokens)
+        return
+    started = time.monotonic()
+    deadline = started + settings.LIMITER_MAX_WAIT
+    next_wait = sync_to_async(_next_wait, thread_sensitive=False)
+    while wait := await next_wait(service, tokens, deadline):
+        await asyncio.sleep(wait)
+    call = _Call(service, started)
+    error = None
+    try:
+        yield Slot(service, tokens)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        await sync_to_async(call.finish, thread_sensitive=False)(error)
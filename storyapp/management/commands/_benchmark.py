@@ -0,0 +1,43 @@
+"""Helpers shared by the benchmark commands."""
+import math
+import os
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import connections
+
+
+def use_database(path):
+    """Point the default connection at a fresh SQLite file for the rest of the process."""
+    path = os.path.abspath(path)
+    if path == os.path.abspath(str(settings.DATABASES['default']['NAME'])):
+        raise CommandError('Refusing to use the application database for the benchmark')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    # Connections opened later, in any thread, are built from the same dict
+    connection = connections['default']
+    connection.close()
+    connection.settings_dict['NAME'] = path
+    return connection
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, or None if it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(values):
+    """Count, mean and p50/p95/p99 of a list of durations in seconds."""
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
@@ -0,0 +1,147 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from storyapp.models import Story, StoryResponse
+
+from ._benchmark import use_database
+
+# Schema before and after the hot path indexes
+BEFORE_MIGRATION = '0011_storyintro'
+AFTER_MIGRATION = '0012_story_hot_path_indexes'
+
+TURNS_PER_STORY = 10
+THEMES = 10
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the story hot path queries against a synthetic database, before and after the indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=str(settings.BASE_DIR / 'cache' / 'benchmark.sqlite3'),
+                            help='SQLite file to create the synthetic database in (deleted first)')
+        parser.add_argument('--responses', type=int, default=1000000,
+                            help='Number of story responses to generate')
+        parser.add_argument('--pending', type=float, default=0.01,
+                            help='Fraction of stories still waiting for images and email')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Times each query is run; the median time is reported')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        connection = use_database(options['database'])
+
+        random.seed(options['seed'])
+        call_command('migrate', 'storyapp', BEFORE_MIGRATION, verbosity=0)
+        started = time.perf_counter()
+        self.populate(connection, options['responses'], options['pending'])
+        self.stdout.write(f"Generated {options['responses']} responses in {time.perf_counter() - started:.1f}s\n")
+
+        self.report('Before indexes', connection, options['repeat'])
+        started = time.perf_counter()
+        call_command('migrate', 'storyapp', AFTER_MIGRATION, verbosity=0)
+        self.stdout.write(f"Applied {AFTER_MIGRATION} in {time.perf_counter() - started:.1f}s\n")
+        self.report('After indexes', connection, options['repeat'])
+
+    def populate(self, connection, response_count, pending):
+        """Insert users, themes, stories and responses with raw SQL, oldest first."""
+        story_count = max(1, response_count // TURNS_PER_STORY)
+        pending_from = story_count - max(1, int(story_count * pending))
+        start = timezone.now() - timedelta(minutes=story_count)
+        adapt = connection.ops.adapt_datetimefield_value
+
+        # One transaction, so SQLite does not sync the file after every row
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO storyapp_theme (id, name, description, created_at, modified_at) VALUES (%s, %s, %s, %s, %s)",
+                [(i, f'Theme {i}', 'Synthetic theme', adapt(start), adapt(start)) for i in range(1, THEMES + 1)]
+            )
+            cursor.executemany(
+                "INSERT INTO storyapp_user (id, email, created_at, modified_at) VALUES (%s, %s, %s, %s)",
+                [(i, f'user{i}@example.com', adapt(start), adapt(start)) for i in range(1, story_count // 10 + 2)]
+            )
+
+            for first in range(1, story_count + 1, BATCH_SIZE):
+                stories, responses = [], []
+                for story_id in range(first, min(first + BATCH_SIZE, story_count + 1)):
+                    created = adapt(start + timedelta(minutes=story_id))
+                    done = story_id <= pending_from
+                    stories.append((
+                        story_id, random.randint(1, story_count // 10 + 1), random.randint(1, THEMES),
+                        'Nova', 'Synthetic plot', f'plots/{story_id}.jpg', '{}',
+                        f'pdfs/{story_id}.pdf' if done else None, done,
+                        Story.FINALIZE_DONE if done else Story.FINALIZE_WAITING, created,
+                        TURNS_PER_STORY, '', 0, created, created,
+                    ))
+                    for turn in range(TURNS_PER_STORY):
+                        # The last turns of pending stories have no images yet
+                        has_images = done or turn < TURNS_PER_STORY - 2
+                        turn_created = adapt(start + timedelta(minutes=story_id, seconds=turn))
+                        responses.append((
+                            story_id, 'Synthetic input', 'Synthetic reply',
+                            f'user_inputs/{story_id}_{turn}.jpg' if has_images else None,
+                            f'ai_responses/{story_id}_{turn}.jpg' if has_images else None,
+                            '{}', '{}', turn_created, turn_created,
+                        ))
+                cursor.executemany(
+                    "INSERT INTO storyapp_story (id, user_id, theme_id, character_name, plot_text, plot_image_path, "
+                    "plot_image_variants, pdf_path, email_sent, finalize_status, finalize_requested_at, turn_count, "
+                    "context_summary, summarized_turns, created_at, modified_at) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                    stories
+                )
+                cursor.executemany(
+                    "INSERT INTO storyapp_storyresponse (story_id, user_input, ai_response, user_img_path, ai_img_path, "
+                    "user_img_variants, ai_img_variants, created_at, modified_at) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                    responses
+                )
+            cursor.execute("ANALYZE")
+
+    def queries(self):
+        """The hot path querysets, as the views, finalization and admin build them."""
+        story_id = Story.objects.order_by('-id').values_list('id', flat=True).first()
+        since = Story.objects.order_by('-created_at').values_list('created_at', flat=True)[100]
+        pending_images = Q(user_img_path__isnull=True) | Q(ai_img_path__isnull=True)
+        return [
+            ('story turns in order',
+             StoryResponse.objects.filter(story_id=story_id).order_by('created_at')),
+            ('prefetched turns',
+             StoryResponse.objects.filter(story_id__in=[story_id]).order_by('created_at')),
+            ('turns waiting for images',
+             StoryResponse.objects.filter(story_id=story_id).filter(pending_images).order_by('created_at')
+             .values('id', 'user_img_path', 'ai_img_path')),
+            ('images ready check',
+             StoryResponse.objects.filter(story_id=story_id).filter(pending_images).values('id')[:1]),
+            ('unsent stories',
+             Story.objects.filter(email_sent=False).order_by('created_at')[:100]),
+            ('admin: unsent stories of a theme',
+             Story.objects.filter(theme_id=1, email_sent=False, created_at__gte=since).order_by('-id')[:100]),
+        ]
+
+    def report(self, title, connection, repeat):
+        self.stdout.write(self.style.SUCCESS(f'\n{title}'))
+        for name, queryset in self.queries():
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = [row[-1] for row in cursor.fetchall()]
+
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append(time.perf_counter() - started)
+
+            self.stdout.write(f'{name}: {statistics.median(timings) * 1000:.2f} ms (median of {repeat})')
+            for step in plan:
+                self.stdout.write(f'    {step}')
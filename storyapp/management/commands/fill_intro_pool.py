@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from storyapp.intro_pool import fill_pool
+from storyapp.models import StoryIntro, Theme
+
+
+class Command(BaseCommand):
+    help = 'Fills the per-theme pools of pre-generated story intros'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--theme', action='append', dest='themes',
+                            help='Only fill the pool of this theme name (may be repeated)')
+        parser.add_argument('--size', type=int, default=settings.INTRO_POOL_SIZE,
+                            help='Number of intros to keep per theme')
+        parser.add_argument('--low-water', type=int, default=None,
+                            help='Only refill themes with fewer intros than this (default: --size)')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+                            help='Keep running and check the pools every SECONDS')
+
+    def handle(self, *args, **options):
+        low_water = options['low_water'] if options['low_water'] is not None else options['size']
+        while True:
+            themes = Theme.objects.all()
+            if options['themes']:
+                themes = themes.filter(name__in=options['themes'])
+
+            for theme in themes:
+                available = StoryIntro.objects.filter(theme=theme).count()
+                if available >= low_water:
+                    continue
+                added = fill_pool(theme, size=options['size'])
+                self.stdout.write(self.style.SUCCESS(
+                    f'{theme.name}: added {added} intros ({available + added} available)'
+                ))
+
+            if options['loop'] is None:
+                break
+            close_old_connections()
+            time.sleep(options['loop'])
@@ -0,0 +1,276 @@
+import contextlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import resolve, reverse
+
+from storyapp import clients, images
+from storyapp.fakes import FakeOpenAIServer, FakeReplicateServer, parse_latency
+from storyapp.models import Story, StoryResponse, Theme
+
+from ._benchmark import summarize, use_database
+
+FINAL_STATUSES = (Story.FINALIZE_DONE, Story.FINALIZE_FAILED)
+
+
+class Recorder:
+    """Thread-safe collection of request latencies and end-to-end timings."""
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, error=False):
+        with self.lock:
+            self.timings[name].append(seconds)
+            if error:
+                self.errors[name] += 1
+
+
+class ImageTracker(threading.Thread):
+    """Records how long after its POST each turn has both of its images."""
+
+    def __init__(self, recorder, interval=0.05):
+        super().__init__(name='image-tracker', daemon=True)
+        self.recorder = recorder
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def watch(self, response_id, posted_at):
+        with self.lock:
+            self.pending[response_id] = posted_at
+
+    def run(self):
+        try:
+            while not self.stopping.wait(self.interval):
+                with self.lock:
+                    pending = dict(self.pending)
+                if not pending:
+                    continue
+                ready = StoryResponse.objects.filter(
+                    id__in=list(pending), user_img_path__isnull=False, ai_img_path__isnull=False
+                ).values_list('id', flat=True)
+                now = time.monotonic()
+                with self.lock:
+                    for response_id in ready:
+                        self.recorder.add('time to images', now - self.pending.pop(response_id))
+        finally:
+            connection.close()
+
+    def wait(self, timeout):
+        """Wait until every watched turn has its images; return the number still missing."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.pending:
+                    break
+            time.sleep(self.interval)
+        self.stopping.set()
+        self.join()
+        return len(self.pending)
+
+
+class Command(BaseCommand):
+    help = ('Drives simulated users through whole stories against local fake OpenAI and Replicate '
+            'servers and reports latency percentiles per endpoint, time to images and throughput')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='Number of concurrent simulated users')
+        parser.add_argument('--stories', type=int, default=1, help='Stories written by each user')
+        parser.add_argument('--turns', type=int, default=10, help='Turns per story (10 completes a story)')
+        parser.add_argument('--openai-latency', default='lognormal:1.5,0.4',
+                            help='Chat completion latency: SECONDS, uniform:LOW,HIGH, normal:MEAN,STDDEV '
+                                 'or lognormal:MEDIAN,SIGMA')
+        parser.add_argument('--openai-failure-rate', type=float, default=0.0,
+                            help='Fraction of chat completions answered with HTTP 500')
+        parser.add_argument('--replicate-latency', default='lognormal:4,0.3',
+                            help='Prediction run time, in the same format as --openai-latency')
+        parser.add_argument('--replicate-failure-rate', type=float, default=0.0,
+                            help='Fraction of predictions that end with status "failed"')
+        parser.add_argument('--think-time', default='0',
+                            help='Pause of a user between two requests, in the same format')
+        parser.add_argument('--timeout', type=float, default=300,
+                            help='Seconds to wait for outstanding images and PDFs after the last turn')
+        parser.add_argument('--intro-pool', action='store_true', help='Serve new stories from the intro pool')
+        parser.add_argument('--database', default=str(settings.BASE_DIR / 'cache' / 'loadtest.sqlite3'),
+                            help='SQLite file to run against (deleted first)')
+        parser.add_argument('--output', help='Also write the report as JSON to this file')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--app-output', action='store_true', help="Show the app's own log output")
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        self.think_time = parse_latency(options['think_time'])
+        self.turns = options['turns']
+        self.timeout = options['timeout']
+        self.recorder = Recorder()
+
+        use_database(options['database'])
+        call_command('migrate', verbosity=0)
+        with open(os.devnull, 'w') as devnull:
+            call_command('populate_themes', stdout=devnull)
+        self.theme_ids = list(Theme.objects.values_list('id', flat=True))
+
+        openai = FakeOpenAIServer(options['openai_latency'], options['openai_failure_rate'])
+        replicate = FakeReplicateServer(options['replicate_latency'], options['replicate_failure_rate'])
+        with openai, replicate, tempfile.TemporaryDirectory() as media_root, override_settings(
+            ALLOWED_HOSTS=['*'],
+            MEDIA_ROOT=media_root,
+            RENDER_CACHE_DIR=os.path.join(media_root, 'render'),
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            OPENAI_API_KEY='fake-key',
+            OPENAI_BASE_URL=f"{openai.url}/v1",
+            OPENAI_HEALTH_PROBE_INTERVAL=0,
+            REPLICATE_API_TOKEN='fake-token',
+            REPLICATE_API_BASE_URL=replicate.url,
+            IMAGE_JOBS_DURABLE=False,
+            INTRO_POOL_ENABLED=options['intro_pool'],
+        ):
+            # Clients built before the settings were overridden point at the real APIs
+            clients._clients.clear()
+            images._versions.clear()
+
+            self.tracker = ImageTracker(self.recorder)
+            self.tracker.start()
+            with contextlib.ExitStack() as stack:
+                if not options['app_output']:
+                    stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+                started = time.monotonic()
+                with ThreadPoolExecutor(max_workers=options['users'], thread_name_prefix='user') as executor:
+                    list(executor.map(self.simulate_user, range(options['users']), [options['stories']] * options['users']))
+                elapsed = time.monotonic() - started
+                missing_images = self.tracker.wait(self.timeout)
+
+        report = self.build_report(options, elapsed, missing_images, openai, replicate)
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def request(self, client, name, method, url, data=None):
+        """Send a request, record its latency under `name` and return the response."""
+        time.sleep(self.think_time())
+        started = time.monotonic()
+        try:
+            response = getattr(client, method)(url, data)
+            error = response.status_code >= 500
+        except Exception:
+            response, error = None, True
+        self.recorder.add(name, time.monotonic() - started, error=error)
+        return response
+
+    def simulate_user(self, number, stories):
+        try:
+            client = Client(raise_request_exception=False)
+            self.request(client, 'index POST', 'post', reverse('index'), {'email': f'loaduser{number}@example.com'})
+            for story in range(stories):
+                self.write_story(client, f'Hero{number}x{story}')
+        finally:
+            connection.close()
+
+    def write_story(self, client, character_name):
+        self.request(client, 'create_story GET', 'get', reverse('create_story'))
+        response = self.request(client, 'create_story POST', 'post', reverse('create_story'), {
+            'theme': random.choice(self.theme_ids),
+            'character_name': character_name,
+        })
+        if response is None or response.status_code != 302:
+            return
+        story_id = resolve(response['Location']).kwargs['story_id']
+        story_url = reverse('continue_story', args=[story_id])
+
+        for turn in range(self.turns):
+            self.request(client, 'continue_story GET', 'get', story_url)
+            posted_at = time.monotonic()
+            response = self.request(client, 'continue_story POST', 'post', story_url, {
+                'user_input': f'{character_name} takes step {turn + 1} of the adventure',
+            })
+            response_id = StoryResponse.objects.filter(story_id=story_id).order_by('-id').values_list('id', flat=True).first()
+            if response_id:
+                self.tracker.watch(response_id, posted_at)
+            if response is None or response.status_code != 302:
+                return
+
+        if resolve(response['Location']).url_name != 'story_complete':
+            return
+        self.request(client, 'story_complete GET', 'get', response['Location'])
+        status_url = reverse('story_finalize_status', args=[story_id])
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            response = self.request(client, 'story_finalize_status GET', 'get', status_url)
+            if response is not None and response.status_code == 200 and response.json()['status'] in FINAL_STATUSES:
+                self.recorder.add('time to PDF', time.monotonic() - posted_at,
+                                  error=response.json()['status'] != Story.FINALIZE_DONE)
+                return
+            time.sleep(0.5)
+        self.recorder.add('time to PDF', time.monotonic() - posted_at, error=True)
+
+    def build_report(self, options, elapsed, missing_images, openai, replicate):
+        timings, errors = self.recorder.timings, self.recorder.errors
+        endpoints = {
+            name: dict(summarize(values), errors=errors[name])
+            for name, values in sorted(timings.items()) if not name.startswith('time to')
+        }
+        requests = sum(endpoint['count'] for endpoint in endpoints.values())
+        turns = len(timings['continue_story POST'])
+        return {
+            'config': {key: options[key] for key in (
+                'users', 'stories', 'turns', 'openai_latency', 'openai_failure_rate',
+                'replicate_latency', 'replicate_failure_rate', 'think_time', 'intro_pool',
+            )},
+            'elapsed': elapsed,
+            'endpoints': endpoints,
+            'time_to_images': dict(summarize(timings['time to images']), missing=missing_images),
+            'time_to_pdf': dict(summarize(timings['time to PDF']), errors=errors['time to PDF']),
+            'throughput': {
+                'requests_per_second': requests / elapsed,
+                'turns_per_second': turns / elapsed,
+                'stories_per_minute': len(timings['time to PDF']) * 60 / elapsed,
+            },
+            'fakes': {'openai': dict(openai.stats), 'replicate': dict(replicate.stats)},
+        }
+
+    def print_report(self, report):
+        def ms(seconds):
+            return '-' if seconds is None else f'{seconds * 1000:.0f}'
+
+        config = report['config']
+        self.stdout.write(self.style.SUCCESS(
+            f"{config['users']} users x {config['stories']} stories x {config['turns']} turns "
+            f"in {report['elapsed']:.1f}s"
+        ))
+        rows = list(report['endpoints'].items()) + [
+            ('time to images', report['time_to_images']),
+            ('time to PDF', report['time_to_pdf']),
+        ]
+        self.stdout.write(f"{'':<28}{'count':>7}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for name, row in rows:
+            failed = row.get('errors', row.get('missing', 0))
+            self.stdout.write(
+                f"{name:<28}{row['count']:>7}{failed:>8}{ms(row['p50']):>9}{ms(row['p95']):>9}{ms(row['p99']):>9}"
+            )
+        throughput = report['throughput']
+        self.stdout.write(
+            f"Throughput: {throughput['requests_per_second']:.2f} requests/s, "
+            f"{throughput['turns_per_second']:.2f} turns/s, {throughput['stories_per_minute']:.2f} stories/min"
+        )
+        fakes = report['fakes']
+        self.stdout.write(
+            f"Fake OpenAI: {fakes['openai']['requests']} requests, {fakes['openai']['failures']} injected failures; "
+            f"fake Replicate: {fakes['replicate']['requests']} requests, "
+            f"{fakes['replicate']['failures']} injected failures"
+        )
@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from storyapp.predictions import reconcile_predictions
+
+
+class Command(BaseCommand):
+    help = 'Completes Replicate predictions whose webhook has not arrived'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=settings.PREDICTION_RECONCILE_AFTER,
+                            metavar='SECONDS', help='Only check predictions pending for at least SECONDS')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+                            help='Keep running and sweep every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            completed = reconcile_predictions(older_than=options['older_than'])
+            if completed:
+                self.stdout.write(self.style.SUCCESS(f'Completed {completed} predictions'))
+
+            if options['loop'] is None:
+                break
+            close_old_connections()
+            time.sleep(options['loop'])
@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from storyapp.finalize import resume_stalled_finalizations
+
+
+class Command(BaseCommand):
+    help = 'Finalizes again the stories whose PDF rendering was interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-after', type=float, default=settings.STORY_FINALIZE_STALE_AFTER,
+                            metavar='SECONDS', help='Only resume stories stuck for SECONDS past their deadline')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+                            help='Keep running and sweep every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            resumed = resume_stalled_finalizations(stale_after=options['stale_after'])
+            if resumed:
+                self.stdout.write(self.style.SUCCESS(f'Resumed {len(resumed)} stories'))
+
+            if options['loop'] is None:
+                break
+            close_old_connections()
+            time.sleep(options['loop'])
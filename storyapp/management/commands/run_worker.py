@@ -0,0 +1,102 @@
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from storyapp.jobs import claim_jobs, default_worker_name, extend_lease, run_job
+
+
+class Command(BaseCommand):
+    help = 'Runs a background worker that processes queued image generation jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.JOB_WORKER_CONCURRENCY,
+                            help='Maximum number of jobs to run at the same time')
+        parser.add_argument('--lease', type=int, default=settings.JOB_LEASE_SECONDS,
+                            help='Seconds a claimed job stays invisible to other workers before it is renewed')
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL,
+                            help='Seconds to sleep when there is no work')
+        parser.add_argument('--kind', action='append', dest='kinds',
+                            help='Only process jobs of this kind (may be repeated)')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is drained')
+        parser.add_argument('--name', default=None, help='Worker name recorded on claimed jobs')
+
+    def handle(self, *args, **options):
+        self.concurrency = max(1, options['concurrency'])
+        self.lease = options['lease']
+        self.worker = options['name'] or default_worker_name()
+        self.stopping = threading.Event()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+        signal.signal(signal.SIGTERM, lambda *args: self.stopping.set())
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Worker {self.worker} started (concurrency={self.concurrency}, lease={self.lease}s)'
+        ))
+
+        heartbeat = threading.Thread(target=self.renew_leases, daemon=True)
+        heartbeat.start()
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='job')
+        try:
+            while not self.stopping.is_set():
+                with self.lock:
+                    free_slots = self.concurrency - len(self.in_flight)
+
+                jobs = []
+                if free_slots > 0:
+                    close_old_connections()
+                    jobs = claim_jobs(self.worker, free_slots, self.lease, kinds=options['kinds'])
+
+                for job in jobs:
+                    with self.lock:
+                        self.in_flight[job.id] = job
+                    executor.submit(self.process, job)
+
+                if not jobs:
+                    with self.lock:
+                        idle = not self.in_flight
+                    if options['once'] and idle:
+                        break
+                    self.stopping.wait(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stopping.set()
+        finally:
+            self.stdout.write('Waiting for running jobs to finish...')
+            executor.shutdown(wait=True)
+            self.stopping.set()
+
+        self.stdout.write(self.style.SUCCESS(f'Worker {self.worker} stopped'))
+
+    def process(self, job):
+        close_old_connections()
+        start_time = time.time()
+        try:
+            outcome = run_job(job)
+            status = {True: 'done', None: 'deferred'}.get(outcome, 'failed')
+            self.stdout.write(f'{job.get_kind_display()} job {job.id} {status} in {time.time() - start_time:.2f} seconds')
+        except Exception as e:
+            self.stderr.write(f'Error running job {job.id}: {type(e).__name__}: {e}')
+        finally:
+            with self.lock:
+                self.in_flight.pop(job.id, None)
+            close_old_connections()
+
+    def renew_leases(self):
+        """Keep the leases of running jobs alive while they make progress."""
+        while not self.stopping.wait(self.lease / 3):
+            with self.lock:
+                jobs = list(self.in_flight.values())
+            for job in jobs:
+                try:
+                    if not extend_lease(job, self.lease):
+                        self.stderr.write(f'Lost lease on job {job.id}')
+                except Exception as e:
+                    self.stderr.write(f'Error renewing lease on job {job.id}: {e}')
+            close_old_connections()
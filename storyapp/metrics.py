@@ -0,0 +1,244 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Every metric with its type and help text
+METRICS = {
+    'storyapp_gpt_request_seconds': ('histogram', 'Time spent in OpenAI chat completion calls'),
+    'storyapp_gpt_tokens_total': ('counter', 'Tokens used by OpenAI chat completions, by call and token type'),
+    'storyapp_replicate_prediction_seconds': ('histogram', 'Time from creating a Replicate prediction to its result'),
+    'storyapp_image_download_seconds': ('histogram', 'Time spent downloading generated images'),
+    'storyapp_pdf_render_seconds': ('histogram', 'Time spent rendering comic PDFs'),
+    'storyapp_email_send_seconds': ('histogram', 'Time spent sending comic emails'),
+    'storyapp_http_request_seconds': ('histogram', 'Time spent in Django views, by view, method and status'),
+    'storyapp_limiter_wait_seconds': ('histogram', 'Time calls waited for room within the OpenAI and Replicate limits'),
+    'storyapp_limiter_rejections_total': ('counter', 'Calls given up after waiting LIMITER_MAX_WAIT for the limits'),
+    'storyapp_limiter_throttled_total': ('counter', 'Calls rejected upstream with HTTP 429'),
+    'storyapp_upstream_retries_total': ('counter', 'Retried OpenAI and Replicate calls'),
+    'storyapp_circuit_breaker_state': ('gauge', 'Circuit breaker state per service: 0 closed, 1 half-open, 2 open'),
+    'storyapp_circuit_breaker_opened_total': ('counter', 'Times a circuit breaker opened'),
+    'storyapp_circuit_breaker_rejections_total': ('counter', 'Calls failed fast by an open circuit breaker'),
+    'storyapp_intro_pool_claims_total': ('counter', 'New stories that asked the intro pool, by theme and hit or miss'),
+    'storyapp_intro_pool_refills_total': ('counter', 'Intro pool refills started, by theme'),
+    'storyapp_intro_pool_generated_total': ('counter', 'Intros generated for the pool, by theme'),
+    'storyapp_intro_pool_available': ('gauge', 'Intros waiting in the pool, by theme'),
+    'storyapp_turn_pipeline_seconds': ('histogram', 'Time from starting a turn pipeline until all its steps finished'),
+    'storyapp_turn_step_seconds': ('histogram', 'Time spent in each turn pipeline step, by step and result'),
+    'storyapp_turn_step_queued_seconds': ('histogram', 'Time turn pipeline steps waited for a free worker, by step'),
+}
+
+# Metric values of this process, keyed by (name, sorted label pairs). Counters
+# hold a number; histograms hold a count per bucket (values above the last
+# bound are only in the total), then the sum and the total count.
+_values = {}
+_lock = threading.Lock()
+_process = {'pid': None, 'id': None}
+_flusher = None
+
+# Gauges read when metrics are rendered, as name -> function returning
+# {label pairs: value}. Their values come from shared state, so they are not
+# part of the snapshots.
+_gauges = {}
+
+
+def _check_process():
+    # A forked worker must not report the samples of its parent as its own
+    pid = os.getpid()
+    if _process['pid'] != pid:
+        _values.clear()
+        _process.update(pid=pid, id=f"{pid}-{uuid.uuid4().hex[:8]}")
+
+
+def inc(name, amount=1, **labels):
+    """Add to a counter."""
+    if not settings.METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _check_process()
+        _values[key] = _values.get(key, 0) + amount
+    _start_flusher()
+
+
+def observe(name, seconds, **labels):
+    """Record one duration in a histogram."""
+    if not settings.METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _check_process()
+        histogram = _values.get(key)
+        if histogram is None:
+            histogram = _values[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += seconds
+        histogram[-1] += 1
+    _start_flusher()
+
+
+def count_tokens(call, usage):
+    """Count the tokens of a chat completion from its `usage`, if it has one."""
+    if usage is not None:
+        inc('storyapp_gpt_tokens_total', usage.prompt_tokens, call=call, type='prompt')
+        inc('storyapp_gpt_tokens_total', usage.completion_tokens, call=call, type='completion')
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time a block into a histogram with an `outcome` label.
+
+    The outcome is `error` when the block raises; blocks that handle their
+    own failures can set `sample['outcome']` themselves.
+    """
+    sample = {'outcome': 'success'}
+    start = time.perf_counter()
+    try:
+        yield sample
+    except BaseException:
+        sample['outcome'] = 'error'
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, outcome=sample['outcome'], **labels)
+
+
+def register_gauge(name, read):
+    """Have `read()` supply the values of a gauge whenever metrics are rendered."""
+    _gauges[name] = read
+
+
+def snapshot():
+    """Values of this process as a JSON-friendly list of [name, labels, value]."""
+    with _lock:
+        _check_process()
+        return [
+            [name, [list(pair) for pair in labels], list(value) if isinstance(value, list) else value]
+            for (name, labels), value in _values.items()
+        ]
+
+
+def flush():
+    """Write this process's values to METRICS_DIR for the other processes to read."""
+    if not settings.METRICS_DIR:
+        return
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    data = snapshot()
+    path = os.path.join(settings.METRICS_DIR, f"{_process['id']}.json")
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def _start_flusher():
+    """Start writing snapshots every METRICS_FLUSH_INTERVAL seconds, once per process."""
+    global _flusher
+    if not settings.METRICS_DIR or (_flusher is not None and _flusher[0] == os.getpid()):
+        return
+
+    def flush_loop():
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            try:
+                flush()
+            except Exception as e:
+                print(f"Error writing metrics snapshot: {type(e).__name__}: {e}")
+
+    with _lock:
+        if _flusher is None or _flusher[0] != os.getpid():
+            thread = threading.Thread(target=flush_loop, name='metrics-flusher', daemon=True)
+            _flusher = (os.getpid(), thread)
+            thread.start()
+            atexit.register(flush)
+
+
+def collect():
+    """Merge the values of every process: this one live, the others from their snapshots.
+
+    Snapshots of exited processes are kept, so counters never go backwards.
+    """
+    merged = {}
+
+    def add(name, labels, value):
+        key = (name, tuple(tuple(pair) for pair in labels))
+        if isinstance(value, list):
+            current = merged.setdefault(key, [0] * len(value))
+            for i, amount in enumerate(value):
+                current[i] += amount
+        else:
+            merged[key] = merged.get(key, 0) + value
+
+    for name, labels, value in snapshot():
+        add(name, labels, value)
+    if settings.METRICS_DIR:
+        own = os.path.join(settings.METRICS_DIR, f"{_process['id']}.json")
+        for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    for name, labels, value in json.load(f):
+                        add(name, labels, value)
+            except (OSError, ValueError) as e:
+                print(f"Error reading metrics snapshot {path}: {e}")
+    return merged
+
+
+def totals(name, by):
+    """Values of a counter summed over every process, keyed by the value of label `by`."""
+    result = {}
+    for (metric, labels), value in collect().items():
+        if metric == name:
+            key = dict(labels).get(by)
+            result[key] = result.get(key, 0) + value
+    return result
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    merged = collect()
+    for name, read in _gauges.items():
+        try:
+            merged.update(((name, labels), value) for labels, value in read().items())
+        except Exception as e:
+            print(f"Error reading gauge {name}: {type(e).__name__}: {e}")
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in merged.items() if metric == name)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind in ('counter', 'gauge'):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', float(bound))])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,37 @@
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+
+
+def record_request(request, response, seconds):
+    match = getattr(request, 'resolver_match', None)
+    metrics.observe(
+        'storyapp_http_request_seconds', seconds,
+        view=match.view_name if match else 'unmatched',
+        method=request.method,
+        status=response.status_code,
+    )
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record the time spent in every view, without forcing async views onto a thread.
+
+    Streaming responses are timed until their headers are ready.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            record_request(request, response, time.perf_counter() - start)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            record_request(request, response, time.perf_counter() - start)
+            return response
+    return middleware
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0003_alter_storyresponse_ai_img_path_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('kind', models.CharField(choices=[('plot_image', 'Plot image'), ('user_image', 'User image'), ('ai_image', 'AI image')], max_length=32)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=3)),
+                ('run_after', models.DateTimeField(help_text='Job is not visible to workers before this time')),
+                ('lease_expires_at', models.DateTimeField(blank=True, help_text='Running job becomes visible again after this time', null=True)),
+                ('worker', models.CharField(blank=True, max_length=100)),
+                ('last_error', models.TextField(blank=True)),
+                ('response', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='storyapp.storyresponse')),
+                ('story', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='storyapp.story')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after'], name='storyapp_jo_status_ada442_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0004_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Hash of normalized prompt and generation parameters', max_length=64, unique=True)),
+                ('params_key', models.CharField(db_index=True, help_text='Hash of generation parameters without the prompt', max_length=64)),
+                ('prompt', models.TextField(help_text='Normalized prompt')),
+                ('path', models.CharField(help_text='Path relative to MEDIA_ROOT', max_length=255)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
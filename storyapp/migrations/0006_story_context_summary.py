@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0005_cachedimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='context_summary',
+            field=models.TextField(blank=True, default='', help_text='Rolling GPT summary of older turns'),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='summarized_turns',
+            field=models.PositiveIntegerField(default=0, help_text='Number of oldest turns folded into the summary'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:49
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_turn_count(apps, schema_editor):
+    Story = apps.get_model('storyapp', 'Story')
+    StoryResponse = apps.get_model('storyapp', 'StoryResponse')
+    counts = (
+        StoryResponse.objects.filter(story=OuterRef('pk'))
+        .order_by().values('story').annotate(total=Count('id')).values('total')
+    )
+    Story.objects.update(turn_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0006_story_context_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='turn_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of responses, kept in sync by the views'),
+        ),
+        migrations.RunPython(backfill_turn_count, migrations.RunPython.noop),
+    ]
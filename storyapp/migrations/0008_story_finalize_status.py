@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:51
+
+from django.db import migrations, models
+
+
+def mark_finalized(apps, schema_editor):
+    Story = apps.get_model('storyapp', 'Story')
+    Story.objects.filter(pdf_path__isnull=False).update(finalize_status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0007_story_turn_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='finalize_requested_at',
+            field=models.DateTimeField(blank=True, help_text='When the last turn was posted', null=True),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='finalize_status',
+            field=models.CharField(blank=True, choices=[('', 'Not started'), ('waiting', 'Waiting for images'), ('rendering', 'Rendering PDF'), ('done', 'Done'), ('failed', 'Failed')], default='', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('plot_image', 'Plot image'), ('user_image', 'User image'), ('ai_image', 'AI image'), ('finalize_story', 'Finalize story')], max_length=32),
+        ),
+        migrations.RunPython(mark_finalized, migrations.RunPython.noop),
+    ]
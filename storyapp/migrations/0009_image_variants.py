@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0008_story_finalize_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='plot_image_variants',
+            field=models.JSONField(blank=True, default=dict, help_text='Web derivatives of the plot image'),
+        ),
+        migrations.AddField(
+            model_name='storyresponse',
+            name='ai_img_variants',
+            field=models.JSONField(blank=True, default=dict, help_text='Web derivatives of the AI image'),
+        ),
+        migrations.AddField(
+            model_name='storyresponse',
+            name='user_img_variants',
+            field=models.JSONField(blank=True, default=dict, help_text='Web derivatives of the user image'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0009_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cachedimage',
+            name='path',
+            field=models.CharField(help_text='Name in the generated storage', max_length=255),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0010_cachedimage_storage_help_text'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('plot_image', 'Plot image'), ('user_image', 'User image'), ('ai_image', 'AI image'), ('finalize_story', 'Finalize story'), ('fill_intro_pool', 'Fill intro pool')], max_length=32),
+        ),
+        migrations.CreateModel(
+            name='StoryIntro',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('plot_template', models.TextField(help_text='Plot text with a placeholder for the character name')),
+                ('plot_image_path', models.CharField(max_length=255)),
+                ('plot_image_variants', models.JSONField(blank=True, default=dict)),
+                ('theme', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='intros', to='storyapp.theme')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0011_storyintro'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='storyresponse',
+            name='story',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='responses', to='storyapp.story'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('email_sent', False)), fields=['created_at'], name='story_unsent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('email_sent', False)), fields=['theme', 'created_at'], name='story_theme_unsent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storyresponse',
+            index=models.Index(fields=['story', 'created_at'], name='response_story_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storyresponse',
+            index=models.Index(condition=models.Q(('user_img_path__isnull', True), ('ai_img_path__isnull', True), _connector='OR'), fields=['story', 'created_at'], name='response_pending_img_idx'),
+        ),
+    ]
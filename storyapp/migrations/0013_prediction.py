@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storyapp', '0012_story_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Prediction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('replicate_id', models.CharField(max_length=64, unique=True)),
+                ('kind', models.CharField(choices=[('plot', 'Plot image'), ('user', 'User image'), ('ai', 'AI image')], max_length=16)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('version', models.CharField(help_text='Replicate model version id', max_length=64)),
+                ('input', models.JSONField(blank=True, default=dict)),
+                ('path', models.CharField(help_text='Name to store the image under in the generated storage', max_length=255)),
+                ('error', models.TextField(blank=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('response', models.ForeignKey(blank=True, help_text='Empty for plot images', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='predictions', to='storyapp.storyresponse')),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='predictions', to='storyapp.story')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='storyapp_pr_status_3e789c_idx')],
+            },
+        ),
+    ]
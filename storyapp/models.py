@@ -24,24 +24,178 @@ class User(TimeStampModel):
 
 
 class Story(TimeStampModel):
+    FINALIZE_NOT_STARTED = ''
+    FINALIZE_WAITING = 'waiting'
+    FINALIZE_RENDERING = 'rendering'
+    FINALIZE_DONE = 'done'
+    FINALIZE_FAILED = 'failed'
+    FINALIZE_CHOICES = [
+        (FINALIZE_NOT_STARTED, 'Not started'),
+        (FINALIZE_WAITING, 'Waiting for images'),
+        (FINALIZE_RENDERING, 'Rendering PDF'),
+        (FINALIZE_DONE, 'Done'),
+        (FINALIZE_FAILED, 'Failed'),
+    ]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='stories')
     theme = models.ForeignKey(Theme, on_delete=models.CASCADE, related_name='stories')
     character_name = models.CharField(max_length=100)
     plot_text = models.TextField(help_text="Generated by GPT")
     plot_image_path = models.CharField(max_length=255, null=True, blank=True, help_text="Image generated using SD")
+    plot_image_variants = models.JSONField(default=dict, blank=True, help_text="Web derivatives of the plot image")
     pdf_path = models.CharField(max_length=255, null=True, blank=True)
     email_sent = models.BooleanField(default=False)
+    finalize_status = models.CharField(max_length=16, choices=FINALIZE_CHOICES, blank=True, default=FINALIZE_NOT_STARTED)
+    finalize_requested_at = models.DateTimeField(null=True, blank=True, help_text="When the last turn was posted")
+    turn_count = models.PositiveIntegerField(default=0, help_text="Number of responses, kept in sync by the views")
+    context_summary = models.TextField(blank=True, default='', help_text="Rolling GPT summary of older turns")
+    summarized_turns = models.PositiveIntegerField(default=0, help_text="Number of oldest turns folded into the summary")
+
+    class Meta:
+        indexes = [
+            # Stories whose comic has not been emailed yet, overall and per theme
+            # (admin filters, finalization sweeps)
+            models.Index(fields=['created_at'], condition=models.Q(email_sent=False), name='story_unsent_idx'),
+            models.Index(fields=['theme', 'created_at'], condition=models.Q(email_sent=False),
+                         name='story_theme_unsent_idx'),
+        ]
 
     def __str__(self):
         return f"{self.character_name}'s {self.theme.name} story"
 
 
 class StoryResponse(TimeStampModel):
-    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='responses')
+    # Indexed by response_story_created_idx below, which also serves lookups by story alone
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='responses', db_index=False)
     user_input = models.TextField()
     ai_response = models.TextField(help_text="Text from GPT")
     user_img_path = models.CharField(max_length=255, null=True, blank=True, help_text="Comic image for user input")
     ai_img_path = models.CharField(max_length=255, null=True, blank=True, help_text="Comic image for AI reply")
+    user_img_variants = models.JSONField(default=dict, blank=True, help_text="Web derivatives of the user image")
+    ai_img_variants = models.JSONField(default=dict, blank=True, help_text="Web derivatives of the AI image")
+
+    class Meta:
+        indexes = [
+            # Turns of a story in order
+            models.Index(fields=['story', 'created_at'], name='response_story_created_idx'),
+            # Turns still waiting for an image
+            models.Index(
+                fields=['story', 'created_at'],
+                condition=models.Q(user_img_path__isnull=True) | models.Q(ai_img_path__isnull=True),
+                name='response_pending_img_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"Response {self.id} for {self.story}"
+
+
+class Job(TimeStampModel):
+    """A durable unit of background work, claimed by `manage.py run_worker`."""
+    KIND_PLOT_IMAGE = 'plot_image'
+    KIND_USER_IMAGE = 'user_image'
+    KIND_AI_IMAGE = 'ai_image'
+    KIND_FINALIZE_STORY = 'finalize_story'
+    KIND_FILL_INTRO_POOL = 'fill_intro_pool'
+    KIND_CHOICES = [
+        (KIND_PLOT_IMAGE, 'Plot image'),
+        (KIND_USER_IMAGE, 'User image'),
+        (KIND_AI_IMAGE, 'AI image'),
+        (KIND_FINALIZE_STORY, 'Finalize story'),
+        (KIND_FILL_INTRO_POOL, 'Fill intro pool'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs')
+    response = models.ForeignKey(StoryResponse, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs')
+    payload = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(help_text="Job is not visible to workers before this time")
+    lease_expires_at = models.DateTimeField(null=True, blank=True, help_text="Running job becomes visible again after this time")
+    worker = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} job {self.id} ({self.status})"
+
+
+class StoryIntro(TimeStampModel):
+    """A pre-generated story plot and plot image, waiting to be claimed by a new story."""
+    theme = models.ForeignKey(Theme, on_delete=models.CASCADE, related_name='intros')
+    plot_template = models.TextField(help_text="Plot text with a placeholder for the character name")
+    plot_image_path = models.CharField(max_length=255)
+    plot_image_variants = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"Intro {self.id} for {self.theme}"
+
+
+class CachedImage(models.Model):
+    """A generated image stored under cache/ in the generated storage, keyed by its inputs."""
+    key = models.CharField(max_length=64, unique=True, help_text="Hash of normalized prompt and generation parameters")
+    params_key = models.CharField(max_length=64, db_index=True, help_text="Hash of generation parameters without the prompt")
+    prompt = models.TextField(help_text="Normalized prompt")
+    path = models.CharField(max_length=255, help_text="Name in the generated storage")
+    size = models.PositiveIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+    last_used_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Cached image {self.key[:12]}"
+
+
+class Prediction(TimeStampModel):
+    """A Replicate prediction whose image is attached when its webhook arrives."""
+    KIND_CHOICES = [
+        ('plot', 'Plot image'),
+        ('user', 'User image'),
+        ('ai', 'AI image'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    replicate_id = models.CharField(max_length=64, unique=True)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='predictions')
+    response = models.ForeignKey(StoryResponse, on_delete=models.CASCADE, null=True, blank=True,
+                                 related_name='predictions', help_text="Empty for plot images")
+    version = models.CharField(max_length=64, help_text="Replicate model version id")
+    input = models.JSONField(default=dict, blank=True)
+    path = models.CharField(max_length=255, help_text="Name to store the image under in the generated storage")
+    error = models.TextField(blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} prediction {self.replicate_id} ({self.status})"
@@ -0,0 +1,306 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+from . import metrics
+from .models import Story, StoryResponse
+from .storage import file_version, read_file, save_file, sharded_name
+
+# Bump when the page layout changes, so cached fragments are rendered again
+LAYOUT_VERSION = 1
+TURNS_PER_PAGE = 2
+
+# Content hashes of source images by name and file_version, so an image
+# regenerated under the same name is hashed again.
+_source_hashes = {}
+
+
+def wrap_lines(text, width=70):
+    """Split text into lines of about `width` characters."""
+    lines = []
+    current_line = []
+
+    for word in text.split():
+        current_line.append(word)
+        if len(' '.join(current_line)) > width:  # adjust based on your font size and page width
+            lines.append(' '.join(current_line[:-1]))
+            current_line = [current_line[-1]]
+
+    if current_line:
+        lines.append(' '.join(current_line))
+    return lines
+
+
+def source_hash(name, content=None, version=None):
+    """SHA-256 of a stored image, read from storage only while the file is unchanged."""
+    key = (name, version or file_version(name))
+    digest = _source_hashes.get(key)
+    if digest is None:
+        digest = hashlib.sha256(content if content is not None else read_file(name)).hexdigest()
+        if len(_source_hashes) > 10000:
+            _source_hashes.clear()
+        _source_hashes[key] = digest
+    return digest
+
+
+def print_variant(name, width, height):
+    """Return a JPEG of the image downscaled for drawing at width x height points.
+
+    The variant has PDF_IMAGE_DPI pixels per inch of the drawn size, which is
+    far smaller than the generated images, and is kept by source hash under
+    RENDER_CACHE_DIR/images so every story and re-render shares it.
+    """
+    dpi = settings.PDF_IMAGE_DPI
+    quality = settings.PDF_IMAGE_QUALITY
+    size = (round(width * dpi / 72), round(height * dpi / 72))
+    version = file_version(name)
+    content = None if (name, version) in _source_hashes else read_file(name)
+    key = hashlib.sha256(f"{source_hash(name, content, version)}:{size[0]}x{size[1]}:{quality}".encode('utf-8')).hexdigest()
+    variant = os.path.join(settings.RENDER_CACHE_DIR, 'images', key[:2], f"{key}.jpg")
+    if os.path.exists(variant):
+        return variant
+
+    os.makedirs(os.path.dirname(variant), exist_ok=True)
+    temp_path = f"{variant}.{uuid.uuid4().hex}.tmp"
+    content = read_file(name) if content is None else content
+    with Image.open(BytesIO(content)) as image:
+        image = image.convert('RGB')
+        # drawImage stretches to the box anyway; never upscale
+        target = (min(size[0], image.width), min(size[1], image.height))
+        if target != image.size:
+            image = image.resize(target, Image.LANCZOS)
+        image.save(temp_path, 'JPEG', quality=quality, optimize=True)
+    os.replace(temp_path, variant)
+    return variant
+
+
+def draw_image(c, name, x, y, width, height, readers):
+    """Draw a stored image, if there is one, using its print variant.
+
+    `readers` maps files to ImageReader objects and is shared by everything
+    drawn in one render, so each file is opened and decoded only once.
+    """
+    if not name:
+        return
+    key = (name, width, height)
+    reader = readers.get(key)
+    if reader is None:
+        try:
+            if settings.PDF_IMAGE_DPI:
+                reader = ImageReader(print_variant(name, width, height))
+            else:
+                reader = ImageReader(BytesIO(read_file(name)))
+        except Exception as e:
+            print(f"Error preparing PDF image {name}: {type(e).__name__}: {e}")
+            return
+        readers[key] = reader
+    c.drawImage(reader, x, y, width, height)
+
+
+def draw_lines(c, x, y, lines):
+    text_object = c.beginText(x, y)
+    for line in lines:
+        text_object.textLine(line)
+    c.drawText(text_object)
+
+
+def draw_title_page(c, story, readers):
+    width, height = A4  # 595.2, 841.8 points (72 points = 1 inch)
+
+    c.setFont("Helvetica-Bold", 24)
+    c.drawCentredString(width/2, height-100, f"{story.character_name}'s {story.theme.name} Adventure")
+
+    c.setFont("Helvetica", 12)
+    c.drawCentredString(width/2, height-150, f"Created on {story.created_at.strftime('%B %d, %Y')}")
+
+    # Load and draw the plot image on the title page
+    draw_image(c, story.plot_image_path, 100, height-400, width-200, 200, readers)
+
+    c.setFont("Helvetica", 12)
+    draw_lines(c, 100, height-450, wrap_lines(story.plot_text))
+
+
+def draw_turns(c, story, turns, readers):
+    """Draw a page of turns, each with its user and AI panels side by side."""
+    width, height = A4
+    y_position = height - 100  # Starting Y position
+
+    for response in turns:
+        # Add user text
+        c.setFont("Helvetica-Bold", 12)
+        c.drawString(50, y_position, f"{story.character_name}:")
+        c.setFont("Helvetica", 10)
+        lines = wrap_lines(response.user_input)
+        draw_lines(c, 50, y_position - 20, lines)
+
+        # Determine where to place images based on text height
+        text_height = len(lines) * 12  # Approximate height of text block
+        image_y = y_position - text_height - 160  # Position images below text
+
+        draw_image(c, response.user_img_path, 50, image_y, 200, 150, readers)
+
+        # Add AI response text
+        c.setFont("Helvetica-Bold", 12)
+        c.drawString(300, y_position, "AI:")
+        c.setFont("Helvetica", 10)
+        draw_lines(c, 300, y_position - 20, wrap_lines(response.ai_response))
+
+        draw_image(c, response.ai_img_path, 300, image_y, 250, 150, readers)
+
+        # Update Y position for the next turn
+        y_position = image_y - 50
+
+        # If we're running out of space on the page, create a new page
+        if y_position < 100:
+            c.showPage()
+            y_position = height - 100
+
+
+def image_key(name):
+    """An image name with its size and mtime, so a regenerated file changes the key."""
+    return [name, file_version(name)] if name else name
+
+
+def fragment_key(story, turns=None):
+    """Hash of everything drawn on a title page (turns=None) or a page of turns."""
+    if turns is None:
+        content = [
+            'title', story.character_name, story.theme.name, story.created_at.isoformat(),
+            story.plot_text, image_key(story.plot_image_path),
+        ]
+    else:
+        content = ['turns', story.character_name] + [
+            [response.user_input, response.ai_response, image_key(response.user_img_path),
+             image_key(response.ai_img_path)]
+            for response in turns
+        ]
+    data = json.dumps([LAYOUT_VERSION, settings.PDF_IMAGE_DPI, settings.PDF_IMAGE_QUALITY] + content)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def fragment_dir(story_id):
+    return os.path.join(settings.RENDER_CACHE_DIR, 'fragments', str(story_id))
+
+
+def render_fragment(story, turns=None, readers=None):
+    """Render a title page or page of turns to its own PDF, reusing a cached one.
+
+    Returns the fragment path. Fragments are named by their content hash, so a
+    fragment is only rendered again when something drawn on it changed.
+    """
+    path = os.path.join(fragment_dir(story.id), f"{fragment_key(story, turns)}.pdf")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    readers = {} if readers is None else readers
+    with metrics.timer('storyapp_pdf_render_seconds', stage='fragment'):
+        c = canvas.Canvas(temp_path, pagesize=A4)
+        if turns is None:
+            draw_title_page(c, story, readers)
+        else:
+            draw_turns(c, story, turns, readers)
+        c.save()
+    os.replace(temp_path, path)
+    return path
+
+
+def turn_pages(responses):
+    """Split the ordered responses into the groups drawn on each page."""
+    return [responses[i:i + TURNS_PER_PAGE] for i in range(0, len(responses), TURNS_PER_PAGE)]
+
+
+def prerender_turn(story_id, response_id):
+    """Render the page holding a turn as soon as every turn on it has its images.
+
+    Called when an image is attached, so that by the time the story is
+    finished most of the comic has already been rendered and generate_pdf
+    only has to merge the fragments.
+    """
+    try:
+        story = Story.objects.select_related('theme').get(id=story_id)
+        responses = list(StoryResponse.objects.filter(story_id=story_id).order_by('created_at'))
+        readers = {}
+        for turns in turn_pages(responses):
+            if response_id not in [response.id for response in turns]:
+                continue
+            if len(turns) == TURNS_PER_PAGE and all(
+                response.user_img_path and response.ai_img_path for response in turns
+            ):
+                render_fragment(story, turns, readers)
+        if story.plot_image_path:
+            render_fragment(story, readers=readers)
+    except Exception as e:
+        print(f"Error pre-rendering PDF page for response {response_id}: {type(e).__name__}: {e}")
+
+
+def render_full(story, responses, output):
+    """Render the whole comic into one canvas (used when pypdf is unavailable)."""
+    readers = {}
+    c = canvas.Canvas(output, pagesize=A4)
+    draw_title_page(c, story, readers)
+    for turns in turn_pages(responses):
+        c.showPage()
+        draw_turns(c, story, turns, readers)
+    c.save()
+
+
+def remove_stale_fragments(story_id, keep):
+    directory = fragment_dir(story_id)
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path not in keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def generate_pdf(story):
+    """Generate a PDF comic book from the story and responses.
+
+    The title page and each page of turns are rendered as separate cached
+    fragments (most of them already by prerender_turn) and concatenated.
+    """
+    start_time = time.time()
+    responses = list(StoryResponse.objects.filter(story=story).order_by('created_at'))
+
+    output = BytesIO()
+    with metrics.timer('storyapp_pdf_render_seconds', stage='document'):
+        if PdfWriter is None:
+            render_full(story, responses, output)
+        else:
+            readers = {}
+            fragments = [render_fragment(story, readers=readers)] + [
+                render_fragment(story, turns, readers) for turns in turn_pages(responses)
+            ]
+            writer = PdfWriter()
+            for fragment in fragments:
+                writer.append(fragment)
+            writer.write(output)
+            remove_stale_fragments(story.id, keep=set(fragments))
+
+    # Store the PDF under a unique name and record it on the story
+    filename = f"comic_{story.id}_{uuid.uuid4().hex}.pdf"
+    story.pdf_path = save_file(sharded_name('pdfs', filename), output.getvalue())
+    story.save(update_fields=['pdf_path'])
+    print(f"PDF for story {story.id} generated in {time.time() - start_time:.2f} seconds")
+
+    return story.pdf_path
@@ -0,0 +1,148 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics
+
+# Setting holding the size of each worker pool. GPT steps get their own pool,
+# so image steps stuck on Replicate never hold up the story text.
+POOL_SIZES = {'images': 'TURN_PIPELINE_WORKERS', 'text': 'TURN_TEXT_WORKERS'}
+
+# Shared, bounded worker pools for every turn graph in this process
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def get_executor(pool='images'):
+    """Return the process-wide worker pool of the given name."""
+    executor = _executors.get(pool)
+    if executor is None:
+        with _executor_lock:
+            executor = _executors.get(pool)
+            if executor is None:
+                executor = _executors[pool] = ThreadPoolExecutor(
+                    max_workers=getattr(settings, POOL_SIZES[pool]),
+                    thread_name_prefix=f'turn-{pool}',
+                )
+    return executor
+
+
+class StepSkipped(Exception):
+    """Raised for a step whose dependency failed."""
+
+
+class TurnGraph:
+    """A small execution graph for the steps of one story turn.
+
+    Steps are added with the names of the steps they depend on and receive
+    the results of those steps as positional arguments, in order. A step is
+    submitted to its worker pool as soon as all of its dependencies have
+    finished, so independent steps run concurrently. Per-step timings are
+    recorded relative to the moment the graph started and exported as
+    metrics. An `executor` given to the graph runs the steps of every pool.
+    """
+
+    def __init__(self, name, executor=None):
+        self.name = name
+        self.executor = executor
+        self.steps = {}
+        self.futures = {}
+        self.timings = {}
+        self.started_at = None
+        self._submitted = set()
+        self._reported = False
+        self._lock = threading.Lock()
+
+    def add(self, name, func, deps=(), pool='images'):
+        """Add a step run in the named pool. Dependencies must already have been added."""
+        for dep in deps:
+            if dep not in self.steps:
+                raise ValueError(f"Unknown dependency {dep!r} for step {name!r}")
+        if pool not in POOL_SIZES:
+            raise ValueError(f"Unknown pool {pool!r} for step {name!r}")
+        self.steps[name] = (func, tuple(deps), pool)
+        self.futures[name] = Future()
+        return self
+
+    def run(self):
+        """Start every step that has no dependencies and return immediately."""
+        self.started_at = time.monotonic()
+        self._schedule_ready()
+        return self
+
+    def result(self, name, timeout=None):
+        """Wait for a step and return its result (or raise its exception)."""
+        return self.futures[name].result(timeout=timeout)
+
+    def wait(self, timeout=None):
+        """Wait for all steps to finish. Returns True if they all did."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for future in self.futures.values():
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                future.exception(timeout=remaining)
+            except TimeoutError:
+                return False
+        return True
+
+    def _schedule_ready(self):
+        ready = []
+        with self._lock:
+            for name, (func, deps, pool) in self.steps.items():
+                if name in self._submitted:
+                    continue
+                if all(self.futures[dep].done() for dep in deps):
+                    self._submitted.add(name)
+                    ready.append(name)
+
+        for name in ready:
+            func, deps, pool = self.steps[name]
+            failed = [dep for dep in deps if self.futures[dep].exception() is not None]
+            if failed:
+                self._finish(name, exception=StepSkipped(f"dependency failed: {', '.join(failed)}"))
+                continue
+            args = [self.futures[dep].result() for dep in deps]
+            queued_at = time.monotonic()
+            (self.executor or get_executor(pool)).submit(self._run_step, name, func, args, queued_at)
+
+    def _run_step(self, name, func, args, queued_at):
+        close_old_connections()
+        start_time = time.monotonic()
+        try:
+            result = func(*args)
+        except Exception as e:
+            print(f"Turn pipeline {self.name}: step {name} failed: {type(e).__name__}: {e}")
+            self._finish(name, exception=e, queued_at=queued_at, start_time=start_time)
+        else:
+            self._finish(name, result=result, queued_at=queued_at, start_time=start_time)
+        finally:
+            close_old_connections()
+
+    def _finish(self, name, result=None, exception=None, queued_at=None, start_time=None):
+        end_time = time.monotonic()
+        if start_time is not None:
+            self.timings[name] = {
+                'queued': start_time - queued_at,
+                'start': start_time - self.started_at,
+                'duration': end_time - start_time,
+            }
+            metrics.observe('storyapp_turn_step_queued_seconds', start_time - queued_at, step=name)
+            metrics.observe('storyapp_turn_step_seconds', end_time - start_time, step=name,
+                            result='error' if exception is not None else 'ok')
+
+        if exception is not None:
+            self.futures[name].set_exception(exception)
+        else:
+            self.futures[name].set_result(result)
+
+        with self._lock:
+            finished = all(future.done() for future in self.futures.values())
+            report = finished and not self._reported
+            self._reported = self._reported or finished
+        if report:
+            metrics.observe('storyapp_turn_pipeline_seconds', end_time - self.started_at)
+        elif not finished:
+            self._schedule_ready()
@@ -0,0 +1,229 @@
+"""Replicate predictions completed by webhook instead of polling.
+
+With REPLICATE_WEBHOOKS on, an image is requested by creating a prediction
+that reports back to `replicate_webhook` and returning at once, so no thread
+waits while the model runs. When the webhook arrives the image is downloaded
+and attached to the story or turn it was requested for.
+
+Webhooks can be lost, so `reconcile_predictions` fetches predictions still
+pending after PREDICTION_RECONCILE_AFTER seconds, completes the finished
+ones and cancels those running longer than REPLICATE_PREDICTION_TIMEOUT.
+"""
+import base64
+import hashlib
+import hmac
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import events, image_cache, limits, metrics, resilience
+from .clients import get_http_session
+from .derivatives import image_fields
+from .images import (
+    IMAGE_PRESETS, PREDICTION_DONE, build_input, build_prompt, download_images, fallback_image, replicate_client,
+    resolve_model_version,
+)
+from .models import Prediction, Story, StoryResponse
+from .pdf import prerender_turn
+from .storage import sharded_name
+
+# Field each kind of image is stored in, on Story for plots and StoryResponse otherwise
+IMAGE_FIELDS = {'plot': 'plot_image_path', 'user': 'user_img_path', 'ai': 'ai_img_path'}
+
+
+def webhook_signature(secret, webhook_id, timestamp, body):
+    """Signature of a webhook body, as Replicate computes it.
+
+    The secret is `whsec_` followed by a base64 key; the signature is the
+    base64 HMAC-SHA256 of "<webhook id>.<timestamp>.<body>".
+    """
+    key = base64.b64decode(secret.removeprefix('whsec_'))
+    signed = f"{webhook_id}.{timestamp}.".encode() + body
+    return base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+
+
+def verify_webhook(headers, body):
+    """True if a webhook carries a valid signature and a recent timestamp."""
+    webhook_id = headers.get('webhook-id')
+    timestamp = headers.get('webhook-timestamp')
+    if not settings.REPLICATE_WEBHOOK_SECRET or not webhook_id or not timestamp:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > settings.REPLICATE_WEBHOOK_TOLERANCE:
+            return False
+        expected = webhook_signature(settings.REPLICATE_WEBHOOK_SECRET, webhook_id, timestamp, body)
+    except ValueError:
+        return False
+    # The header lists space separated "v1,<signature>" entries
+    signatures = [entry.partition(',')[2] for entry in headers.get('webhook-signature', '').split()]
+    return any(hmac.compare_digest(signature, expected) for signature in signatures)
+
+
+def webhook_url():
+    return settings.REPLICATE_WEBHOOK_URL.rstrip('/') + reverse('replicate_webhook')
+
+
+def _headers():
+    return {'Authorization': f"Token {settings.REPLICATE_API_TOKEN}"}
+
+
+def create_prediction(version_id, model_input):
+    """Create a prediction that reports to the webhook when it completes; return it without waiting."""
+    client = replicate_client()
+    with limits.limit('replicate'):
+        response = get_http_session().post(
+            f"{client.base_url}/v1/predictions",
+            json={
+                'version': version_id,
+                'input': model_input,
+                'webhook': webhook_url(),
+                'webhook_events_filter': ['completed'],
+            },
+            headers=_headers(),
+            timeout=settings.REPLICATE_REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+    return response.json()
+
+
+def attach(kind, story_id, response_id, image_path):
+    """Store an image path on the story (plot images) or turn it was requested for."""
+    field = IMAGE_FIELDS[kind]
+    if not image_path:
+        print(f"Failed to generate image for {field}")
+        return
+    if response_id is None:
+        Story.objects.filter(id=story_id).update(**image_fields(field, image_path))
+    else:
+        StoryResponse.objects.filter(id=response_id).update(**image_fields(field, image_path))
+    events.publish(story_id)
+    print(f"{field} saved: {image_path}")
+    if response_id is not None:
+        prerender_turn(story_id, response_id)
+
+
+def start_prediction(kind, text, story_id, response_id=None, **fields):
+    """Request an image of the given kind without waiting for it.
+
+    Cached images, and the fallback while Replicate's breaker is open, are
+    attached at once. Otherwise a prediction is created and recorded, and
+    its image is attached by the webhook. Returns the Prediction, or None.
+    """
+    if not settings.REPLICATE_API_TOKEN:
+        print(f"Cannot generate {kind} image: REPLICATE_API_TOKEN is not set")
+        return None
+
+    preset = IMAGE_PRESETS[kind]
+    prompt = build_prompt(kind, text, **fields)
+    print(f"{preset['label']} image prompt: {prompt}")
+
+    try:
+        version = resolve_model_version()
+        model_input = build_input(kind, prompt)
+        relative_path = sharded_name(preset['directory'], f"{kind}_{uuid.uuid4().hex}.jpg")
+
+        cached = image_cache.lookup(model_input, version.id)
+        if cached is not None:
+            attach(kind, story_id, response_id, image_cache.materialize(cached, relative_path))
+            return None
+
+        # A create that may have reached Replicate is not repeated, so no
+        # duplicate prediction reports to the webhook
+        data = resilience.call_once('replicate', create_prediction, version.id, model_input)
+    except resilience.CircuitOpen as e:
+        attach(kind, story_id, response_id, fallback_image(kind, model_input, version.id, relative_path, e))
+        return None
+    except Exception as e:
+        print(f"Error starting {kind} prediction: {type(e).__name__}: {e}")
+        return None
+
+    prediction = Prediction.objects.create(
+        replicate_id=data['id'],
+        kind=kind,
+        story_id=story_id,
+        response_id=response_id,
+        version=version.id,
+        input=model_input,
+        path=relative_path,
+    )
+    print(f"Started {prediction}")
+    return prediction
+
+
+def complete_prediction(prediction, data):
+    """Attach the output of a finished prediction. Returns False if it was already handled.
+
+    The prediction is claimed with a conditional update, so a webhook and
+    the reconciliation sweep never attach the same image twice. If the
+    download fails it is released again for the next delivery or sweep.
+    """
+    succeeded = data['status'] == 'succeeded' and bool(data.get('output'))
+    claimed = Prediction.objects.filter(id=prediction.id, status=Prediction.STATUS_PENDING).update(
+        status=Prediction.STATUS_SUCCEEDED if succeeded else Prediction.STATUS_FAILED,
+        error='' if succeeded else data.get('error') or f"{data['status']} without output",
+        completed_at=timezone.now(),
+    )
+    if not claimed:
+        return False
+
+    if not succeeded:
+        print(f"Prediction {prediction.replicate_id} {data['status']}: {data.get('error')}")
+        return True
+
+    try:
+        with metrics.timer('storyapp_image_download_seconds', kind=prediction.kind):
+            relative_path = download_images(data['output'], prediction.path)[0]
+    except Exception:
+        Prediction.objects.filter(id=prediction.id).update(status=Prediction.STATUS_PENDING, completed_at=None)
+        raise
+    metrics.observe('storyapp_replicate_prediction_seconds',
+                    (timezone.now() - prediction.created_at).total_seconds(), kind=prediction.kind)
+
+    try:
+        image_cache.store(prediction.input, prediction.version, relative_path)
+    except Exception as e:
+        print(f"Error caching {prediction.kind} image: {type(e).__name__}: {e}")
+
+    attach(prediction.kind, prediction.story_id, prediction.response_id, relative_path)
+    return True
+
+
+def reconcile_predictions(older_than=None):
+    """Complete pending predictions whose webhook has not arrived.
+
+    Predictions older than `older_than` seconds (PREDICTION_RECONCILE_AFTER
+    by default) are fetched from Replicate. Finished ones are completed;
+    ones still running after REPLICATE_PREDICTION_TIMEOUT are canceled and
+    marked failed. Returns the number of predictions completed.
+    """
+    if older_than is None:
+        older_than = settings.PREDICTION_RECONCILE_AFTER
+    now = timezone.now()
+    pending = Prediction.objects.filter(
+        status=Prediction.STATUS_PENDING, created_at__lte=now - timedelta(seconds=older_than)
+    ).order_by('created_at')
+
+    base_url = replicate_client().base_url
+    session = get_http_session()
+    timeout = settings.REPLICATE_REQUEST_TIMEOUT
+    completed = 0
+    for prediction in pending:
+        url = f"{base_url}/v1/predictions/{prediction.replicate_id}"
+        try:
+            response = session.get(url, headers=_headers(), timeout=timeout)
+            response.raise_for_status()
+            data = response.json()
+            if data['status'] not in PREDICTION_DONE:
+                if (now - prediction.created_at).total_seconds() < settings.REPLICATE_PREDICTION_TIMEOUT:
+                    continue
+                session.post(f"{url}/cancel", headers=_headers(), timeout=timeout)
+                data = dict(data, status='canceled',
+                            error=f"still {data['status']} after {settings.REPLICATE_PREDICTION_TIMEOUT}s")
+            completed += complete_prediction(prediction, data)
+        except Exception as e:
+            print(f"Error reconciling {prediction}: {type(e).__name__}: {e}")
+    return completed
@@ -0,0 +1,219 @@
+"""Retries and circuit breakers for calls to OpenAI and Replicate.
+
+Failed attempts that are worth repeating (timeouts, connection errors,
+HTTP 408/429/5xx) are retried up to UPSTREAM_RETRY_ATTEMPTS times with full
+jitter exponential backoff. Requests that are not idempotent go through
+call_once, which only retries failures after which the request cannot have
+run. Every service has a circuit breaker kept in the
+default cache, so all processes sharing the cache see the same state:
+
+- closed: calls go through; BREAKER_FAILURE_THRESHOLD upstream failures
+  within BREAKER_FAILURE_WINDOW seconds open it.
+- open: calls fail at once with CircuitOpen, so callers fall back to cached
+  or placeholder content instead of waiting for timeouts.
+- half-open: BREAKER_RESET_TIMEOUT seconds after opening, one call is let
+  through as a probe; it closes the breaker on success and reopens it on
+  failure.
+"""
+import asyncio
+import random
+import time
+
+import httpx
+import openai
+import requests
+import urllib3
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+from .limits import LimitExceeded
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+
+# Values of the storyapp_circuit_breaker_state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+SERVICES = ('openai', 'replicate')
+
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class PredictionTimeout(Exception):
+    """Raised when a Replicate prediction does not finish within REPLICATE_PREDICTION_TIMEOUT."""
+
+
+def _status(error):
+    return getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def is_retryable(error):
+    """True for failures that another attempt may not hit."""
+    if isinstance(error, (TimeoutError, ConnectionError, openai.APIConnectionError, httpx.TransportError,
+                          requests.ConnectionError, requests.Timeout)):
+        return True
+    return _status(error) in RETRYABLE_STATUSES
+
+
+def is_unsent(error):
+    """True for failures after which the request cannot have run.
+
+    The connection was never made, or the service turned the request away
+    with HTTP 429, so repeating a request that is not idempotent is safe.
+    """
+    if _status(error) == 429:
+        return True
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, requests.ConnectTimeout)):
+        return True
+    # requests wraps a refused connection in a ConnectionError
+    reason = getattr(error.args[0], 'reason', None) if isinstance(error, requests.ConnectionError) and error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def is_upstream_failure(error):
+    """True for failures that count towards opening the breaker.
+
+    Rejected requests (other 4xx), failed model runs and our own limits
+    say nothing about the health of the service.
+    """
+    if isinstance(error, (LimitExceeded, CircuitOpen)):
+        return False
+    return is_retryable(error) or isinstance(error, PredictionTimeout)
+
+
+def _key(service, name):
+    return f"breaker:{service}:{name}"
+
+
+def breaker_state(service):
+    """Current state of a service's breaker: closed, half_open or open."""
+    opened_at = cache.get(_key(service, 'opened_at'))
+    if opened_at is None:
+        return CLOSED
+    if time.time() - opened_at < settings.BREAKER_RESET_TIMEOUT:
+        return OPEN
+    return HALF_OPEN
+
+
+def _before_call(service):
+    state = breaker_state(service)
+    if state == CLOSED:
+        return
+    # Only one probe at a time while half-open
+    if state == HALF_OPEN and cache.add(_key(service, 'probe'), True, timeout=settings.BREAKER_RESET_TIMEOUT):
+        print(f"Circuit breaker for {service} is half-open, probing")
+        return
+    metrics.inc('storyapp_circuit_breaker_rejections_total', service=service)
+    raise CircuitOpen(f"{service} is unavailable (circuit breaker {state})")
+
+
+def record_success(service):
+    keys = [_key(service, 'opened_at'), _key(service, 'probe'), _key(service, 'failures')]
+    found = cache.get_many(keys)
+    if not found:
+        return
+    if keys[0] in found:
+        print(f"Circuit breaker for {service} closed")
+    cache.delete_many(keys)
+
+
+def record_failure(service):
+    if breaker_state(service) != CLOSED:
+        # The probe failed; stay open for another BREAKER_RESET_TIMEOUT
+        cache.set(_key(service, 'opened_at'), time.time(), timeout=None)
+        cache.delete(_key(service, 'probe'))
+        return
+    key = _key(service, 'failures')
+    cache.add(key, 0, timeout=settings.BREAKER_FAILURE_WINDOW)
+    try:
+        failures = cache.incr(key)
+    except ValueError:
+        failures = 1
+    if failures >= settings.BREAKER_FAILURE_THRESHOLD:
+        cache.set(_key(service, 'opened_at'), time.time(), timeout=None)
+        cache.delete(key)
+        metrics.inc('storyapp_circuit_breaker_opened_total', service=service)
+        print(f"Circuit breaker for {service} opened after {failures} failures")
+
+
+def backoff(attempt):
+    """Full jitter delay before retry number `attempt` (starting at 1)."""
+    ceiling = min(settings.UPSTREAM_RETRY_MAX_DELAY, settings.UPSTREAM_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return random.uniform(0, ceiling)
+
+
+def _after_failure(service, error, attempt, retryable=is_retryable):
+    """Record a failed attempt; return the delay before retrying or re-raise."""
+    if is_upstream_failure(error):
+        record_failure(service)
+    if not retryable(error) or attempt >= settings.UPSTREAM_RETRY_ATTEMPTS or breaker_state(service) != CLOSED:
+        raise error
+    delay = backoff(attempt)
+    metrics.inc('storyapp_upstream_retries_total', service=service)
+    print(f"Retrying {service} call in {delay:.2f}s after {type(error).__name__}: {error}")
+    return delay
+
+
+def _call(service, retryable, func, args, kwargs):
+    attempt = 0
+    while True:
+        attempt += 1
+        _before_call(service)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            time.sleep(_after_failure(service, e, attempt, retryable))
+            continue
+        record_success(service)
+        return result
+
+
+async def _acall(service, retryable, func, args, kwargs):
+    # The breaker lives in the cache, whose calls block on the redis and
+    # file backends, so it is only used from worker threads
+    before_call = sync_to_async(_before_call, thread_sensitive=False)
+    after_failure = sync_to_async(_after_failure, thread_sensitive=False)
+    attempt = 0
+    while True:
+        attempt += 1
+        await before_call(service)
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            await asyncio.sleep(await after_failure(service, e, attempt, retryable))
+            continue
+        await sync_to_async(record_success, thread_sensitive=False)(service)
+        return result
+
+
+def call(service, func, *args, **kwargs):
+    """Call func with retries, behind the breaker of `service`."""
+    return _call(service, is_retryable, func, args, kwargs)
+
+
+def call_once(service, func, *args, **kwargs):
+    """Like call, but a request that may have reached the service is not repeated."""
+    return _call(service, is_unsent, func, args, kwargs)
+
+
+async def acall(service, func, *args, **kwargs):
+    """Async version of call for coroutine functions."""
+    return await _acall(service, is_retryable, func, args, kwargs)
+
+
+async def acall_once(service, func, *args, **kwargs):
+    """Async version of call_once for coroutine functions."""
+    return await _acall(service, is_unsent, func, args, kwargs)
+
+
+def breaker_states():
+    """Gauge values of the breaker of every service."""
+    return {(('service', service),): STATE_VALUES[breaker_state(service)] for service in SERVICES}
+
+
+metrics.register_gauge('storyapp_circuit_breaker_state', breaker_states)
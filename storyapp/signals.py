@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import bump_version
+from .models import Story, StoryResponse, Theme
+
+
+@receiver([post_save, post_delete], sender=Theme)
+def invalidate_themes(sender, **kwargs):
+    bump_version('themes')
+
+
+@receiver([post_save, post_delete], sender=Story)
+def invalidate_story(sender, instance, **kwargs):
+    bump_version(f'story:{instance.id}')
+
+
+@receiver([post_save, post_delete], sender=StoryResponse)
+def invalidate_story_of_response(sender, instance, **kwargs):
+    bump_version(f'story:{instance.story_id}')
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Put every new SQLite connection into WAL mode with a busy timeout."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT * 1000)}")
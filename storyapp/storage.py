@@ -0,0 +1,121 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage, storages
+
+
+def generated_storage():
+    """Storage backend for generated images and PDFs (STORAGES['generated'])."""
+    return storages['generated']
+
+
+def sharded_name(directory, filename):
+    """Name for a file two hash-based subdirectories below `directory`.
+
+    Spreading files over 65536 subdirectories keeps directory lookups fast
+    on filesystems and key listings cheap on object stores.
+    """
+    digest = hashlib.sha256(filename.encode('utf-8')).hexdigest()
+    return f"{directory}/{digest[:2]}/{digest[2:4]}/{filename}"
+
+
+def save_file(name, content):
+    """Save bytes under `name` and return the name the backend stored them as."""
+    return generated_storage().save(name, ContentFile(content))
+
+
+class PartialFile:
+    """A file in the generated storage that is written in pieces and appears only once complete.
+
+    On local disk the pieces go to a hidden temporary file next to the
+    destination, which `commit` renames into place; for other backends they
+    go to a temporary file that `commit` uploads. Leaving the `with` block
+    without committing discards what was written.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.storage = generated_storage()
+        self.local = isinstance(self.storage, FileSystemStorage)
+        directory = None
+        if self.local:
+            directory = os.path.dirname(self.storage.path(name))
+            os.makedirs(directory, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix='.', suffix='.part', delete=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        """Store the written file and return the name it was stored under."""
+        self.file.close()
+        if self.local:
+            name = self.storage.get_available_name(self.name)
+            path = self.storage.path(name)
+            os.replace(self.file.name, path)
+            if self.storage.file_permissions_mode is not None:
+                os.chmod(path, self.storage.file_permissions_mode)
+            return name
+        with open(self.file.name, 'rb') as f:
+            return self.storage.save(self.name, File(f))
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+
+def read_file(name):
+    with generated_storage().open(name, 'rb') as f:
+        return f.read()
+
+
+def file_version(name):
+    """Size and modification time of a stored file, or None if it is missing.
+
+    Caches keyed by name include this so a file rewritten in place is noticed.
+    """
+    storage = generated_storage()
+    try:
+        stat = os.stat(storage.path(name))
+        return (stat.st_size, stat.st_mtime_ns)
+    except (NotImplementedError, OSError):
+        pass
+    try:
+        return (storage.size(name), storage.get_modified_time(name).isoformat())
+    except (NotImplementedError, OSError):
+        return None
+
+
+def file_url(name):
+    return generated_storage().url(name) if name else None
+
+
+def copy_file(source, destination):
+    """Copy a stored file, as a hard link when the backend is on local disk."""
+    storage = generated_storage()
+    try:
+        source_path = storage.path(source)
+        destination_path = storage.path(destination)
+    except NotImplementedError:
+        source_path = None
+    # Some backends (InMemoryStorage) have paths without files behind them
+    if source_path is None or not os.path.exists(source_path):
+        with storage.open(source, 'rb') as f:
+            return storage.save(destination, f)
+
+    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
+    return destination
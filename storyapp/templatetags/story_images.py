@@ -0,0 +1,37 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from ..derivatives import WEB_FORMATS
+from ..storage import file_url
+
+register = template.Library()
+
+DEFAULT_SIZES = '(max-width: 768px) 100vw, 50vw'
+
+
+def srcset(sources):
+    return ', '.join(f"{file_url(path)} {width}w" for width, path in sources)
+
+
+@register.simple_tag
+def responsive_image(path, variants, alt='', css_class='', sizes=DEFAULT_SIZES):
+    """Render a generated image as a <picture> using its web derivatives.
+
+    Images without derivatives are rendered as a plain <img> of the original.
+    """
+    if not path:
+        return ''
+    src = file_url(path)
+    sources = (variants or {}).get('sources')
+    if not sources:
+        return format_html('<img src="{}" alt="{}" class="{}">', src, alt, css_class)
+
+    alternatives = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((mime, srcset(sources[name]), sizes) for name, _, mime in WEB_FORMATS if name != 'jpeg' and sources.get(name))
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" class="{}" loading="lazy"></picture>',
+        alternatives, src, srcset(sources.get('jpeg', [])), sizes,
+        variants['width'], variants['height'], alt, css_class,
+    )
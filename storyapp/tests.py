@@ -1,3 +1,1659 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import requests
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from PIL import Image
+from pypdf import PdfReader
+from django.db import connection
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import clear_url_caches, reverse
+from django.utils import timezone
+
+from . import urls as story_urls
+from . import async_views, clients, events, image_cache, images, jobs, limits, metrics, predictions, resilience, views
+from .caching import get_themes
+from .context import build_story_context, estimate_tokens, format_turn, update_story_summary
+from .finalize import resume_stalled_finalizations, start_finalization
+from .models import CachedImage, Job, Prediction, Story, StoryIntro, StoryResponse, Theme, User
+from .derivatives import ingest_image
+from .fakes import SENTENCES, FakeOpenAIServer, FakeReplicateServer, parse_latency
+from .images import generate_image, save_image
+from .intro_pool import claim_intro, fill_pool, pool_stats
+from .storage import file_url, generated_storage, sharded_name
+from .views import attach_image, create_response, generate_story_plot, get_story_with_responses, send_email
+from .pdf import fragment_dir, fragment_key, generate_pdf, prerender_turn
+from .pipeline import StepSkipped, TurnGraph
+from .templatetags.story_images import responsive_image
+
+
+class TurnGraphTests(TestCase):
+    """Turn steps run as soon as their dependencies finish, each in its pool."""
+
+    def setUp(self):
+        self.enterContext(override_settings(METRICS_DIR=''))
+        self.enterContext(mock.patch.dict(metrics._values, clear=True))
+        executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(executor.shutdown)
+        self.graph = TurnGraph('test', executor=executor)
+
+    def test_steps_wait_for_their_dependencies(self):
+        finished = []
+
+        def step(name, value):
+            def run(*args):
+                finished.append(name)
+                return (value, args)
+            return run
+
+        self.graph.add('text', step('text', 1))
+        self.graph.add('user_image', step('user_image', 2))
+        self.graph.add('save', step('save', 3), deps=['text'])
+        self.graph.add('ai_image', step('ai_image', 4), deps=['text', 'user_image'])
+        self.graph.run()
+
+        self.assertTrue(self.graph.wait(timeout=5))
+        self.assertEqual(self.graph.result('save'), (3, ((1, ()),)))
+        self.assertEqual(self.graph.result('ai_image'), (4, ((1, ()), (2, ()))))
+        self.assertLess(finished.index('text'), finished.index('save'))
+        self.assertLess(max(finished.index('text'), finished.index('user_image')), finished.index('ai_image'))
+
+    def test_failed_dependency_skips_dependents(self):
+        def fail():
+            raise ValueError('no text')
+
+        ran = []
+        self.graph.add('text', fail)
+        self.graph.add('save', lambda text: ran.append('save'), deps=['text'])
+        self.graph.add('summarize', lambda saved: ran.append('summarize'), deps=['save'])
+        self.graph.add('user_image', lambda: 'panel.jpg')
+        self.graph.run()
+
+        self.assertTrue(self.graph.wait(timeout=5))
+        with self.assertRaises(ValueError):
+            self.graph.result('text')
+        for name in ('save', 'summarize'):
+            with self.assertRaisesMessage(StepSkipped, 'dependency failed'):
+                self.graph.result(name)
+        self.assertEqual(ran, [])
+        self.assertEqual(self.graph.result('user_image'), 'panel.jpg')
+        self.assertEqual(set(self.graph.timings), {'text', 'user_image'})
+
+    def test_result_timeout_and_timings(self):
+        release = threading.Event()
+        self.graph.add('text', lambda: release.wait(5) and 'Off she goes.')
+        self.graph.run()
+
+        with self.assertRaises(TimeoutError):
+            self.graph.result('text', timeout=0.05)
+        self.assertFalse(self.graph.wait(timeout=0.01))
+        release.set()
+        self.assertEqual(self.graph.result('text', timeout=5), 'Off she goes.')
+        self.assertTrue(self.graph.wait(timeout=5))
+
+        timing = self.graph.timings['text']
+        self.assertEqual(set(timing), {'queued', 'start', 'duration'})
+        self.assertGreaterEqual(timing['duration'], 0.05)
+        rendered = metrics.render()
+        self.assertIn('storyapp_turn_step_seconds_count{result="ok",step="text"} 1', rendered)
+        self.assertIn('storyapp_turn_step_queued_seconds_count{step="text"} 1', rendered)
+        self.assertIn('storyapp_turn_pipeline_seconds_count 1', rendered)
+
+    def test_steps_run_in_their_pool(self):
+        graph = TurnGraph('pools')
+        graph.add('text', lambda: threading.current_thread().name, pool='text')
+        graph.add('image', lambda: threading.current_thread().name)
+        graph.run()
+        self.assertTrue(graph.result('text', timeout=5).startswith('turn-text'))
+        self.assertTrue(graph.result('image', timeout=5).startswith('turn-images'))
+        with self.assertRaises(ValueError):
+            graph.add('pdf', lambda: None, pool='pdf')
+
+
+class StreamStoryResponseTests(TestCase):
+    """The streamed continuation is generated once and always saved."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        user = User.objects.create(email='test@example.com')
+        theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.story = Story.objects.create(user=user, theme=theme, character_name='Nova', plot_text='Nova finds a map.', turn_count=1)
+        self.response = StoryResponse.objects.create(story=self.story, user_input='Nova opens the map', ai_response='')
+        self.url = reverse('stream_story_response', args=[self.response.id])
+        session = self.client.session
+        session['user_id'] = user.id
+        session.save()
+        for name in ('start_ai_image', 'start_summary_update', 'complete_story'):
+            setattr(self, name, self.enterContext(mock.patch(f'storyapp.views.{name}')))
+
+    def stream(self, tokens):
+        stream_ai_response = mock.Mock(return_value=iter(tokens))
+        return self.enterContext(mock.patch('storyapp.views.stream_ai_response', stream_ai_response))
+
+    def read_events(self, response):
+        return [chunk.decode() for chunk in response.streaming_content]
+
+    def test_disconnected_client_still_saves_the_whole_turn(self):
+        self.stream(['Off ', 'she ', 'goes ', 'to the stars.'])
+        response = self.client.get(self.url)
+        self.assertEqual(next(iter(response.streaming_content)).decode(), 'data: {"token": "Off "}\n\n')
+        # The browser went away after the first token; the request_finished
+        # signal must not close the test database connection
+        with mock.patch.object(connection, 'close'):
+            response.close()
+
+        self.response.refresh_from_db()
+        self.assertEqual(self.response.ai_response, 'Off she goes to the stars.')
+        self.start_ai_image.assert_called_once_with(self.story, mock.ANY, 'Off she goes to the stars.')
+        self.start_summary_update.assert_called_once_with(self.story.id)
+        self.complete_story.assert_not_called()
+
+    def test_second_connection_waits_instead_of_calling_gpt(self):
+        stream_ai_response = self.stream(['Off she goes.'])
+        first = self.read_events(self.client.get(self.url))
+        self.assertIn('event: done', first[-1])
+
+        # While the first connection holds the lock, a reconnect only waits for the saved text
+        StoryResponse.objects.filter(id=self.response.id).update(ai_response='')
+        cache.add(f"stream-response:{self.response.id}", True)
+        waiting = iter(self.client.get(self.url).streaming_content)
+        self.assertEqual(next(waiting), b': waiting\n\n')
+        StoryResponse.objects.filter(id=self.response.id).update(ai_response='Off she goes.')
+        done = json.loads(next(waiting).decode().split('data: ')[1])
+        self.assertEqual(done['ai_response'], 'Off she goes.')
+        self.assertEqual(stream_ai_response.call_count, 1)
+
+    def test_tenth_turn_completes_story(self):
+        Story.objects.filter(id=self.story.id).update(turn_count=10)
+        self.stream(['The ', 'end.'])
+        received = self.read_events(self.client.get(self.url))
+        done = json.loads(received[-1].split('data: ')[1])
+        self.assertEqual(done['redirect_url'], reverse('story_complete', args=[self.story.id]))
+        self.complete_story.assert_called_once()
+
+    @override_settings(STREAM_CLAIM_TIMEOUT=30)
+    def test_unclaimed_stream_is_generated_server_side(self):
+        with mock.patch('storyapp.views.threading.Timer') as timer:
+            views.schedule_stream_fallback(self.story, self.response)
+        self.assertEqual(timer.call_args.args[0], 30)
+        timer.return_value.start.assert_called_once()
+
+        with mock.patch('storyapp.views.generate_ai_response', return_value='Off she goes.') as generate_ai_response:
+            self.assertTrue(views.generate_unclaimed_continuation(self.story.id, self.response.id))
+            self.assertFalse(views.generate_unclaimed_continuation(self.story.id, self.response.id))
+        generate_ai_response.assert_called_once()
+        self.response.refresh_from_db()
+        self.assertEqual(self.response.ai_response, 'Off she goes.')
+        self.start_ai_image.assert_called_once()
+
+        # A browser that opens the stream late just gets the saved text
+        stream_ai_response = self.stream([])
+        done = json.loads(self.read_events(self.client.get(self.url))[-1].split('data: ')[1])
+        self.assertEqual(done['ai_response'], 'Off she goes.')
+        stream_ai_response.assert_not_called()
+
+    def test_claimed_stream_is_not_generated_server_side(self):
+        self.stream(['Off she goes.'])
+        chunks = iter(self.client.get(self.url).streaming_content)
+        next(chunks)  # the stream holds the lock from its first token
+        with mock.patch('storyapp.views.generate_ai_response') as generate_ai_response:
+            self.assertFalse(views.generate_unclaimed_continuation(self.story.id, self.response.id))
+        generate_ai_response.assert_not_called()
+        list(chunks)
+
+
+class StoryImageEventsTests(TestCase):
+    """Image readiness of a whole story, polled in one request or pushed as events."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        user = User.objects.create(email='test@example.com')
+        theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.story = Story.objects.create(user=user, theme=theme, character_name='Nova', plot_text='Nova finds a map.')
+        self.done = StoryResponse.objects.create(story=self.story, user_input='Nova flies', ai_response='Off she goes.',
+                                                 user_img_path='responses/u1.jpg', ai_img_path='responses/a1.jpg')
+        self.half = StoryResponse.objects.create(story=self.story, user_input='Nova lands', ai_response='Safe.',
+                                                 user_img_path='responses/u2.jpg')
+        self.new = StoryResponse.objects.create(story=self.story, user_input='Nova waves', ai_response='Hello!')
+        session = self.client.session
+        session['user_id'] = user.id
+        session.save()
+
+    def events(self):
+        """Parse the stream into (name, data) pairs, comments as (None, text)."""
+        for chunk in self.client.get(reverse('story_image_events', args=[self.story.id])).streaming_content:
+            chunk = chunk.decode()
+            if chunk.startswith(('retry:', ':')):
+                yield None, chunk.strip()
+            else:
+                name, data = chunk.strip().split('\n')
+                yield name.removeprefix('event: '), json.loads(data.removeprefix('data: '))
+
+    def test_status_batches_pending_images(self):
+        url = reverse('story_image_status', args=[self.story.id])
+        with self.assertNumQueries(2):  # plot image, pending responses
+            data = self.client.get(url).json()
+        self.assertEqual(data['plot_image_path'], None)
+        self.assertEqual([s['response_id'] for s in data['responses']], [self.half.id, self.new.id])
+        self.assertEqual(data['responses'][0]['user_img_url'], file_url('responses/u2.jpg'))
+        self.assertFalse(data['responses'][0]['ai_img_ready'])
+        self.assertFalse(data['complete'])
+
+        # Responses asked for by id are reported whether or not they are ready
+        data = self.client.get(url, {'responses': f'{self.done.id},x'}).json()
+        self.assertEqual([s['response_id'] for s in data['responses']], [self.done.id])
+        self.assertTrue(data['complete'])
+
+    def test_events_report_each_image_then_complete(self):
+        stream = self.events()
+        self.assertEqual(next(stream), (None, 'retry: 3000'))
+        self.assertEqual([next(stream)[1]['response_id'] for _ in range(2)], [self.half.id, self.new.id])
+
+        StoryResponse.objects.filter(id=self.half.id).update(ai_img_path='responses/a2.jpg')
+        events.publish(self.story.id)
+        name, data = next(stream)
+        self.assertEqual((name, data['response_id'], data['ai_img_ready']), ('image', self.half.id, True))
+
+        Story.objects.filter(id=self.story.id).update(plot_image_path='plots/plot.jpg')
+        StoryResponse.objects.filter(id=self.new.id).update(user_img_path='responses/u3.jpg', ai_img_path='responses/a3.jpg')
+        events.publish(self.story.id)
+        rest = list(stream)
+        self.assertEqual([name for name, data in rest], ['plot', 'image', 'complete'])
+        self.assertEqual(rest[0][1]['plot_image_path'], 'plots/plot.jpg')
+        self.assertEqual(rest[-1][1], {'story_id': self.story.id})
+
+    @override_settings(IMAGE_EVENTS_MAX_DURATION=0.3, IMAGE_EVENTS_DB_RECHECK=0.1, IMAGE_EVENTS_POLL_INTERVAL=0.05)
+    def test_events_stop_after_max_duration(self):
+        start = time.monotonic()
+        received = list(self.events())
+        self.assertLess(time.monotonic() - start, 2)
+        names = [name for name, data in received]
+        self.assertNotIn('complete', names)
+        self.assertEqual(names.count('image'), 2)
+        self.assertIn((None, ': keepalive'), received)
+
+    def test_events_require_a_session(self):
+        self.client.session.flush()
+        self.client.cookies.clear()
+        self.assertEqual(self.client.get(reverse('story_image_events', args=[self.story.id])).status_code, 403)
+
+
+def reload_urls():
+    importlib.reload(story_urls)
+    clear_url_caches()
+
+
+def use_async_views(test):
+    """Serve the app's URLs with ASYNC_VIEWS on for the rest of a test."""
+    # The views are chosen when the URLs are imported, so they are reloaded
+    # with the setting and served directly
+    test.addCleanup(reload_urls)
+    test.enterContext(override_settings(ASYNC_VIEWS=True))
+    reload_urls()
+    test.enterContext(override_settings(ROOT_URLCONF='storyapp.urls'))
+
+
+class AsyncViewTests(TestCase):
+    """The async story views behave like the sync ones."""
+
+    def setUp(self):
+        use_async_views(self)
+        self.user = User.objects.create(email='test@example.com')
+        self.theme = Theme.objects.create(name='Space', description='A space adventure')
+        session = self.async_client.session
+        session['user_id'] = self.user.id
+        session.save()
+
+    async def test_create_story_survives_intro_pool_errors(self):
+        with mock.patch('storyapp.async_views.claim_intro', side_effect=RuntimeError('database is locked')), \
+                mock.patch('storyapp.views.agenerate_story_plot', return_value='Nova sets off.') as agenerate_story_plot:
+            response = await self.async_client.post(reverse('create_story'), {'theme': self.theme.id, 'character_name': 'Nova'})
+        story = await Story.objects.aget()
+        self.assertRedirects(response, reverse('continue_story', args=[story.id]), fetch_redirect_response=False)
+        self.assertEqual((story.plot_text, story.plot_image_path), ('Nova sets off.', None))
+        agenerate_story_plot.assert_awaited_once()
+
+    @override_settings(STREAM_CONTINUATIONS=False)
+    async def test_story_and_turn_end_to_end(self):
+        openai = self.enterContext(FakeOpenAIServer(latency='0.01'))
+        replicate = self.enterContext(FakeReplicateServer(latency='0.1'))
+        self.enterContext(override_settings(
+            OPENAI_API_KEY='fake-key',
+            OPENAI_BASE_URL=f"{openai.url}/v1",
+            REPLICATE_API_TOKEN='fake-token',
+            REPLICATE_API_BASE_URL=replicate.url,
+            REPLICATE_POLL_INTERVAL=0.02,
+            IMAGE_DERIVATIVE_WIDTHS=[],
+        ))
+        self.enterContext(mock.patch.dict(clients._clients, clear=True))
+        self.enterContext(mock.patch.dict(images._versions, clear=True))
+        # Background threads cannot see this test's transaction
+        self.enterContext(mock.patch('storyapp.intro_pool.start_refill'))
+        start_summary_update = self.enterContext(mock.patch('storyapp.async_views.start_summary_update'))
+
+        response = await self.async_client.post(reverse('create_story'), {'theme': self.theme.id, 'character_name': 'Nova'})
+        story = await Story.objects.aget()
+        self.assertRedirects(response, reverse('continue_story', args=[story.id]), fetch_redirect_response=False)
+        self.assertTrue(any(story.plot_text.startswith(sentence) for sentence in SENTENCES), story.plot_text)
+        self.assertTrue(generated_storage().exists(story.plot_image_path))
+
+        url = reverse('continue_story', args=[story.id])
+        response = await self.async_client.post(url, {'user_input': 'Nova opens the map'})
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        # The panels are generated by tasks that outlive the request
+        await asyncio.wait_for(asyncio.gather(*async_views._background_tasks), timeout=10)
+
+        turn = await StoryResponse.objects.aget(story=story)
+        self.assertTrue(any(turn.ai_response.startswith(sentence) for sentence in SENTENCES), turn.ai_response)
+        for name, size in ((turn.user_img_path, (512, 512)), (turn.ai_img_path, (768, 384))):
+            with generated_storage().open(name) as f, Image.open(f) as image:
+                self.assertEqual(image.size, size)
+        self.assertEqual(openai.stats['requests'], 2)
+        self.assertEqual(len(replicate.predictions), 3)
+        self.assertEqual((await Story.objects.aget(id=story.id)).turn_count, 1)
+        start_summary_update.assert_called_once_with(story.id)
+
+
+class AsyncEventStreamTests(TestCase):
+    """With ASYNC_VIEWS the event streams send every event as soon as it is ready."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        use_async_views(self)
+        user = User.objects.create(email='test@example.com')
+        theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.story = Story.objects.create(user=user, theme=theme, character_name='Nova', plot_text='Nova finds a map.',
+                                          plot_image_path='plots/plot.jpg', turn_count=1)
+        self.response = StoryResponse.objects.create(story=self.story, user_input='Nova opens the map', ai_response='',
+                                                     user_img_path='responses/u.jpg')
+        session = self.async_client.session
+        session['user_id'] = user.id
+        session.save()
+
+    async def next_chunk(self, chunks):
+        return (await asyncio.wait_for(anext(chunks), timeout=2)).decode()
+
+    async def test_continuation_tokens_arrive_one_at_a_time(self):
+        writing = asyncio.Event()
+
+        async def tokens(story_context):
+            yield 'Off '
+            await writing.wait()  # GPT is still writing the rest
+            yield 'she goes.'
+
+        with mock.patch('storyapp.views.astream_ai_response', tokens), \
+                mock.patch('storyapp.views.start_ai_image') as start_ai_image, \
+                mock.patch('storyapp.views.start_summary_update'):
+            response = await self.async_client.get(reverse('stream_story_response', args=[self.response.id]))
+            self.assertTrue(response.is_async)
+            chunks = aiter(response.streaming_content)
+            self.assertEqual(await self.next_chunk(chunks), 'data: {"token": "Off "}\n\n')
+
+            writing.set()
+            self.assertEqual(await self.next_chunk(chunks), 'data: {"token": "she goes."}\n\n')
+            done = json.loads((await self.next_chunk(chunks)).split('data: ')[1])
+            self.assertEqual(done['ai_response'], 'Off she goes.')
+
+        ai_response = await StoryResponse.objects.values_list('ai_response', flat=True).aget(id=self.response.id)
+        self.assertEqual(ai_response, 'Off she goes.')
+        start_ai_image.assert_called_once()
+
+    @override_settings(IMAGE_EVENTS_POLL_INTERVAL=0.05)
+    async def test_image_events_arrive_as_images_land(self):
+        response = await self.async_client.get(reverse('story_image_events', args=[self.story.id]))
+        self.assertTrue(response.is_async)
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await self.next_chunk(chunks), 'retry: 3000\n\n')
+        self.assertIn('"ai_img_ready": false', await self.next_chunk(chunks))
+
+        await StoryResponse.objects.filter(id=self.response.id).aupdate(ai_img_path='responses/a.jpg')
+        events.publish(self.story.id)
+        self.assertIn('"ai_img_ready": true', await self.next_chunk(chunks))
+        self.assertEqual(await self.next_chunk(chunks), f'event: complete\ndata: {{"story_id": {self.story.id}}}\n\n')
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class StoryPageQueryTests(TestCase):
+    """The story pages run a fixed number of queries however long the story is."""
+
+    def setUp(self):
+        self.user = User.objects.create(email='test@example.com')
+        self.theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.story = Story.objects.create(
+            user=self.user,
+            theme=self.theme,
+            character_name='Nova',
+            plot_text='Nova finds a map to the stars.'
+        )
+        session = self.client.session
+        session['user_id'] = self.user.id
+        session.save()
+
+    def add_turns(self, count):
+        for i in range(count):
+            StoryResponse.objects.create(story=self.story, user_input=f'Turn {i}', ai_response=f'Reply {i}')
+        Story.objects.filter(id=self.story.id).update(turn_count=StoryResponse.objects.filter(story=self.story).count())
+
+    def test_continue_story_query_count_is_constant(self):
+        url = reverse('continue_story', args=[self.story.id])
+        self.add_turns(1)
+        with self.assertNumQueries(3):  # session, story with theme and user, responses
+            self.client.get(url)
+        self.add_turns(7)
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'Round 9 of 10')
+
+    def test_story_complete_query_count_is_constant(self):
+        url = reverse('story_complete', args=[self.story.id])
+        self.add_turns(1)
+        with self.assertNumQueries(2):  # story with theme and user, responses
+            self.client.get(url)
+        self.add_turns(9)
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertContains(response, 'test@example.com')
+
+    def test_turns_are_read_in_index_order(self):
+        plan = StoryResponse.objects.filter(story=self.story).order_by('created_at').explain()
+        self.assertIn('response_story_created_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    @override_settings(STREAM_CONTINUATIONS=True)
+    def test_continue_story_post_increments_turn_count(self):
+        url = reverse('continue_story', args=[self.story.id])
+        with mock.patch('storyapp.views.start_turn_pipeline') as start_turn_pipeline, \
+                mock.patch('storyapp.views.schedule_stream_fallback') as schedule_stream_fallback:
+            response = self.client.post(url, {'user_input': 'Nova opens the map'}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        start_turn_pipeline.assert_called_once()
+        schedule_stream_fallback.assert_called_once()
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.turn_count, 1)
+        self.assertEqual(StoryResponse.objects.get(id=response.json()['response_id']).user_input, 'Nova opens the map')
+
+    @override_settings(STREAM_CONTINUATIONS=False)
+    def test_tenth_turn_completes_story(self):
+        self.add_turns(9)
+        url = reverse('continue_story', args=[self.story.id])
+        graph = mock.Mock()
+        graph.result.return_value = 'The end.'
+        with mock.patch('storyapp.views.start_turn_pipeline', return_value=graph), \
+                mock.patch('storyapp.views.complete_story') as complete_story:
+            response = self.client.post(url, {'user_input': 'Nova flies home'})
+        self.assertRedirects(response, reverse('story_complete', args=[self.story.id]), fetch_redirect_response=False)
+        complete_story.assert_called_once()
+
+    @override_settings(STREAM_CONTINUATIONS=False, TURN_TEXT_TIMEOUT=0.01)
+    def test_slow_continuation_does_not_hold_the_request(self):
+        url = reverse('continue_story', args=[self.story.id])
+        graph = mock.Mock()
+        graph.result.side_effect = TimeoutError
+        with mock.patch('storyapp.views.start_turn_pipeline', return_value=graph):
+            response = self.client.post(url, {'user_input': 'Nova waits'})
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        graph.result.assert_called_once_with('save_ai_response', timeout=0.01)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class PageCacheTests(TestCase):
+    """Completed story pages and the theme list are cached until written to."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='test@example.com')
+        self.theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.story = Story.objects.create(
+            user=self.user,
+            theme=self.theme,
+            character_name='Nova',
+            plot_text='Nova finds a map to the stars.',
+            finalize_status=Story.FINALIZE_DONE,
+        )
+
+    def test_completed_story_page_is_cached(self):
+        url = reverse('story_complete', args=[self.story.id])
+        first = self.client.get(url)
+        self.assertTrue(first.has_header('ETag'))
+        self.assertTrue(first.has_header('Last-Modified'))
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(second.content, first.content)
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Writing to the story invalidates the cached page
+        self.story.character_name = 'Vega'
+        self.story.save()
+        self.assertContains(self.client.get(url), 'Vega')
+
+    def test_unfinished_story_page_is_not_cached(self):
+        Story.objects.filter(id=self.story.id).update(finalize_status=Story.FINALIZE_WAITING)
+        response = self.client.get(reverse('story_complete', args=[self.story.id]))
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_theme_list_is_invalidated_on_save(self):
+        self.assertEqual([theme.name for theme in get_themes()], ['Space'])
+        with self.assertNumQueries(0):
+            get_themes()
+        Theme.objects.create(name='Ocean', description='An undersea adventure')
+        self.assertEqual([theme.name for theme in get_themes()], ['Space', 'Ocean'])
+
+
+class ConcurrentWriteTests(TransactionTestCase):
+    """Background image writes and turn posts running at once lose no updates."""
+
+    THREADS = 8
+    TURNS = 40
+
+    def test_concurrent_writes(self):
+        self.assertEqual(connection.cursor().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        story = Story.objects.create(
+            user=User.objects.create(email='test@example.com'),
+            theme=Theme.objects.create(name='Space', description='A space adventure'),
+            character_name='Nova',
+            plot_text='Nova finds a map to the stars.'
+        )
+        response_ids = [create_response(story, f'Turn {i}').id for i in range(self.TURNS)]
+
+        def write(task):
+            try:
+                kind, value = task
+                if kind == 'turn':
+                    create_response(Story.objects.get(id=story.id), value)
+                else:
+                    attach_image(story.id, value, kind)(f'{kind}/{value}.jpg')
+            finally:
+                connection.close()
+
+        tasks = [('turn', f'Extra {i}') for i in range(self.TURNS)]
+        for response_id in response_ids:
+            tasks += [('user_img_path', response_id), ('ai_img_path', response_id)]
+        with mock.patch('storyapp.derivatives.ingest_image', return_value={}), \
+                mock.patch('storyapp.views.prerender_turn'), \
+                ThreadPoolExecutor(max_workers=self.THREADS) as executor:
+            list(executor.map(write, tasks))  # Re-raises any "database is locked"
+
+        story.refresh_from_db()
+        self.assertEqual(story.turn_count, 2 * self.TURNS)
+        self.assertEqual(StoryResponse.objects.filter(story=story).count(), 2 * self.TURNS)
+        for response in StoryResponse.objects.filter(id__in=response_ids):
+            self.assertEqual(response.user_img_path, f'user_img_path/{response.id}.jpg')
+            self.assertEqual(response.ai_img_path, f'ai_img_path/{response.id}.jpg')
+
+
+@override_settings(JOB_MAX_ATTEMPTS=3, JOB_RETRY_DELAY=10)
+class JobQueueTests(TransactionTestCase):
+    """Jobs are claimed by one worker at a time, retried with backoff and never finished twice."""
+
+    def setUp(self):
+        self.story = Story.objects.create(
+            user=User.objects.create(email='test@example.com'),
+            theme=Theme.objects.create(name='Space', description='A space adventure'),
+            character_name='Nova',
+            plot_text='Nova finds a map to the stars.'
+        )
+        self.handler = mock.Mock()
+        self.enterContext(mock.patch.dict(jobs.HANDLERS, {Job.KIND_PLOT_IMAGE: self.handler}))
+
+    def enqueue(self, count=1):
+        return [jobs.enqueue(Job.KIND_PLOT_IMAGE, story=self.story) for _ in range(count)]
+
+    def test_concurrent_claimers_never_share_a_job(self):
+        self.enqueue(30)
+
+        def claim(worker):
+            try:
+                claimed = []
+                while True:
+                    batch = jobs.claim_jobs(worker, 3, lease_seconds=60)
+                    if not batch:
+                        return claimed
+                    claimed += [job.id for job in batch]
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(claim, ['a', 'b', 'c', 'd']))
+        claimed = [job_id for result in results for job_id in result]
+        self.assertEqual(len(claimed), 30)
+        self.assertEqual(len(set(claimed)), 30)
+        self.assertFalse(Job.objects.exclude(status=Job.STATUS_RUNNING).exists())
+
+    def test_expired_lease_is_reclaimed(self):
+        self.enqueue()
+        job, = jobs.claim_jobs('a', 1, lease_seconds=60)
+        self.assertEqual(jobs.claim_jobs('b', 1, lease_seconds=60), [])
+
+        Job.objects.filter(id=job.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        reclaimed, = jobs.claim_jobs('b', 1, lease_seconds=60)
+        self.assertEqual((reclaimed.id, reclaimed.worker, reclaimed.attempts), (job.id, 'b', 2))
+
+    def test_expired_lease_on_the_last_attempt_fails_the_job(self):
+        job, = self.enqueue()
+        Job.objects.filter(id=job.id).update(
+            status=Job.STATUS_RUNNING, attempts=3, lease_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(jobs.claim_jobs('b', 1, lease_seconds=60), [])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), (Job.STATUS_FAILED, 3, 'lease expired on attempt 3'))
+
+    def test_deferred_jobs_keep_their_attempts(self):
+        self.enqueue()
+        self.handler.side_effect = jobs.JobDeferred(30)
+        job, = jobs.claim_jobs('a', 1, lease_seconds=60)
+        self.assertIsNone(jobs.run_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_PENDING, 0))
+        self.assertAlmostEqual((job.run_after - timezone.now()).total_seconds(), 30, delta=2)
+
+    def test_failures_back_off_until_max_attempts(self):
+        job, = self.enqueue()
+        self.handler.side_effect = jobs.JobError('no image')
+        for attempt, delay in [(1, 10), (2, 20)]:
+            Job.objects.filter(id=job.id).update(run_after=timezone.now())
+            claimed, = jobs.claim_jobs('a', 1, lease_seconds=60)
+            self.assertFalse(jobs.run_job(claimed))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts, job.last_error), (Job.STATUS_PENDING, attempt, 'JobError: no image'))
+            self.assertAlmostEqual((job.run_after - timezone.now()).total_seconds(), delay, delta=2)
+
+        Job.objects.filter(id=job.id).update(run_after=timezone.now())
+        claimed, = jobs.claim_jobs('a', 1, lease_seconds=60)
+        jobs.run_job(claimed)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_FAILED, 3))
+        self.assertEqual(jobs.claim_jobs('a', 1, lease_seconds=60), [])
+
+    def test_worker_that_lost_its_lease_cannot_overwrite_the_new_owner(self):
+        self.enqueue()
+        stale, = jobs.claim_jobs('a', 1, lease_seconds=60)
+        Job.objects.filter(id=stale.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        owner, = jobs.claim_jobs('b', 1, lease_seconds=60)
+
+        # The old claim finishing or renewing changes nothing
+        self.assertFalse(jobs.extend_lease(stale, 60))
+        self.assertTrue(jobs.run_job(stale))
+        job = Job.objects.get(id=owner.id)
+        self.assertEqual((job.status, job.worker, job.attempts), (Job.STATUS_RUNNING, 'b', 2))
+
+        self.assertTrue(jobs.extend_lease(owner, 60))
+        self.handler.side_effect = jobs.JobError('no image')
+        jobs.run_job(owner)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), (Job.STATUS_PENDING, 'JobError: no image'))
+
+    def test_run_worker_drains_the_queue(self):
+        self.enqueue(5)
+        with mock.patch('signal.signal'):  # Keep the test runner's SIGTERM handler
+            call_command('run_worker', '--once', '--concurrency', '2', '--poll-interval', '0.01', stdout=StringIO())
+        self.assertEqual(self.handler.call_count, 5)
+        self.assertEqual(Job.objects.filter(status=Job.STATUS_DONE).count(), 5)
+
+    def test_run_worker_reports_deferred_jobs(self):
+        self.enqueue()
+        self.handler.side_effect = jobs.JobDeferred(30)
+        stdout = StringIO()
+        with mock.patch('signal.signal'):
+            call_command('run_worker', '--once', '--poll-interval', '0.01', stdout=stdout)
+        self.assertIn('deferred', stdout.getvalue())
+        self.assertNotIn('failed', stdout.getvalue())
+
+
+@override_settings(OPENAI_API_KEY='', STORY_CONTEXT_RECENT_TURNS=3, STORY_CONTEXT_TOKEN_BUDGET=600,
+                   STORY_SUMMARY_MAX_WORDS=60)
+class StoryContextTests(TestCase):
+    """The GPT context keeps the last turns verbatim and a bounded summary of the rest."""
+
+    def setUp(self):
+        self.story = Story.objects.create(
+            user=User.objects.create(email='test@example.com'),
+            theme=Theme.objects.create(name='Space', description='A space adventure'),
+            character_name='Nova',
+            plot_text='Nova finds a map to the stars.'
+        )
+
+    def add_turn(self, i):
+        return StoryResponse.objects.create(
+            story=self.story,
+            user_input=f"Nova takes step {i}.",
+            ai_response=f"Turn {i} begins as the ship drifts on. " + ' '.join(SENTENCES) * 2,
+        )
+
+    def context(self):
+        story, responses = get_story_with_responses(self.story.id)
+        return build_story_context(story, responses, 'What happens next?')
+
+    def test_context_stays_within_budget(self):
+        sizes = []
+        for i in range(12):
+            self.add_turn(i)
+            update_story_summary(self.story.id)
+            story_context = self.context()
+            self.assertLessEqual(estimate_tokens(story_context), 600)
+            sizes.append(estimate_tokens(story_context))
+        # Flat once the summary has reached its word limit, although all turns
+        # together are far over the budget
+        self.assertLess(max(sizes[6:]) - min(sizes[6:]), 60)
+        all_turns = ''.join(format_turn(response) for response in StoryResponse.objects.filter(story=self.story))
+        self.assertGreater(estimate_tokens(all_turns), 3 * 600)
+
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.summarized_turns, 9)
+        self.assertLessEqual(len(self.story.context_summary.split()), 60)
+        self.assertIn(f"Story so far: {self.story.context_summary}", story_context)
+
+    def test_only_recent_turns_are_verbatim(self):
+        responses = [self.add_turn(i) for i in range(10)]
+        update_story_summary(self.story.id)
+        story_context = self.context()
+        for response in responses[-3:]:
+            self.assertIn(format_turn(response), story_context)
+        for response in responses[:-3]:
+            self.assertNotIn(response.user_input, story_context)
+
+    def test_unsummarized_turns_are_dropped_oldest_first(self):
+        responses = [self.add_turn(i) for i in range(12)]
+        story_context = self.context()
+        self.assertLessEqual(estimate_tokens(story_context), 600)
+        self.assertIn(format_turn(responses[-1]), story_context)
+        self.assertNotIn(responses[0].user_input, story_context)
+
+    def test_stale_summary_update_is_refused(self):
+        for i in range(5):
+            self.add_turn(i)
+
+        def concurrent_update(previous_summary, responses):
+            # Another process folds the same turns in while this one summarizes
+            Story.objects.filter(id=self.story.id).update(context_summary='Newer summary.', summarized_turns=2)
+            return 'Stale summary.'
+
+        with mock.patch('storyapp.context.summarize_turns', side_effect=concurrent_update):
+            self.assertFalse(update_story_summary(self.story.id))
+        self.story.refresh_from_db()
+        self.assertEqual((self.story.context_summary, self.story.summarized_turns), ('Newer summary.', 2))
+        self.assertFalse(update_story_summary(self.story.id))
+
+
+class StoryFinalizationTests(TestCase):
+    """The PDF is built in the background once the story's images are attached."""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.media_root = media_root.name
+        self.enterContext(override_settings(
+            MEDIA_ROOT=self.media_root, RENDER_CACHE_DIR=os.path.join(self.media_root, 'render')
+        ))
+        self.enterContext(mock.patch.dict('storyapp.pdf._source_hashes', clear=True))
+        user = User.objects.create(email='test@example.com')
+        theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.story = Story.objects.create(user=user, theme=theme, character_name='Nova', plot_text='Nova finds a map.')
+        self.response = StoryResponse.objects.create(story=self.story, user_input='Nova flies', ai_response='Off she goes.')
+
+    def test_generate_pdf_without_images(self):
+        pdf_path = generate_pdf(self.story)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, pdf_path)))
+
+    def test_generate_pdf_without_pypdf(self):
+        with mock.patch('storyapp.pdf.PdfWriter', None):
+            pdf_path = generate_pdf(self.story)
+        self.assertEqual(len(PdfReader(os.path.join(self.media_root, pdf_path)).pages), 2)
+
+    def test_pdf_reuses_page_fragments(self):
+        os.makedirs(os.path.join(self.media_root, 'responses'))
+        Image.new('RGB', (64, 64), 'blue').save(os.path.join(self.media_root, 'responses', 'panel.jpg'))
+        second = StoryResponse.objects.create(story=self.story, user_input='Nova lands', ai_response='Safe.')
+        StoryResponse.objects.filter(story=self.story).update(
+            user_img_path='responses/panel.jpg', ai_img_path='responses/panel.jpg'
+        )
+
+        prerender_turn(self.story.id, second.id)
+        fragments = set(os.listdir(fragment_dir(self.story.id)))
+        self.assertEqual(len(fragments), 1)
+
+        pdf_path = generate_pdf(self.story)
+        self.assertEqual(len(PdfReader(os.path.join(self.media_root, pdf_path)).pages), 2)
+        self.assertEqual(len(set(os.listdir(fragment_dir(self.story.id))) - fragments), 1)  # the title page
+
+        # Changing one turn only replaces the fragment of its page
+        before = set(os.listdir(fragment_dir(self.story.id)))
+        StoryResponse.objects.filter(id=second.id).update(ai_response='Safe and sound.')
+        generate_pdf(self.story)
+        after = set(os.listdir(fragment_dir(self.story.id)))
+        self.assertEqual(len(before & after), 1)
+        self.assertEqual(len(after), 2)
+
+    def test_regenerated_image_replaces_its_fragment(self):
+        os.makedirs(os.path.join(self.media_root, 'plots'))
+        path = os.path.join(self.media_root, 'plots', 'plot.jpg')
+        Image.new('RGB', (64, 64), 'blue').save(path)
+        Story.objects.filter(id=self.story.id).update(plot_image_path='plots/plot.jpg')
+        self.story.refresh_from_db()
+        before = fragment_key(self.story)
+        generate_pdf(self.story)
+
+        # Same name, new picture
+        Image.new('RGB', (96, 96), 'red').save(path)
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        self.assertNotEqual(fragment_key(self.story), before)
+        generate_pdf(self.story)
+        variants = [name for _, _, names in os.walk(os.path.join(self.media_root, 'render', 'images')) for name in names]
+        self.assertEqual(len(variants), 2)
+
+    def test_pdf_embeds_downscaled_images(self):
+        os.makedirs(os.path.join(self.media_root, 'plots'))
+        Image.effect_noise((768, 384), 64).convert('RGB').save(os.path.join(self.media_root, 'plots', 'plot.jpg'), quality=95)
+        Story.objects.filter(id=self.story.id).update(plot_image_path='plots/plot.jpg')
+        self.story.refresh_from_db()
+
+        with override_settings(PDF_IMAGE_DPI=0):
+            original = os.path.getsize(os.path.join(self.media_root, generate_pdf(self.story)))
+        downscaled = os.path.getsize(os.path.join(self.media_root, generate_pdf(self.story)))
+        self.assertLess(downscaled, original)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'render', 'images'))), 1)
+
+    @override_settings(IMAGE_JOBS_DURABLE=True)
+    def test_finalize_job_waits_for_images(self):
+        self.assertTrue(start_finalization(self.story))
+        self.assertFalse(start_finalization(self.story))
+        job = Job.objects.get(kind=Job.KIND_FINALIZE_STORY)
+
+        # Images are still missing, so the job goes back to the queue
+        [job] = jobs.claim_jobs('test', 1, 60)
+        self.assertFalse(jobs.run_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_PENDING, 0))
+        self.assertEqual(mail.outbox, [])
+
+        Story.objects.filter(id=self.story.id).update(plot_image_path='plots/plot.jpg')
+        StoryResponse.objects.filter(id=self.response.id).update(user_img_path='responses/u.jpg', ai_img_path='responses/a.jpg')
+        Job.objects.filter(id=job.id).update(run_after=job.created_at)
+        [job] = jobs.claim_jobs('test', 1, 60)
+        self.assertTrue(jobs.run_job(job))
+
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.finalize_status, Story.FINALIZE_DONE)
+        self.assertTrue(self.story.email_sent)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(STORY_FINALIZE_TIMEOUT=180, STORY_FINALIZE_STALE_AFTER=600)
+    def test_sweep_resumes_interrupted_finalization(self):
+        # A process restarted mid-render left the story rendering
+        Story.objects.filter(id=self.story.id).update(
+            finalize_status=Story.FINALIZE_RENDERING, finalize_requested_at=timezone.now() - timedelta(seconds=600)
+        )
+        self.assertEqual(resume_stalled_finalizations(), [])
+
+        Story.objects.filter(id=self.story.id).update(finalize_requested_at=timezone.now() - timedelta(seconds=900))
+        fresh = Story.objects.create(user=self.story.user, theme=self.story.theme, character_name='Ray',
+                                     finalize_status=Story.FINALIZE_WAITING, finalize_requested_at=timezone.now())
+        call_command('resume_finalizations', stdout=StringIO())
+
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.finalize_status, Story.FINALIZE_DONE)
+        self.assertEqual(len(mail.outbox), 1)
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.finalize_status, Story.FINALIZE_WAITING)
+        self.assertEqual(resume_stalled_finalizations(), [])
+
+    @override_settings(IMAGE_JOBS_DURABLE=True)
+    def test_sweep_requeues_stalled_durable_finalization(self):
+        Story.objects.filter(id=self.story.id).update(
+            finalize_status=Story.FINALIZE_WAITING, finalize_requested_at=timezone.now() - timedelta(days=1)
+        )
+        self.assertEqual(resume_stalled_finalizations(), [self.story.id])
+        self.assertEqual(Job.objects.filter(kind=Job.KIND_FINALIZE_STORY, story=self.story).count(), 1)
+
+        # The deadline moved to now, so the job renders without waiting
+        [job] = jobs.claim_jobs('test', 1, 60)
+        self.assertTrue(jobs.run_job(job))
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.finalize_status, Story.FINALIZE_DONE)
+
+
+class WebImageTests(TestCase):
+    """Generated images get smaller web versions for srcset."""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.media_root = media_root.name
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root, IMAGE_DERIVATIVE_WIDTHS=[256, 512]))
+        os.makedirs(os.path.join(self.media_root, 'plots'))
+        Image.new('RGB', (768, 384), 'green').save(os.path.join(self.media_root, 'plots', 'plot.jpg'))
+
+    def test_ingest_writes_derivatives(self):
+        variants = ingest_image('plots/plot.jpg')
+        self.assertEqual((variants['width'], variants['height']), (768, 384))
+        self.assertEqual(variants['sources']['jpeg'], [
+            [256, 'plots/plot_256w.jpg'], [512, 'plots/plot_512w.jpg'], [768, 'plots/plot.jpg']
+        ])
+        self.assertEqual([width for width, path in variants['sources']['webp']], [256, 512, 768])
+        for sources in variants['sources'].values():
+            for width, path in sources:
+                with Image.open(os.path.join(self.media_root, path)) as image:
+                    self.assertEqual(image.width, width)
+
+        html = responsive_image('plots/plot.jpg', variants, 'Plot')
+        self.assertIn('<source type="image/webp" srcset="/media/plots/plot_256w.webp 256w', html)
+        self.assertIn('srcset="/media/plots/plot_256w.jpg 256w, /media/plots/plot_512w.jpg 512w, /media/plots/plot.jpg 768w"', html)
+
+    def test_image_without_derivatives(self):
+        self.assertEqual(ingest_image('plots/missing.jpg'), {})
+        self.assertEqual(responsive_image('plots/plot.jpg', {}, 'Plot'), '<img src="/media/plots/plot.jpg" alt="Plot" class="">')
+
+
+@override_settings(IMAGE_CACHE_ENABLED=True, IMAGE_CACHE_SIMILARITY=0, IMAGE_CACHE_MAX_BYTES=10 ** 9)
+class ImageCacheTests(TestCase):
+    """Generated images are reused for identical or similar inputs and evicted least recently used first."""
+
+    VERSION = 'v1'
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.enterContext(mock.patch.dict(image_cache._stats, {name: 0 for name in image_cache._stats}))
+
+    def model_input(self, text):
+        return images.build_input('ai', images.build_prompt('ai', text))
+
+    def add(self, text):
+        content = BytesIO()
+        Image.new('RGB', (8, 8), 'white').save(content, 'JPEG')
+        name = save_image(sharded_name('responses', f"ai_{len(text)}_{time.monotonic_ns()}.jpg"), content.getvalue())
+        return image_cache.store(self.model_input(text), self.VERSION, name)
+
+    def test_exact_hits_ignore_case_and_spacing(self):
+        entry = self.add('The ship lands on the moon')
+        self.assertEqual(image_cache.lookup(self.model_input('the ship  lands on the MOON!'), self.VERSION), entry)
+        self.assertIsNone(image_cache.lookup(self.model_input('The ship lands on the moon'), 'v2'))
+        self.assertIsNone(image_cache.lookup(self.model_input('The ship leaves the moon'), self.VERSION))
+        self.assertEqual(image_cache.cache_stats(), {
+            'hits': 1, 'similar_hits': 0, 'misses': 2, 'stores': 1, 'evictions': 0,
+        })
+        entry.refresh_from_db()
+        self.assertEqual(entry.hits, 1)
+
+    def test_similarity_threshold(self):
+        entry = self.add('The ship lands on the moon at night')
+        similar = self.model_input('The ship lands on the moon at dawn')
+        score = image_cache._similarity(image_cache.normalize_prompt(similar['prompt']), entry.prompt)
+        self.assertTrue(0 < score < 1)
+        with override_settings(IMAGE_CACHE_SIMILARITY=score + 0.01):
+            self.assertIsNone(image_cache.lookup(similar, self.VERSION))
+        with override_settings(IMAGE_CACHE_SIMILARITY=score - 0.01):
+            self.assertEqual(image_cache.lookup(similar, self.VERSION), entry)
+        self.assertEqual((image_cache.cache_stats()['similar_hits'], image_cache.cache_stats()['misses']), (1, 1))
+
+    def test_lru_eviction_deletes_rows_and_files(self):
+        oldest, used, newest = self.add('A red door'), self.add('A blue door'), self.add('A green door')
+        image_cache.lookup(self.model_input('A red door'), self.VERSION)  # Now the most recently used
+        self.assertEqual(image_cache.evict(max_bytes=oldest.size + newest.size), 1)
+        self.assertFalse(CachedImage.objects.filter(id=used.id).exists())
+        self.assertFalse(generated_storage().exists(used.path))
+        for entry in (oldest, newest):
+            self.assertTrue(generated_storage().exists(entry.path))
+        self.assertEqual(image_cache.cache_stats()['evictions'], 1)
+
+        # Storing past IMAGE_CACHE_MAX_BYTES evicts on its own
+        with override_settings(IMAGE_CACHE_MAX_BYTES=newest.size):
+            latest = self.add('A black door')
+        self.assertEqual(list(CachedImage.objects.values_list('id', flat=True)), [latest.id])
+        for entry in (oldest, newest):
+            self.assertFalse(generated_storage().exists(entry.path))
+
+
+@override_settings(STORAGES={
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'generated': {'BACKEND': 'django.core.files.storage.InMemoryStorage', 'OPTIONS': {'base_url': 'https://assets.example.com/'}},
+})
+class GeneratedStorageTests(TestCase):
+    """Generated assets only go through the storage API, so any backend works."""
+
+    def setUp(self):
+        render_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(render_dir.cleanup)
+        self.enterContext(override_settings(RENDER_CACHE_DIR=render_dir.name, IMAGE_DERIVATIVE_WIDTHS=[256]))
+        user = User.objects.create(email='test@example.com')
+        theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.story = Story.objects.create(user=user, theme=theme, character_name='Nova', plot_text='Nova finds a map.')
+
+    def test_sharded_names(self):
+        name = sharded_name('responses', 'user_abc.jpg')
+        self.assertRegex(name, r'^responses/[0-9a-f]{2}/[0-9a-f]{2}/user_abc\.jpg$')
+        self.assertEqual(name, sharded_name('responses', 'user_abc.jpg'))
+
+    def test_story_assets_without_local_files(self):
+        buffer = tempfile.SpooledTemporaryFile()
+        Image.new('RGB', (512, 512), 'red').save(buffer, 'JPEG')
+        buffer.seek(0)
+        name = save_image(sharded_name('responses', 'user_abc.jpg'), buffer.read())
+        self.assertTrue(generated_storage().exists(name))
+
+        variants = ingest_image(name)
+        self.assertEqual(variants['sources']['jpeg'][0][0], 256)
+        self.assertIn('https://assets.example.com/responses/', responsive_image(name, variants))
+
+        StoryResponse.objects.create(
+            story=self.story, user_input='Nova flies', ai_response='Off she goes.', user_img_path=name, ai_img_path=name
+        )
+        pdf_path = generate_pdf(self.story)
+        self.assertTrue(pdf_path.startswith('pdfs/'))
+        self.assertTrue(send_email(self.story))
+        self.assertEqual(len(mail.outbox[0].attachments), 1)
+
+
+@override_settings(STORAGES={
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'generated': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+})
+class FakeServiceTests(TestCase):
+    """GPT and image generation run end to end against the local fake APIs."""
+
+    def setUp(self):
+        self.openai = self.enterContext(FakeOpenAIServer(latency='0.01'))
+        self.replicate = self.enterContext(FakeReplicateServer(latency='0.1'))
+        self.enterContext(override_settings(
+            OPENAI_API_KEY='fake-key',
+            OPENAI_BASE_URL=f"{self.openai.url}/v1",
+            REPLICATE_API_TOKEN='fake-token',
+            REPLICATE_API_BASE_URL=self.replicate.url,
+            REPLICATE_POLL_INTERVAL=0.02,
+            IMAGE_DERIVATIVE_WIDTHS=[],
+        ))
+        self.enterContext(mock.patch.dict(clients._clients, clear=True))
+        self.enterContext(mock.patch.dict(images._versions, clear=True))
+
+    def test_story_text(self):
+        plot = generate_story_plot('A space adventure', 'Nova')
+        self.assertTrue(any(plot.startswith(sentence) for sentence in SENTENCES), plot)
+        self.assertEqual(self.openai.stats['requests'], 1)
+
+    def test_image(self):
+        name = generate_image('user', 'Nova opens the map', character_name='Nova')
+        with generated_storage().open(name) as f, Image.open(f) as image:
+            self.assertEqual(image.size, (512, 512))
+        self.assertEqual(self.replicate.stats['failures'], 0)
+
+    def test_injected_failures(self):
+        self.replicate.failure_rate = 1.0
+        self.assertIsNone(generate_image('ai', 'The map glows'))
+        self.assertEqual(self.replicate.stats['failures'], 1)
+
+    def test_downloads_stream_to_storage_over_kept_alive_connections(self):
+        # InMemoryStorage is not safe for the parallel downloads, so use a real directory
+        media_root = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(
+            MEDIA_ROOT=media_root, STORAGES=settings.STORAGES | {'generated': settings.STORAGES['default']},
+        ))
+        urls = [f"{self.replicate.url}/files/64x32/a.jpg", f"{self.replicate.url}/files/64x32/b.jpg"]
+        names = images.download_images(urls, sharded_name('responses', 'user_pair.jpg'))
+        self.assertEqual(len(names), 2)
+        for name in names:
+            with generated_storage().open(name) as f, Image.open(f) as image:
+                self.assertEqual(image.size, (64, 32))
+        connections = self.replicate.stats['connections']
+        images.download_image(urls[0], sharded_name('responses', 'user_again.jpg'))
+        self.assertEqual(self.replicate.stats['connections'], connections)
+
+    def test_interrupted_download_leaves_no_file(self):
+        def broken_body(response, chunk_size):
+            yield b'\xff\xd8'
+            raise requests.ConnectionError('Connection reset')
+
+        name = sharded_name('responses', 'user_broken.jpg')
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root, STORAGES=settings.STORAGES | {'generated': settings.STORAGES['default']},
+        ):
+            with mock.patch.object(requests.Response, 'iter_content', broken_body), \
+                    self.assertRaises(requests.ConnectionError):
+                images.download_image(f"{self.replicate.url}/files/64x32/a.jpg", name)
+            self.assertEqual(os.listdir(os.path.dirname(generated_storage().path(name))), [])
+
+    def test_model_version_is_cached_and_reused_when_lookup_fails(self):
+        def expire():
+            for key, (version, expires_at) in images._versions.items():
+                images._versions[key] = (version, 0)
+
+        with override_settings(REPLICATE_VERSION_CACHE_TTL=60):
+            version = images.resolve_model_version()
+            self.assertEqual(version.id, FakeReplicateServer.VERSION_ID)
+            self.assertIs(images.resolve_model_version(), version)
+            self.assertEqual(self.replicate.stats['requests'], 1)
+
+            # Once the TTL has passed the version is looked up again...
+            expire()
+            images.resolve_model_version()
+            self.assertEqual(self.replicate.stats['requests'], 2)
+
+            # ...and the known version is kept while Replicate cannot be reached
+            expire()
+            unreachable = mock.Mock()
+            unreachable.models.get.side_effect = httpx.ConnectError('Connection refused')
+            with mock.patch('storyapp.images.replicate_client', return_value=unreachable):
+                self.assertEqual(images.resolve_model_version().id, FakeReplicateServer.VERSION_ID)
+                images._versions.clear()
+                with self.assertRaises(httpx.ConnectError):
+                    images.resolve_model_version()
+
+    def test_latency_specs(self):
+        self.assertEqual(parse_latency('0.5')(), 0.5)
+        self.assertTrue(0.2 <= parse_latency('uniform:0.2,0.4')() <= 0.4)
+        self.assertGreater(parse_latency('lognormal:1,0.5')(), 0)
+        with self.assertRaises(ValueError):
+            parse_latency('gamma:1,2')
+
+
+@override_settings(ALLOWED_HOSTS=['*'], OPENAI_HEALTH_TTL=60, OPENAI_HEALTH_TIMEOUT=1, OPENAI_HEALTH_PROBE_INTERVAL=0)
+class OpenAIHealthTests(TestCase):
+    """The health probe is cached for the readiness endpoint and never blocks story requests."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.openai = self.enterContext(FakeOpenAIServer(latency='0'))
+        self.enterContext(override_settings(OPENAI_API_KEY='fake-key', OPENAI_BASE_URL=f"{self.openai.url}/v1"))
+        self.enterContext(mock.patch.dict(clients._clients, clear=True))
+        self.enterContext(mock.patch.dict(clients._health, ok=None, checked_at=0.0, error=None, latency=None))
+
+    def test_probe_result_is_cached(self):
+        self.assertFalse(clients.openai_health()['fresh'])
+        status = clients.refresh_openai_health()
+        self.assertTrue(status['ok'] and status['fresh'])
+        self.assertEqual(self.openai.stats['requests'], 1)
+        clients.refresh_openai_health()
+        self.assertEqual(self.openai.stats['requests'], 1)
+        clients.refresh_openai_health(force=True)
+        self.assertEqual(self.openai.stats['requests'], 2)
+        with override_settings(OPENAI_HEALTH_TTL=0):
+            self.assertFalse(clients.openai_health()['fresh'])
+
+    def test_failed_probe_does_not_disable_stories(self):
+        clients._health.update(ok=False, checked_at=time.monotonic(), error='APITimeoutError')
+        self.assertIsNotNone(clients.get_openai_client())
+        plot = generate_story_plot('A space adventure', 'Nova')
+        self.assertTrue(any(plot.startswith(sentence) for sentence in SENTENCES), plot)
+
+    def test_readiness(self):
+        response = self.client.get(reverse('readiness'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['openai']['ok'])
+
+        # A fresh result is reused until it expires or a probe is forced
+        with override_settings(OPENAI_BASE_URL='http://127.0.0.1:9/v1'), \
+                mock.patch.dict(clients._clients, clear=True):
+            self.assertEqual(self.client.get(reverse('readiness')).status_code, 200)
+            response = self.client.get(reverse('readiness'), {'force': '1'})
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()['ready'])
+        self.assertIn('APIConnectionError', response.json()['openai']['error'])
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class MetricsTests(TestCase):
+    """Metrics of all processes are served in the Prometheus text format."""
+
+    def setUp(self):
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        self.enterContext(override_settings(METRICS_DIR=metrics_dir.name, METRICS_TOKEN=''))
+        self.enterContext(mock.patch.dict(metrics._values, clear=True))
+
+    def test_histogram_exposition(self):
+        for seconds in (0.003, 0.2, 0.2, 500):
+            metrics.observe('storyapp_pdf_render_seconds', seconds, stage='document')
+        text = metrics.render()
+        self.assertIn('# TYPE storyapp_pdf_render_seconds histogram', text)
+        self.assertIn('storyapp_pdf_render_seconds_bucket{stage="document",le="0.005"} 1', text)
+        self.assertIn('storyapp_pdf_render_seconds_bucket{stage="document",le="0.25"} 3', text)
+        self.assertIn('storyapp_pdf_render_seconds_bucket{stage="document",le="120.0"} 3', text)
+        self.assertIn('storyapp_pdf_render_seconds_bucket{stage="document",le="+Inf"} 4', text)
+        self.assertIn('storyapp_pdf_render_seconds_count{stage="document"} 4', text)
+
+    def test_snapshots_of_other_processes_are_merged(self):
+        metrics.inc('storyapp_gpt_tokens_total', 10, call='plot', type='prompt')
+        metrics.flush()
+        with open(os.path.join(settings.METRICS_DIR, 'other.json'), 'w') as f:
+            json.dump([['storyapp_gpt_tokens_total', [['call', 'plot'], ['type', 'prompt']], 5]], f)
+        self.assertIn('storyapp_gpt_tokens_total{call="plot",type="prompt"} 15', metrics.render())
+
+    def test_timer_records_outcome(self):
+        with self.assertRaises(ValueError), metrics.timer('storyapp_email_send_seconds'):
+            raise ValueError
+        self.assertIn('storyapp_email_send_seconds_count{outcome="error"} 1', metrics.render())
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('readiness'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('storyapp_http_request_seconds_count{method="GET",status="503",view="readiness"} 1',
+                      response.content.decode())
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+
+class Throttled(Exception):
+    status_code = 429
+
+
+class RecordingCache:
+    """The default cache, recording the threads it is used from."""
+
+    def __init__(self):
+        self.threads = set()
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.threads.add(threading.current_thread())
+            return getattr(cache, name)(*args, **kwargs)
+        return record
+
+
+@override_settings(
+    LIMITER_ENABLED=True, LIMITER_WINDOW=60, LIMITER_MAX_WAIT=5, LIMITER_DECREASE_COOLDOWN=60,
+    OPENAI_RPM=2, OPENAI_TPM=100, OPENAI_MAX_CONCURRENCY=8, OPENAI_LATENCY_TARGET=30,
+)
+class LimiterTests(TestCase):
+    """Calls to OpenAI and Replicate share rate budgets and an adaptive concurrency limit."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_calls_over_budget_wait_for_next_window(self):
+        self.assertEqual(limits._try_acquire('openai', 10), 0)
+        self.assertEqual(limits._try_acquire('openai', 10), 0)
+        self.assertGreater(limits._try_acquire('openai', 10), 0)
+        with override_settings(LIMITER_MAX_WAIT=0), self.assertRaises(limits.LimitExceeded):
+            with limits.limit('openai', tokens=10):
+                pass
+
+    @override_settings(LIMITER_WINDOW=1, OPENAI_RPM=120)
+    def test_spike_is_queued(self):
+        def call(i):
+            with limits.limit('openai', tokens=10):
+                return int(time.time())
+
+        # Two calls per one-second window; the others wait for later windows
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            windows = list(executor.map(call, range(5)))
+        self.assertGreaterEqual(len(set(windows)), 3)
+
+    def test_token_budget_is_corrected_with_usage(self):
+        with limits.limit('openai', tokens=90) as slot:
+            slot.use_tokens(20)
+        self.assertEqual(limits._try_acquire('openai', 70), 0)
+        self.assertGreater(limits._try_acquire('openai', 20), 0)
+
+    @override_settings(OPENAI_RPM=0)
+    def test_concurrency_adapts_to_throttling(self):
+        with self.assertRaises(Throttled), limits.limit('openai'):
+            raise Throttled('Too many requests')
+        self.assertEqual(limits.concurrency_limit('openai'), 4)
+        # One decrease per cooldown, however many calls were throttled together
+        with self.assertRaises(Throttled), limits.limit('openai'):
+            raise Throttled('Too many requests')
+        self.assertEqual(limits.concurrency_limit('openai'), 4)
+        with limits.limit('openai'):
+            pass
+        self.assertEqual(limits.concurrency_limit('openai'), 4.25)
+
+    async def test_async_limit_uses_the_cache_off_the_event_loop(self):
+        loop_thread = threading.current_thread()
+        recording = RecordingCache()
+        with mock.patch('storyapp.limits.cache', recording):
+            async with limits.alimit('openai', tokens=10) as slot:
+                await slot.ause_tokens(20)
+        self.assertTrue(recording.threads)
+        self.assertNotIn(loop_thread, recording.threads)
+        window = int(time.time() // settings.LIMITER_WINDOW)
+        used = [cache.get(limits._budget_key('openai', 'tokens', w)) for w in (window - 1, window)]
+        self.assertIn(20, used)
+
+    @override_settings(OPENAI_MAX_CONCURRENCY=1, OPENAI_RPM=0)
+    def test_concurrency_limit_holds_calls(self):
+        with limits.limit('openai'):
+            self.assertGreater(limits._try_acquire('openai', 0), 0)
+        self.assertEqual(limits._try_acquire('openai', 0), 0)
+
+
+@override_settings(
+    UPSTREAM_RETRY_ATTEMPTS=3, UPSTREAM_RETRY_BASE_DELAY=0, BREAKER_FAILURE_THRESHOLD=3,
+    BREAKER_FAILURE_WINDOW=60, BREAKER_RESET_TIMEOUT=60,
+)
+class ResilienceTests(TestCase):
+    """Transient upstream failures are retried and a failing upstream is skipped."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.enterContext(mock.patch.dict(metrics._values, clear=True))
+
+    def flaky(self, *errors, result='ok'):
+        return mock.Mock(side_effect=list(errors) + [result])
+
+    def test_transient_errors_are_retried(self):
+        func = self.flaky(ConnectionError('reset'), Throttled('Too many requests'))
+        self.assertEqual(resilience.call('openai', func, 'prompt'), 'ok')
+        self.assertEqual(func.call_count, 3)
+        self.assertIn('storyapp_upstream_retries_total{service="openai"} 2', metrics.render())
+
+        func = self.flaky(ValueError('bad request'))
+        with self.assertRaises(ValueError):
+            resilience.call('openai', func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_requests_that_may_have_run_are_not_repeated(self):
+        func = self.flaky(httpx.ReadTimeout('slow'))
+        with self.assertRaises(httpx.ReadTimeout):
+            resilience.call_once('replicate', func)
+        self.assertEqual(func.call_count, 1)
+        cache.clear()  # the breaker counted the timeout
+
+        try:
+            requests.post('http://127.0.0.1:9/v1/predictions', timeout=1)
+        except requests.ConnectionError as e:
+            refused = e
+        func = self.flaky(refused, httpx.ConnectError('refused'))
+        self.assertEqual(resilience.call_once('replicate', func), 'ok')
+        self.assertEqual(func.call_count, 3)
+        func = self.flaky(Throttled('Too many requests'))
+        self.assertEqual(resilience.call_once('replicate', func), 'ok')
+        self.assertEqual(func.call_count, 2)
+
+        conflict = mock.Mock(side_effect=Throttled('Conflict'))
+        conflict.side_effect.status_code = 409
+        with self.assertRaises(Throttled):
+            resilience.call('replicate', conflict)
+        self.assertEqual(conflict.call_count, 1)
+
+    async def test_async_calls_use_the_breaker_off_the_event_loop(self):
+        loop_thread = threading.current_thread()
+        recording = RecordingCache()
+        func = mock.AsyncMock(side_effect=[ConnectionError('reset'), 'ok'])
+        with mock.patch('storyapp.resilience.cache', recording):
+            self.assertEqual(await resilience.acall('replicate', func), 'ok')
+        self.assertEqual(func.await_count, 2)
+        self.assertTrue(recording.threads)
+        self.assertNotIn(loop_thread, recording.threads)
+
+    def test_breaker_opens_and_recovers(self):
+        # Failed attempts count towards the threshold until a call succeeds
+        resilience.call('replicate', self.flaky(ConnectionError('reset'), ConnectionError('reset')))
+        self.assertEqual(resilience.breaker_state('replicate'), resilience.CLOSED)
+        failing = mock.Mock(side_effect=ConnectionError('down'))
+        with self.assertRaises(ConnectionError):
+            resilience.call('replicate', failing)
+        self.assertEqual(resilience.breaker_state('replicate'), resilience.OPEN)
+        self.assertEqual(failing.call_count, 3)
+
+        with self.assertRaises(resilience.CircuitOpen):
+            resilience.call('replicate', failing)
+        self.assertEqual(failing.call_count, 3)
+        self.assertIn('storyapp_circuit_breaker_state{service="replicate"} 2', metrics.render())
+
+        # After the reset timeout one probe is let through and closes it again
+        with override_settings(BREAKER_RESET_TIMEOUT=0):
+            self.assertEqual(resilience.breaker_state('replicate'), resilience.HALF_OPEN)
+            self.assertEqual(resilience.call('replicate', self.flaky()), 'ok')
+        self.assertEqual(resilience.breaker_state('replicate'), resilience.CLOSED)
+        self.assertIn('storyapp_circuit_breaker_state{service="replicate"} 0', metrics.render())
+
+    def test_open_breaker_falls_back_without_calling_upstream(self):
+        with FakeOpenAIServer(latency='0', failure_rate=1.0) as openai, override_settings(
+            OPENAI_API_KEY='fake-key', OPENAI_BASE_URL=f"{openai.url}/v1",
+        ), mock.patch.dict(clients._clients, clear=True), mock.patch.dict(clients._health, ok=None):
+            self.assertIn('An error occurred', generate_story_plot('A space adventure', 'Nova'))
+            self.assertEqual(openai.stats['requests'], 3)
+            self.assertIn('An error occurred', generate_story_plot('A space adventure', 'Nova'))
+            self.assertEqual(openai.stats['requests'], 3)
+
+    @override_settings(REPLICATE_POLL_INTERVAL=0.02, IMAGE_CACHE_ENABLED=True, IMAGE_DERIVATIVE_WIDTHS=[])
+    def test_open_breaker_uses_closest_cached_image(self):
+        with FakeReplicateServer(latency='0') as replicate, tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root, REPLICATE_API_TOKEN='fake-token', REPLICATE_API_BASE_URL=replicate.url,
+        ), mock.patch.dict(clients._clients, clear=True), mock.patch.dict(images._versions, clear=True):
+            self.assertIsNotNone(generate_image('user', 'Nova opens the map', character_name='Nova'))
+            requests = replicate.stats['requests']
+            cache.set('breaker:replicate:opened_at', time.time())
+            name = generate_image('user', 'Nova reads the map', character_name='Nova')
+            self.assertTrue(generated_storage().exists(name))
+            self.assertEqual(replicate.stats['requests'], requests)
+            self.assertIsNone(generate_image('plot', 'Nova reads the map'))
+            # Unrelated scenes get no image rather than another story's panel
+            self.assertIsNone(generate_image('user', 'A dragon sleeps under the volcano', character_name='Zed'))
+            with override_settings(IMAGE_FALLBACK_SIMILARITY=0):
+                self.assertIsNone(generate_image('user', 'Nova reads the map', character_name='Nova'))
+
+    @override_settings(REPLICATE_PREDICTION_TIMEOUT=0.1, REPLICATE_POLL_INTERVAL=0.02)
+    def test_slow_prediction_is_canceled(self):
+        with FakeReplicateServer(latency='5') as replicate, override_settings(
+            REPLICATE_API_TOKEN='fake-token', REPLICATE_API_BASE_URL=replicate.url,
+        ), mock.patch.dict(clients._clients, clear=True):
+            with self.assertRaises(resilience.PredictionTimeout):
+                images.run_prediction(replicate.VERSION_ID, {'prompt': 'A slow map'})
+            self.assertEqual([prediction['status'] for prediction in replicate.predictions.values()], ['canceled'])
+
+    @override_settings(REPLICATE_POLL_INTERVAL=0.02)
+    def test_failed_poll_does_not_start_another_prediction(self):
+        with FakeReplicateServer(latency='0.1') as replicate, override_settings(
+            REPLICATE_API_TOKEN='fake-token', REPLICATE_API_BASE_URL=replicate.url,
+        ), mock.patch.dict(clients._clients, clear=True):
+            replicate.fail_polls = 2
+            output = images.run_prediction(replicate.VERSION_ID, {'prompt': 'A map'})
+            self.assertEqual(len(output), 1)
+            self.assertEqual(replicate.stats['poll_failures'], 2)
+            self.assertEqual(len(replicate.predictions), 1)
+
+    @override_settings(REPLICATE_POLL_INTERVAL=0.02)
+    async def test_failed_async_poll_does_not_start_another_prediction(self):
+        with FakeReplicateServer(latency='0.1') as replicate, override_settings(
+            REPLICATE_API_TOKEN='fake-token', REPLICATE_API_BASE_URL=replicate.url,
+        ), mock.patch.dict(clients._clients, clear=True):
+            replicate.fail_polls = 2
+            output = await images.arun_prediction(clients.get_async_http_client(), replicate.VERSION_ID, {'prompt': 'A map'})
+            self.assertEqual(len(output), 1)
+            self.assertEqual(replicate.stats['poll_failures'], 2)
+            self.assertEqual(len(replicate.predictions), 1)
+
+
+@override_settings(ALLOWED_HOSTS=['*'], INTRO_POOL_ENABLED=True)
+class IntroPoolTests(TestCase):
+    """New stories take a pre-generated intro for their theme when one is available."""
+
+    def setUp(self):
+        self.user = User.objects.create(email='test@example.com')
+        self.theme = Theme.objects.create(name='Space', description='A space adventure')
+        self.enterContext(mock.patch('storyapp.intro_pool.start_refill'))
+        self.enterContext(override_settings(METRICS_DIR=''))
+        self.enterContext(mock.patch.dict(metrics._values, clear=True))
+
+    def add_intro(self):
+        return StoryIntro.objects.create(
+            theme=self.theme,
+            plot_template="Quillon finds a map. Quillon's ship is ready.",
+            plot_image_path='plots/intro.jpg',
+        )
+
+    def test_claim_personalizes_and_removes_intro(self):
+        self.add_intro()
+        intro = claim_intro(self.theme, 'Nova')
+        self.assertEqual(intro['plot_text'], "Nova finds a map. Nova's ship is ready.")
+        self.assertEqual(intro['plot_image_path'], 'plots/intro.jpg')
+        self.assertFalse(StoryIntro.objects.exists())
+        self.assertIsNone(claim_intro(self.theme, 'Nova'))
+
+    def test_create_story_uses_pool(self):
+        self.add_intro()
+        session = self.client.session
+        session['user_id'] = self.user.id
+        session.save()
+        before = pool_stats()
+        with mock.patch('storyapp.views.generate_story_plot') as generate_story_plot:
+            response = self.client.post(reverse('create_story'), {'theme': self.theme.id, 'character_name': 'Nova'})
+        generate_story_plot.assert_not_called()
+        story = Story.objects.get()
+        self.assertRedirects(response, reverse('continue_story', args=[story.id]), fetch_redirect_response=False)
+        self.assertEqual((story.plot_text[:4], story.plot_image_path), ('Nova', 'plots/intro.jpg'))
+        self.assertEqual(pool_stats()['hits'], before['hits'] + 1)
+
+    def test_pool_metrics(self):
+        self.add_intro()
+        claim_intro(self.theme, 'Nova')
+        claim_intro(self.theme, 'Nova')
+        self.add_intro()
+        stats = pool_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+        text = metrics.render()
+        self.assertIn('storyapp_intro_pool_claims_total{result="hit",theme="Space"} 1', text)
+        self.assertIn('storyapp_intro_pool_claims_total{result="miss",theme="Space"} 1', text)
+        self.assertIn('storyapp_intro_pool_available{theme="Space"} 1', text)
+
+    def test_create_story_survives_intro_pool_errors(self):
+        session = self.client.session
+        session['user_id'] = self.user.id
+        session.save()
+        with mock.patch('storyapp.views.claim_intro', side_effect=RuntimeError('database is locked')), \
+                mock.patch('storyapp.views.generate_story_plot', return_value='Nova sets off.'):
+            response = self.client.post(reverse('create_story'), {'theme': self.theme.id, 'character_name': 'Nova'})
+        story = Story.objects.get()
+        self.assertRedirects(response, reverse('continue_story', args=[story.id]), fetch_redirect_response=False)
+        self.assertEqual((story.plot_text, story.plot_image_path), ('Nova sets off.', None))
+
+    def test_fill_pool(self):
+        client = mock.Mock()
+        client.chat.completions.create.return_value.choices = [mock.Mock(message=mock.Mock(content='Quillon sets off.'))]
+        client.chat.completions.create.return_value.usage = None
+        with mock.patch('storyapp.intro_pool.get_openai_client', return_value=client), \
+                mock.patch('storyapp.views.generate_plot_image', return_value='plots/new.jpg'):
+            self.assertEqual(fill_pool(self.theme, size=2), 2)
+        self.assertEqual(StoryIntro.objects.filter(theme=self.theme).count(), 2)
+        self.assertEqual(pool_stats()['available'], {'Space': 2})
+
+
+class PredictionWebhookTests(LiveServerTestCase):
+    """Predictions are created without waiting and completed by signed webhooks or the sweep."""
+
+    SECRET = 'whsec_dGVzdC1zZWNyZXQ='
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        media_root = self.enterContext(tempfile.TemporaryDirectory())
+        self.replicate = self.enterContext(FakeReplicateServer(latency='0.3', webhook_secret=self.SECRET))
+        self.enterContext(override_settings(
+            MEDIA_ROOT=media_root,
+            REPLICATE_API_TOKEN='fake-token',
+            REPLICATE_API_BASE_URL=self.replicate.url,
+            REPLICATE_WEBHOOKS=True,
+            REPLICATE_WEBHOOK_URL=self.live_server_url,
+            REPLICATE_WEBHOOK_SECRET=self.SECRET,
+            IMAGE_CACHE_ENABLED=False,
+            IMAGE_DERIVATIVE_WIDTHS=[],
+        ))
+        self.enterContext(mock.patch.dict(clients._clients, clear=True))
+        self.enterContext(mock.patch.dict(images._versions, clear=True))
+        self.enterContext(mock.patch('storyapp.predictions.prerender_turn'))
+        self.story = Story.objects.create(
+            user=User.objects.create(email='test@example.com'),
+            theme=Theme.objects.create(name='Space', description='A space adventure'),
+            character_name='Nova',
+            plot_text='Nova finds a map to the stars.'
+        )
+        self.response = StoryResponse.objects.create(story=self.story, user_input='Nova opens the map', ai_response='')
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'timed out')
+            time.sleep(0.05)
+
+    def test_webhook_attaches_image(self):
+        start_time = time.monotonic()
+        prediction = predictions.start_prediction(
+            'user', 'Nova opens the map', self.story.id, self.response.id, character_name='Nova'
+        )
+        self.assertLess(time.monotonic() - start_time, 0.3)
+        self.assertEqual(prediction.status, Prediction.STATUS_PENDING)
+
+        self.wait_for(lambda: StoryResponse.objects.get(id=self.response.id).user_img_path)
+        name = StoryResponse.objects.get(id=self.response.id).user_img_path
+        with generated_storage().open(name) as f, Image.open(f) as image:
+            self.assertEqual(image.size, (512, 512))
+        prediction.refresh_from_db()
+        self.assertEqual(prediction.status, Prediction.STATUS_SUCCEEDED)
+        self.assertEqual(self.replicate.stats['webhooks'], 1)
+        # The prediction was never polled
+        self.assertEqual(self.replicate.stats['requests'], 3)
+
+    def test_unsigned_webhooks_are_refused(self):
+        prediction = Prediction.objects.create(
+            replicate_id='fake99', kind='plot', story=self.story, version='v', path='plots/plot.jpg'
+        )
+        body = json.dumps({'id': 'fake99', 'status': 'failed', 'error': 'boom'}).encode()
+        timestamp = str(int(time.time()))
+        signature = predictions.webhook_signature(self.SECRET, 'msg_1', timestamp, body)
+        headers = {'HTTP_WEBHOOK_ID': 'msg_1', 'HTTP_WEBHOOK_TIMESTAMP': timestamp}
+        url = reverse('replicate_webhook')
+
+        response = self.client.post(url, body, 'application/json', HTTP_WEBHOOK_SIGNATURE='v1,forged', **headers)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(url, body, 'application/json', HTTP_WEBHOOK_SIGNATURE=f'v1,{signature}', **headers)
+        self.assertEqual(response.status_code, 204)
+        prediction.refresh_from_db()
+        self.assertEqual((prediction.status, prediction.error), (Prediction.STATUS_FAILED, 'boom'))
+
+        # Signed bodies that are not a prediction are rejected without a retry
+        for bad_body in (b'{not json', b'[1, 2]', b'{"status": "failed"}'):
+            bad_signature = predictions.webhook_signature(self.SECRET, 'msg_1', timestamp, bad_body)
+            response = self.client.post(url, bad_body, 'application/json',
+                                        HTTP_WEBHOOK_SIGNATURE=f'v1,{bad_signature}', **headers)
+            self.assertEqual(response.status_code, 400)
+
+        # Webhooks that arrive before their prediction is saved are retried by Replicate
+        prediction.delete()
+        response = self.client.post(url, body, 'application/json', HTTP_WEBHOOK_SIGNATURE=f'v1,{signature}', **headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_sweep_completes_missed_webhooks(self):
+        self.replicate.webhook_loss_rate = 1.0
+        prediction = predictions.start_prediction('plot', self.story.plot_text, self.story.id)
+        self.assertEqual(predictions.reconcile_predictions(older_than=0), 0)
+        time.sleep(0.4)
+        self.assertEqual(predictions.reconcile_predictions(older_than=0), 1)
+        self.story.refresh_from_db()
+        self.assertTrue(generated_storage().exists(self.story.plot_image_path))
+        self.assertEqual(self.replicate.stats['webhooks'], 0)
+
+        # Predictions running past REPLICATE_PREDICTION_TIMEOUT are canceled
+        self.replicate.sample_latency = lambda: 60
+        prediction = predictions.start_prediction('ai', 'The map glows', self.story.id, self.response.id)
+        with override_settings(REPLICATE_PREDICTION_TIMEOUT=0):
+            self.assertEqual(predictions.reconcile_predictions(older_than=0), 1)
+        prediction.refresh_from_db()
+        self.assertEqual(prediction.status, Prediction.STATUS_FAILED)
+        self.assertEqual(self.replicate.predictions[prediction.replicate_id]['status'], 'canceled')
@@ -1,10 +1,18 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
 
 urlpatterns = [
     path('', views.index, name='index'),
-    path('create_story/', views.create_story, name='create_story'),
-    path('continue_story/<int:story_id>/', views.continue_story, name='continue_story'),
+    path('create_story/', async_views.acreate_story if settings.ASYNC_VIEWS else views.create_story, name='create_story'),
+    path('continue_story/<int:story_id>/', async_views.acontinue_story if settings.ASYNC_VIEWS else views.continue_story, name='continue_story'),
     path('story_complete/<int:story_id>/', views.story_complete, name='story_complete'),
+    path('story_finalize_status/<int:story_id>/', views.story_finalize_status, name='story_finalize_status'),
+    path('stream_story_response/<int:response_id>/', async_views.astream_story_response if settings.ASYNC_VIEWS else views.stream_story_response, name='stream_story_response'),
     path('check_image_status/<int:response_id>/', views.check_image_status, name='check_image_status'),
+    path('story_image_status/<int:story_id>/', views.story_image_status, name='story_image_status'),
+    path('story_image_events/<int:story_id>/', async_views.astory_image_events if settings.ASYNC_VIEWS else views.story_image_events, name='story_image_events'),
+    path('replicate_webhook/', views.replicate_webhook, name='replicate_webhook'),
+    path('ready/', views.readiness, name='readiness'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
@@ -1,53 +1,43 @@
 import os
-import uuid
+import hmac
+import json
+import threading
 import time  # Add time import for timing operations
-import replicate
+from concurrent.futures import TimeoutError
 from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
 from django.core.mail import EmailMessage
-from PIL import Image, ImageDraw, ImageFont
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from io import BytesIO
-import requests
-import threading
-
-from .models import User, Theme, Story, StoryResponse
+from django.core.cache import cache
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
+from django.db import close_old_connections, transaction
+from django.db.models import F, Prefetch, Q
+
+from .models import User, Story, StoryResponse, Job, Prediction
 from .forms import UserForm, StoryForm, StoryResponseForm
 
-# Initialize OpenAI API
-from openai import OpenAI
-
-# Create OpenAI client instance - handle empty API key gracefully
-def get_openai_client():
-    # Debug environment variables
-    import os
-    print("\nDEBUG: Environment variables:")
-    print(f"1. Direct os.getenv: {os.getenv('OPENAI_API_KEY')}")
-    print(f"2. Settings OPENAI_API_KEY: {settings.OPENAI_API_KEY}")
-    print(f"3. All env vars containing 'OPENAI': {[k for k in os.environ.keys() if 'OPENAI' in k]}")
-
-    if not settings.OPENAI_API_KEY or not settings.OPENAI_API_KEY.strip():
-        print("WARNING: OPENAI_API_KEY is not set or empty")
-        return None
-
-    try:
-        client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        print("DEBUG: Successfully created OpenAI client")
-        test_response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": "Say 'OK' if you can hear me"}],
-            max_tokens=5
-        )
-        print(f"DEBUG: Test response received: {test_response.choices[0].message.content}")
-        return client
-    except Exception as e:
-        print(f"ERROR initializing OpenAI client: {e}")
-        print(f"ERROR type: {type(e).__name__}")
-        return None
+from .clients import (
+    get_openai_client, get_async_openai_client, refresh_openai_health,
+    create_chat_completion, acreate_chat_completion, estimate_chat_tokens,
+)
+from .pipeline import TurnGraph
+from .context import build_story_context, start_summary_update, update_story_summary
+from .finalize import image_progress, start_finalization
+from .pdf import prerender_turn
+from .derivatives import image_fields
+from .storage import file_url, generated_storage
+from .intro_pool import claim_intro, pool_stats
+from .caching import (
+    get_story_page, get_themes, set_story_page, story_page_etag, story_page_last_modified, themes_version
+)
+from .images import PREDICTION_DONE, generate_image, agenerate_image
+from .predictions import complete_prediction, start_prediction, verify_webhook
+from . import jobs, events, limits, metrics, resilience
 
 # Set Replicate API token
 if settings.REPLICATE_API_TOKEN and settings.REPLICATE_API_TOKEN.strip():
@@ -92,11 +82,38 @@ def create_story(request):
             # Get form data
             theme = form.cleaned_data['theme']
             character_name = form.cleaned_data['character_name']
+            plot_text = None
             
             try:
+                # Use a pre-generated intro for the theme if one is available
+                intro = claim_intro(theme, character_name)
+                if intro is not None:
+                    story = Story.objects.create(
+                        user=user,
+                        theme=theme,
+                        character_name=character_name,
+                        **intro
+                    )
+                    return redirect('continue_story', story_id=story.id)
+                
                 # Generate story plot using GPT
                 plot_text = generate_story_plot(theme.description, character_name)
                 
+                if settings.REPLICATE_WEBHOOKS or settings.IMAGE_JOBS_DURABLE:
+                    # The plot image is attached by the prediction webhook or
+                    # generated by a worker after the redirect
+                    story = Story.objects.create(
+                        user=user,
+                        theme=theme,
+                        character_name=character_name,
+                        plot_text=plot_text
+                    )
+                    if settings.REPLICATE_WEBHOOKS:
+                        start_prediction('plot', plot_text, story.id)
+                    else:
+                        jobs.enqueue(Job.KIND_PLOT_IMAGE, story=story)
+                    return redirect('continue_story', story_id=story.id)
+                
                 # Generate plot image using Stable Diffusion
                 plot_image_path = generate_plot_image(plot_text)
                 
@@ -106,7 +123,7 @@ def create_story(request):
                     theme=theme,
                     character_name=character_name,
                     plot_text=plot_text,
-                    plot_image_path=plot_image_path
+                    **image_fields('plot_image_path', plot_image_path)
                 )
                 
                 return redirect('continue_story', story_id=story.id)
@@ -114,7 +131,10 @@ def create_story(request):
                 print(f"Error creating story: {e}")
                 messages.error(request, f"Error creating story: {str(e)}")
                 
-                # Create story without image if generation fails
+                # Create story without image if generation fails; the plot is
+                # generated here if the failure came before it
+                if plot_text is None:
+                    plot_text = generate_story_plot(theme.description, character_name)
                 story = Story.objects.create(
                     user=user,
                     theme=theme,
@@ -124,14 +144,16 @@ def create_story(request):
                 
                 return redirect('continue_story', story_id=story.id)
     else:
-        form = StoryForm()
+        form = StoryForm(themes=get_themes())
     
     # Get all available themes
-    themes = Theme.objects.all()
+    themes = get_themes()
     
     return render(request, 'storyapp/create_story.html', {
         'form': form,
         'themes': themes,
+        'themes_version': themes_version(),
+        'page_cache_timeout': settings.PAGE_CACHE_TIMEOUT,
         'user': user
     })
 
@@ -143,11 +165,10 @@ def continue_story(request, story_id):
     if not user_id:
         return redirect('index')
     
-    story = get_object_or_404(Story, id=story_id)
-    responses = StoryResponse.objects.filter(story=story).order_by('created_at')
+    story, responses = get_story_with_responses(story_id)
     
     # Get the latest response for image status checking
-    latest_response = responses.last()
+    latest_response = responses[-1] if responses else None
     
     # Initialize context variables
     context = {
@@ -160,6 +181,7 @@ def continue_story(request, story_id):
         'current_user_img': None,
         'current_ai_img': None,
         'latest_response': latest_response,
+        'streaming': settings.STREAM_CONTINUATIONS,
     }
     
     if request.method == 'POST':
@@ -168,116 +190,542 @@ def continue_story(request, story_id):
             # Get user input
             user_input = form.cleaned_data['user_input']
             
-            # Generate AI response using GPT
-            story_context = f"Theme: {story.theme.name}\nCharacter: {story.character_name}\nPlot: {story.plot_text}\n"
-            
-            # Add previous responses for context
-            for resp in responses:
-                story_context += f"User: {resp.user_input}\nAI: {resp.ai_response}\n"
-            
-            # Add current user input
-            story_context += f"User: {user_input}\n"
-            
-            # Generate AI response using GPT
-            ai_response = generate_ai_response(story_context)
-            
-            # Create response object first (without images)
-            response = StoryResponse.objects.create(
-                story=story,
-                user_input=user_input,
-                ai_response=ai_response
-            )
-            
-            # Set processing flag and current inputs for template
-            context['processing'] = True
-            context['current_user_input'] = user_input
-            context['current_ai_response'] = ai_response
-            
-            # Start a background thread to generate images
-            def generate_images_thread():
-                try:
-                    # Generate user image
-                    print("Generating user image...")
-                    user_img_path = generate_user_image(user_input, story.character_name)
-                    if user_img_path:
-                        response.user_img_path = user_img_path
-                        response.save()
-                        print(f"User image saved: {user_img_path}")
-                    else:
-                        print("Failed to generate user image")
-                    
-                    # Generate AI image
-                    print("Generating AI image...")
-                    ai_img_path = generate_ai_image(ai_response)
-                    if ai_img_path:
-                        response.ai_img_path = ai_img_path
-                        response.save()
-                        print(f"AI image saved: {ai_img_path}")
-                    else:
-                        print("Failed to generate AI image")
-                    
-                except Exception as e:
-                    print(f"Error generating images: {e}")
-            
-            # Start the thread for image generation
-            image_thread = threading.Thread(target=generate_images_thread)
-            image_thread.daemon = True
-            image_thread.start()
+            streaming = settings.STREAM_CONTINUATIONS and wants_json(request)
+            if not streaming:
+                story_context = build_story_context(story, responses, user_input)
+            
+            # Create the response row first so every pipeline step can attach to it
+            response = create_response(story, user_input)
+            
+            if streaming:
+                # The continuation is streamed by stream_story_response; only
+                # the user panel starts now.
+                start_turn_pipeline(story, response)
+                schedule_stream_fallback(story, response)
+                return JsonResponse({
+                    'response_id': response.id,
+                    'stream_url': reverse('stream_story_response', args=[response.id]),
+                })
+            
+            # The user panel only depends on the user input, so it renders while
+            # GPT writes the continuation; the AI panel starts as soon as the text arrives.
+            graph = start_turn_pipeline(story, response, story_context)
+            try:
+                graph.result('save_ai_response', timeout=settings.TURN_TEXT_TIMEOUT)
+            except TimeoutError:
+                # The pipeline still saves the continuation when it arrives
+                print(f"Continuation of response {response.id} not ready after {settings.TURN_TEXT_TIMEOUT}s")
             
             # If we have 10 responses, generate PDF and send email
-            if responses.count() >= 9:  # 9 existing + 1 new = 10 total
-                pdf_path = generate_pdf(story)
-                send_email(story)
+            if story.turn_count >= 10:
+                complete_story(story)
                 return redirect('story_complete', story_id=story.id)
             
             # Redirect to refresh the page and show the new response
             return redirect('continue_story', story_id=story.id)
+        elif wants_json(request):
+            return JsonResponse({'errors': form.errors}, status=400)
     
     return render(request, 'storyapp/continue_story.html', context)
 
+
+def get_story_with_responses(story_id):
+    """Load a story with its theme, user and ordered responses in two queries."""
+    story = get_object_or_404(
+        Story.objects.select_related('theme', 'user').prefetch_related(
+            Prefetch('responses', queryset=StoryResponse.objects.order_by('created_at'), to_attr='ordered_responses')
+        ),
+        id=story_id
+    )
+    return story, story.ordered_responses
+
+
+def create_response(story, user_input):
+    """Create a blank turn for the user input and bump the story's turn counter.
+    
+    story.turn_count is refreshed from the database, so concurrent posts to
+    the same story each see their own turn number.
+    """
+    with transaction.atomic():
+        response = StoryResponse.objects.create(
+            story=story,
+            user_input=user_input,
+            ai_response=''
+        )
+        Story.objects.filter(id=story.id).update(turn_count=F('turn_count') + 1)
+        story.turn_count = Story.objects.values_list('turn_count', flat=True).get(id=story.id)
+    return response
+
+
+def wants_json(request):
+    """True for the AJAX form posts made by the streaming story page."""
+    return 'application/json' in request.headers.get('Accept', '')
+
+
+def complete_story(story):
+    """Build and email the comic PDF in the background once the images are done."""
+    start_finalization(story)
+
+
+def attach_image(story_id, response_id, field):
+    """Return a pipeline step that stores an image path on a response."""
+    def attach(image_path):
+        if image_path:
+            StoryResponse.objects.filter(id=response_id).update(**image_fields(field, image_path))
+            events.publish(story_id)
+            print(f"{field} saved: {image_path}")
+            prerender_turn(story_id, response_id)
+        else:
+            print(f"Failed to generate image for {field}")
+        return image_path
+    return attach
+
+
+def start_turn_pipeline(story, response, story_context=None):
+    """Start the concurrent GPT and image steps for one story turn.
+    
+    Without a story context the continuation is streamed separately and only
+    the user panel is started here; see start_ai_image.
+    """
+    character_name = story.character_name
+    user_input = response.user_input
+    
+    def save_ai_response(ai_response):
+        StoryResponse.objects.filter(id=response.id).update(ai_response=ai_response)
+        return ai_response
+    
+    requested_at = time.time()
+    graph = TurnGraph(f"response {response.id}")
+    
+    if settings.REPLICATE_WEBHOOKS:
+        # Predictions are only created here; replicate_webhook attaches the images
+        graph.add('user_image', lambda: start_prediction(
+            'user', user_input, story.id, response.id, character_name=character_name
+        ))
+    elif settings.IMAGE_JOBS_DURABLE:
+        # Images are handed to the durable queue and rendered by run_worker
+        jobs.enqueue(Job.KIND_USER_IMAGE, story=story, response=response)
+    else:
+        graph.add('user_image', lambda: generate_user_image(user_input, character_name, queued_at=requested_at))
+        graph.add('save_user_image', attach_image(story.id, response.id, 'user_img_path'), deps=['user_image'])
+    
+    if story_context is None:
+        return graph.run()
+    
+    graph.add('ai_text', lambda: generate_ai_response(story_context), pool='text')
+    graph.add('save_ai_response', save_ai_response, deps=['ai_text'], pool='text')
+    graph.add('summarize', lambda ai_response: update_story_summary(story.id), deps=['save_ai_response'], pool='text')
+    if settings.REPLICATE_WEBHOOKS:
+        graph.add('ai_image', lambda ai_response: start_prediction('ai', ai_response, story.id, response.id),
+                  deps=['ai_text'])
+    elif settings.IMAGE_JOBS_DURABLE:
+        graph.add('ai_image', lambda ai_response: jobs.enqueue(Job.KIND_AI_IMAGE, story=story, response=response),
+                  deps=['save_ai_response'])
+    else:
+        graph.add('ai_image', lambda ai_response: generate_ai_image(ai_response, queued_at=requested_at), deps=['ai_text'])
+        graph.add('save_ai_image', attach_image(story.id, response.id, 'ai_img_path'), deps=['ai_image'])
+    return graph.run()
+
+
+def start_ai_image(story, response, ai_response):
+    """Start the AI panel for a turn whose continuation was streamed."""
+    if settings.REPLICATE_WEBHOOKS:
+        start_prediction('ai', ai_response, story.id, response.id)
+        return None
+    if settings.IMAGE_JOBS_DURABLE:
+        jobs.enqueue(Job.KIND_AI_IMAGE, story=story, response=response)
+        return None
+    
+    requested_at = time.time()
+    graph = TurnGraph(f"response {response.id} AI panel")
+    graph.add('ai_image', lambda: generate_ai_image(ai_response, queued_at=requested_at))
+    graph.add('save_ai_image', attach_image(story.id, response.id, 'ai_img_path'), deps=['ai_image'])
+    return graph.run()
+
+
+def stream_lock_key(response_id):
+    """Cache key held by whoever generates a streamed turn's continuation."""
+    return f"stream-response:{response_id}"
+
+
+def finish_streamed_turn(story, response, ai_response, turn_count):
+    """Save a streamed continuation and start the steps that follow it."""
+    StoryResponse.objects.filter(id=response.id).update(ai_response=ai_response)
+    start_ai_image(story, response, ai_response)
+    start_summary_update(story.id)
+    if turn_count >= 10:
+        complete_story(story)
+
+
+def schedule_stream_fallback(story, response):
+    """Generate the continuation server-side if its stream is never opened.
+    
+    A browser that leaves before opening the stream URL would otherwise
+    leave the turn without text, so after STREAM_CLAIM_TIMEOUT seconds the
+    continuation is written here unless a stream has claimed it.
+    """
+    if not settings.STREAM_CLAIM_TIMEOUT:
+        return None
+    
+    def run():
+        try:
+            generate_unclaimed_continuation(story.id, response.id)
+        finally:
+            close_old_connections()
+    
+    timer = threading.Timer(settings.STREAM_CLAIM_TIMEOUT, run)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def generate_unclaimed_continuation(story_id, response_id):
+    """Write and save a streamed turn's continuation unless a stream claimed it.
+
+    Returns True if the continuation was generated here.
+    """
+    try:
+        if not cache.add(stream_lock_key(response_id), True, timeout=settings.OPENAI_TIMEOUT * 2):
+            return False
+        response = StoryResponse.objects.select_related('story__theme').get(id=response_id, story_id=story_id)
+        if response.ai_response:
+            return False
+        story = response.story
+        print(f"Stream of response {response_id} was not opened; generating the continuation server-side")
+
+        previous = StoryResponse.objects.filter(story=story, id__lt=response.id).order_by('created_at')
+        story_context = build_story_context(story, previous, response.user_input)
+        finish_streamed_turn(story, response, generate_ai_response(story_context), story.turn_count)
+        return True
+    except Exception as e:
+        print(f"Error generating unclaimed continuation: {type(e).__name__}: {e}")
+        return False
+
+
+def stream_story_response(request, response_id):
+    """Server-Sent Events endpoint streaming the AI continuation of a turn.
+    
+    Tokens are sent as `data` events while GPT writes them. The response is
+    saved and the AI panel started once the stream completes, followed by a
+    final `done` event.
+    """
+    if not request.session.get('user_id'):
+        return HttpResponse(status=403)
+    
+    response = get_object_or_404(StoryResponse.objects.select_related('story__theme'), id=response_id)
+    story = response.story
+    
+    def event(data, name=None):
+        prefix = f"event: {name}\n" if name else ""
+        return f"{prefix}data: {json.dumps(data)}\n\n"
+    
+    def done_event(ai_response, turn_count):
+        data = {'response_id': response.id, 'ai_response': ai_response}
+        if turn_count >= 10:
+            data['redirect_url'] = reverse('story_complete', args=[story.id])
+        return event(data, name='done')
+    
+    def stream():
+        turn_count = story.turn_count
+        if response.ai_response:
+            yield done_event(response.ai_response, turn_count)
+            return
+        
+        # Only one connection generates the text; reconnects wait for it
+        if not cache.add(stream_lock_key(response.id), True, timeout=settings.OPENAI_TIMEOUT * 2):
+            deadline = time.monotonic() + settings.OPENAI_TIMEOUT * 2
+            while time.monotonic() < deadline:
+                ai_response = StoryResponse.objects.filter(id=response.id).values_list('ai_response', flat=True).first()
+                if ai_response:
+                    yield done_event(ai_response, turn_count)
+                    return
+                yield ": waiting\n\n"
+                time.sleep(1)
+            return
+        
+        previous = StoryResponse.objects.filter(story=story, id__lt=response.id).order_by('created_at')
+        story_context = build_story_context(story, previous, response.user_input)
+        
+        chunks = []
+        tokens = stream_ai_response(story_context)
+        try:
+            for chunk in tokens:
+                chunks.append(chunk)
+                yield event({'token': chunk})
+        finally:
+            # A client that disconnects mid-stream still gets its turn saved
+            chunks.extend(tokens)
+            ai_response = ''.join(chunks).strip()
+            finish_streamed_turn(story, response, ai_response, turn_count)
+        yield done_event(ai_response, turn_count)
+    
+    http_response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    http_response['Cache-Control'] = 'no-cache'
+    http_response['X-Accel-Buffering'] = 'no'
+    return http_response
+
+
 # Add a new view to check image generation status
 def check_image_status(request, response_id):
     """AJAX endpoint to check if images have been generated."""
-    response = get_object_or_404(StoryResponse, id=response_id)
+    response = get_object_or_404(
+        StoryResponse.objects.values('user_img_path', 'ai_img_path'), id=response_id
+    )
     
     return JsonResponse({
-        'user_img_ready': bool(response.user_img_path),
-        'ai_img_ready': bool(response.ai_img_path),
-        'user_img_path': response.user_img_path if response.user_img_path else None,
-        'ai_img_path': response.ai_img_path if response.ai_img_path else None,
+        'user_img_ready': bool(response['user_img_path']),
+        'ai_img_ready': bool(response['ai_img_path']),
+        'user_img_path': response['user_img_path'] or None,
+        'ai_img_path': response['ai_img_path'] or None,
+        'user_img_url': file_url(response['user_img_path']),
+        'ai_img_url': file_url(response['ai_img_path']),
     })
 
 
+def image_status_rows(story_id, response_ids=None):
+    """Image paths of the given responses, or of those still missing an image."""
+    responses = StoryResponse.objects.filter(story_id=story_id)
+    if response_ids is not None:
+        responses = responses.filter(id__in=response_ids)
+    else:
+        responses = responses.filter(Q(user_img_path__isnull=True) | Q(ai_img_path__isnull=True))
+    return responses.order_by('created_at').values('id', 'user_img_path', 'ai_img_path')
+
+
+def image_status(response):
+    """Status of one row of image_status_rows."""
+    return {
+        'response_id': response['id'],
+        'user_img_ready': bool(response['user_img_path']),
+        'ai_img_ready': bool(response['ai_img_path']),
+        'user_img_path': response['user_img_path'] or None,
+        'ai_img_path': response['ai_img_path'] or None,
+        'user_img_url': file_url(response['user_img_path']),
+        'ai_img_url': file_url(response['ai_img_path']),
+    }
+
+
+def image_statuses(story_id, response_ids=None):
+    """Image status of a story's plot and responses, in one query each."""
+    return [image_status(response) for response in image_status_rows(story_id, response_ids)]
+
+
+def story_image_status(request, story_id):
+    """Polling fallback: status of all pending images of a story in one request."""
+    ids = request.GET.get('responses')
+    response_ids = [int(i) for i in ids.split(',') if i.isdigit()] if ids else None
+    plot_image_path = get_object_or_404(
+        Story.objects.values_list('plot_image_path', flat=True), id=story_id
+    )
+    
+    statuses = image_statuses(story_id, response_ids)
+    return JsonResponse({
+        'plot_image_path': plot_image_path,
+        'plot_image_url': file_url(plot_image_path),
+        'responses': statuses,
+        'complete': all(s['user_img_ready'] and s['ai_img_ready'] for s in statuses),
+    })
+
+
+def story_image_events(request, story_id):
+    """Server-Sent Events stream of image readiness for a whole story.
+    
+    Every response of the story that is missing an image when the stream
+    opens is watched. An `image` event is pushed whenever one of them
+    changes and `complete` once all of them are ready; a missing plot image
+    is reported with a `plot` event when it arrives.
+    The stream wakes up as soon as an image is attached in this process,
+    and otherwise re-checks the database every IMAGE_EVENTS_DB_RECHECK
+    seconds.
+    """
+    if not request.session.get('user_id'):
+        return HttpResponse(status=403)
+    plot_image_path = get_object_or_404(
+        Story.objects.values_list('plot_image_path', flat=True), id=story_id
+    )
+    
+    def event(data, name):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+    
+    def stream():
+        yield "retry: 3000\n\n"
+        deadline = time.monotonic() + settings.IMAGE_EVENTS_MAX_DURATION
+        version = events.current_version(story_id)
+        plot_pending = not plot_image_path
+        # Last status sent for every response that is still missing an image
+        pending = {}
+        statuses = image_statuses(story_id)
+        
+        while True:
+            for status in statuses:
+                if status != pending.get(status['response_id']):
+                    yield event(status, 'image')
+                if status['user_img_ready'] and status['ai_img_ready']:
+                    pending.pop(status['response_id'], None)
+                else:
+                    pending[status['response_id']] = status
+            
+            if not pending:
+                yield event({'story_id': story_id}, 'complete')
+                return
+            if time.monotonic() > deadline:
+                return
+            
+            new_version = events.wait_for_change(story_id, version, settings.IMAGE_EVENTS_DB_RECHECK)
+            if new_version == version:
+                yield ": keepalive\n\n"
+            version = new_version
+            
+            if plot_pending:
+                plot_image = Story.objects.filter(id=story_id).values_list('plot_image_path', flat=True).first()
+                if plot_image:
+                    plot_pending = False
+                    yield event({'plot_image_path': plot_image, 'plot_image_url': file_url(plot_image)}, 'plot')
+            statuses = image_statuses(story_id, list(pending))
+    
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def readiness(request):
+    """Readiness endpoint that refreshes the cached upstream health status."""
+    status = refresh_openai_health(force=request.GET.get('force') == '1')
+    ready = bool(status['ok'])
+
+    return JsonResponse({
+        'ready': ready,
+        'openai': {
+            'ok': status['ok'],
+            'error': status['error'],
+            'latency': status['latency'],
+        },
+        'intro_pool': pool_stats(),
+    }, status=200 if ready else 503)
+
+
+def metrics_view(request):
+    """Metrics of all processes in the Prometheus text format."""
+    expected = f"Bearer {settings.METRICS_TOKEN}"
+    if settings.METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@csrf_exempt
+@require_POST
+def replicate_webhook(request):
+    """Completion callback of predictions started by start_prediction.
+    
+    Requests without a valid signature are refused, and signed bodies that
+    are not a prediction get a 400 so they are not redelivered. Unknown
+    predictions get a 404 so Replicate retries webhooks that arrive before
+    the prediction was saved, and failed downloads a 500 for the same reason.
+    """
+    if not verify_webhook(request.headers, request.body):
+        return HttpResponse(status=403)
+    
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return HttpResponse(status=400)
+    if not isinstance(data, dict) or not data.get('id'):
+        return HttpResponse(status=400)
+    
+    prediction = Prediction.objects.filter(replicate_id=data['id']).first()
+    if prediction is None:
+        return HttpResponse(status=404)
+    if data.get('status') in PREDICTION_DONE:
+        complete_prediction(prediction, data)
+    return HttpResponse(status=204)
+
+
+@condition(etag_func=story_page_etag, last_modified_func=story_page_last_modified)
 def story_complete(request, story_id):
-    """Show completed story."""
-    story = get_object_or_404(Story, id=story_id)
-    responses = StoryResponse.objects.filter(story=story).order_by('created_at')
+    """Show completed story.
     
-    return render(request, 'storyapp/story_complete.html', {
+    Once the comic has been sent the page can no longer change, so it is
+    cached and served with an ETag and Last-Modified for conditional requests.
+    """
+    entry = get_story_page(request, story_id)
+    if entry is not None:
+        response = HttpResponse(entry['content'])
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    
+    story, responses = get_story_with_responses(story_id)
+    images_ready, images_total = image_progress(story, responses)
+    
+    response = render(request, 'storyapp/story_complete.html', {
         'story': story,
-        'responses': responses
+        'responses': responses,
+        'finalizing': story.finalize_status in (Story.FINALIZE_WAITING, Story.FINALIZE_RENDERING),
+        'images_ready': images_ready,
+        'images_total': images_total,
     })
+    if story.finalize_status == Story.FINALIZE_DONE:
+        entry = set_story_page(story_id, response.content)
+        response['ETag'] = entry['etag']
+        response['Last-Modified'] = http_date(entry['last_modified'].timestamp())
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def story_finalize_status(request, story_id):
+    """Progress of the background PDF build, polled by the story complete page."""
+    story, responses = get_story_with_responses(story_id)
+    images_ready, images_total = image_progress(story, responses)
+    return JsonResponse({
+        'status': story.finalize_status,
+        'status_display': story.get_finalize_status_display(),
+        'images_ready': images_ready,
+        'images_total': images_total,
+        'email_sent': story.email_sent,
+    })
+
+
+def plot_messages(theme_description, character_name):
+    """Chat messages asking GPT for a story introduction."""
+    prompt = f"Create an exciting comic book story introduction about a character named {character_name} in the following setting: {theme_description}. Make it engaging and suitable for children. Keep it under 200 words."
+    return [
+        {"role": "system", "content": "You are a creative comic book writer who creates engaging stories for children."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def continuation_messages(story_context):
+    """Chat messages asking GPT to continue the story."""
+    prompt = f"Continue this comic book story in an engaging way. Keep your response concise (around 100 words) and exciting. Previous story context:\n{story_context}"
+    return [
+        {"role": "system", "content": "You are a creative comic book writer who creates engaging stories for children. Keep your responses concise and exciting."},
+        {"role": "user", "content": prompt}
+    ]
 
 
 def generate_story_plot(theme_description, character_name):
     """Generate story plot using OpenAI's GPT."""
-    # Get a fresh OpenAI client
+    # Get the shared OpenAI client
     client = get_openai_client()
     if client is None:
         return f"Once upon a time, there was a character named {character_name} in a {theme_description} world. \nPlease set your OpenAI API key in the .env file to generate real stories."
 
     try:
-        # Create the prompt
-        prompt = f"Create an exciting comic book story introduction about a character named {character_name} in the following setting: {theme_description}. Make it engaging and suitable for children. Keep it under 200 words."
-
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a creative comic book writer who creates engaging stories for children."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500
-        )
+        response = create_chat_completion(client, 'plot', plot_messages(theme_description, character_name), max_tokens=500)
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"Error generating story plot: {e}")
+        return f"Once upon a time, there was a character named {character_name} in a {theme_description} world. \nAn error occurred while generating the story."
+
+
+async def agenerate_story_plot(theme_description, character_name):
+    """Async version of generate_story_plot."""
+    client = get_async_openai_client()
+    if client is None:
+        return f"Once upon a time, there was a character named {character_name} in a {theme_description} world. \nPlease set your OpenAI API key in the .env file to generate real stories."
+
+    try:
+        response = await acreate_chat_completion(client, 'plot', plot_messages(theme_description, character_name), max_tokens=500)
         return response.choices[0].message.content.strip()
     except Exception as e:
         print(f"Error generating story plot: {e}")
@@ -286,357 +734,125 @@ def generate_story_plot(theme_description, character_name):
 
 def generate_ai_response(story_context):
     """Generate AI response using OpenAI's GPT."""
-    # Get a fresh OpenAI client
+    # Get the shared OpenAI client
     client = get_openai_client()
     if client is None:
         return "The adventure continues... \nPlease set your OpenAI API key in the .env file to generate real story continuations."
 
     try:
-        # Create the prompt
-        prompt = f"Continue this comic book story in an engaging way. Keep your response concise (around 100 words) and exciting. Previous story context:\n{story_context}"
-
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a creative comic book writer who creates engaging stories for children. Keep your responses concise and exciting."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=300
-        )
+        response = create_chat_completion(client, 'continuation', continuation_messages(story_context), max_tokens=300)
         return response.choices[0].message.content.strip()
     except Exception as e:
         print(f"Error generating AI response: {e}")
         return "The adventure continues... \nAn error occurred while generating the story continuation."
 
 
-def generate_plot_image(plot_text):
-    """Generate a 3-panel comic image for the plot using Replicate."""
-    # Check if Replicate API token is set
-    if not settings.REPLICATE_API_TOKEN:
-        print("Cannot generate image: REPLICATE_API_TOKEN is not set")
-        return None
-        
-    # Create prompt for a 3-panel comic based on the plot
-    prompt = f"Create a comic-style black and white storyboard with 3 panels showing: {plot_text[:300]}"
-    print(f"Plot image prompt: {prompt}")
-    
-    # Use Replicate API to generate image
+async def agenerate_ai_response(story_context):
+    """Async version of generate_ai_response."""
+    client = get_async_openai_client()
+    if client is None:
+        return "The adventure continues... \nPlease set your OpenAI API key in the .env file to generate real story continuations."
+
     try:
-        print("Generating image with Replicate...")
-        start_time = time.time()
-        
-        output = replicate.run(
-            "stability-ai/sdxl-lightning:latest",  # Faster model
-            input={
-                "prompt": prompt,
-                "width": 768,
-                "height": 384,  # Wider format for 3 panels
-                "num_outputs": 1,
-                "guidance_scale": 7.5,
-                "negative_prompt": "color, detailed, complex, photorealistic"
-            }
-        )
-        
-        # Download the image
-        if output and len(output) > 0:
-            image_url = output[0]
-            print(f"Image generated, URL: {image_url}")
-            
-            response = requests.get(image_url)
-            if response.status_code != 200:
-                print(f"Failed to download image: {response.status_code}")
-                return None
-            
-            # Create a unique filename
-            filename = f"plot_{uuid.uuid4().hex}.jpg"
-            filepath = os.path.join(settings.MEDIA_ROOT, 'plots', filename)
-            
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            
-            # Save the image
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-            
-            end_time = time.time()
-            print(f"Image saved to: {filepath}")
-            print(f"Total time: {end_time - start_time:.2f} seconds")
-            
-            # Return the path relative to MEDIA_ROOT
-            return os.path.join('plots', filename)
+        response = await acreate_chat_completion(client, 'continuation', continuation_messages(story_context), max_tokens=300)
+        return response.choices[0].message.content.strip()
     except Exception as e:
-        print(f"Error generating plot image: {type(e).__name__}: {e}")
-    
-    return None
+        print(f"Error generating AI response: {e}")
+        return "The adventure continues... \nAn error occurred while generating the story continuation."
 
 
-def generate_user_image(user_input, character_name):
-    """Generate an image for user input using Replicate."""
-    # Check if Replicate API token is set
-    if not settings.REPLICATE_API_TOKEN:
-        print("Cannot generate user image: REPLICATE_API_TOKEN is not set")
-        return None
-        
-    # Create prompt for a single comic panel
-    prompt = f"Comic-style black and white panel showing {character_name}: {user_input[:200]}"
-    print(f"User image prompt: {prompt}")
-    
-    # Use Replicate API to generate image
+def stream_ai_response(story_context):
+    """Yield the AI continuation in chunks as OpenAI streams it."""
+    client = get_openai_client()
+    if client is None:
+        yield "The adventure continues... \nPlease set your OpenAI API key in the .env file to generate real story continuations."
+        return
+
+    produced = False
     try:
-        print("Generating image with Replicate...")
-        start_time = time.time()
-        
-        output = replicate.run(
-            "stability-ai/sdxl-lightning:latest",  # Faster model
-            input={
-                "prompt": prompt,
-                "width": 512,
-                "height": 512,
-                "num_outputs": 1,
-                "guidance_scale": 7.5,
-                "negative_prompt": "color, detailed, complex, photorealistic"
-            }
-        )
-        
-        # Download the image
-        if output and len(output) > 0:
-            image_url = output[0]
-            print(f"Image generated, URL: {image_url}")
-            
-            response = requests.get(image_url)
-            if response.status_code != 200:
-                print(f"Failed to download image: {response.status_code}")
-                return None
-            
-            # Create a unique filename
-            filename = f"user_{uuid.uuid4().hex}.jpg"
-            filepath = os.path.join(settings.MEDIA_ROOT, 'responses', filename)
-            
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            
-            # Save the image
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-            
-            end_time = time.time()
-            print(f"Image saved to: {filepath}")
-            print(f"Total time: {end_time - start_time:.2f} seconds")
-            
-            # Return the path relative to MEDIA_ROOT
-            return os.path.join('responses', filename)
+        messages = continuation_messages(story_context)
+        # The slot is held until the whole continuation has been streamed
+        with limits.limit('openai', tokens=estimate_chat_tokens(messages, 300)), \
+                metrics.timer('storyapp_gpt_request_seconds', call='continuation_stream'):
+            # Opening the stream is retried; a stream that breaks off is not
+            stream = resilience.call(
+                'openai', client.chat.completions.create,
+                model="gpt-4",
+                messages=messages,
+                max_tokens=300,
+                stream=True,
+                timeout=settings.OPENAI_CALL_TIMEOUT
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    produced = True
+                    yield chunk.choices[0].delta.content
     except Exception as e:
-        print(f"Error generating user image: {type(e).__name__}: {e}")
-    
-    return None
+        print(f"Error streaming AI response: {e}")
+        if not produced:
+            yield "The adventure continues... \nAn error occurred while generating the story continuation."
 
 
-def generate_ai_image(ai_response):
-    """Generate a 2-panel comic image for AI response using Replicate."""
-    # Check if Replicate API token is set
-    if not settings.REPLICATE_API_TOKEN:
-        print("Cannot generate AI image: REPLICATE_API_TOKEN is not set")
-        return None
-        
-    # Create prompt for a 2-panel comic
-    prompt = f"Black-and-white comic 2-panel scene showing: {ai_response[:300]}"
-    print(f"AI image prompt: {prompt}")
-    
-    # Use Replicate API to generate image
+async def astream_ai_response(story_context):
+    """Async version of stream_ai_response."""
+    client = get_async_openai_client()
+    if client is None:
+        yield "The adventure continues... \nPlease set your OpenAI API key in the .env file to generate real story continuations."
+        return
+
+    produced = False
     try:
-        print("Generating image with Replicate...")
-        start_time = time.time()
-        
-        output = replicate.run(
-            "stability-ai/sdxl-lightning:latest",  # Faster model
-            input={
-                "prompt": prompt,
-                "width": 768,
-                "height": 384,  # Wider format for 2 panels
-                "num_outputs": 1,
-                "guidance_scale": 7.5,
-                "negative_prompt": "color, detailed, complex, photorealistic"
-            }
-        )
-        
-        if output and len(output) > 0:
-            image_url = output[0]
-            print(f"Image generated, URL: {image_url}")
-            
-            # Download and save the image
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                # Create a unique filename
-                filename = f"ai_{uuid.uuid4().hex}.jpg"
-                filepath = os.path.join(settings.MEDIA_ROOT, 'responses', filename)
-                
-                # Ensure directory exists
-                os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                
-                # Save the image
-                with open(filepath, 'wb') as f:
-                    f.write(response.content)
-                
-                end_time = time.time()
-                print(f"Image saved to: {filepath}")
-                print(f"Total time: {end_time - start_time:.2f} seconds")
-                
-                # Return the path relative to MEDIA_ROOT
-                return os.path.join('responses', filename)
+        messages = continuation_messages(story_context)
+        # The slot is held until the whole continuation has been streamed
+        async with limits.alimit('openai', tokens=estimate_chat_tokens(messages, 300)):
+            with metrics.timer('storyapp_gpt_request_seconds', call='continuation_stream'):
+                # Opening the stream is retried; a stream that breaks off is not
+                stream = await resilience.acall(
+                    'openai', client.chat.completions.create,
+                    model="gpt-4",
+                    messages=messages,
+                    max_tokens=300,
+                    stream=True,
+                    timeout=settings.OPENAI_CALL_TIMEOUT
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        produced = True
+                        yield chunk.choices[0].delta.content
     except Exception as e:
-        print(f"Error generating AI image: {type(e).__name__}: {e}")
-    
-    return None
+        print(f"Error streaming AI response: {e}")
+        if not produced:
+            yield "The adventure continues... \nAn error occurred while generating the story continuation."
 
 
-def generate_pdf(story):
-    """Generate a PDF comic book from the story and responses."""
-    responses = StoryResponse.objects.filter(story=story).order_by('created_at')
-    
-    # Create a unique filename for the PDF
-    filename = f"comic_{story.id}_{uuid.uuid4().hex}.pdf"
-    filepath = os.path.join(settings.MEDIA_ROOT, 'pdfs', filename)
-    
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    
-    # Create A4 PDF
-    c = canvas.Canvas(filepath, pagesize=A4)
-    width, height = A4  # 595.2, 841.8 points (72 points = 1 inch)
-    
-    # Add title page
-    c.setFont("Helvetica-Bold", 24)
-    c.drawCentredString(width/2, height-100, f"{story.character_name}'s {story.theme.name} Adventure")
-    
-    c.setFont("Helvetica", 12)
-    c.drawCentredString(width/2, height-150, f"Created on {story.created_at.strftime('%B %d, %Y')}" )
-    
-    # Load and draw the plot image on the title page
-    plot_image_path = os.path.join(settings.MEDIA_ROOT, story.plot_image_path)
-    if os.path.exists(plot_image_path):
-        c.drawImage(plot_image_path, 100, height-400, width-200, 200)
-    
-    # Add plot text
-    text_object = c.beginText(100, height-450)
-    text_object.setFont("Helvetica", 12)
-    
-    # Word wrap the plot text
-    words = story.plot_text.split()
-    lines = []
-    current_line = []
-    
-    for word in words:
-        current_line.append(word)
-        if len(' '.join(current_line)) > 70:  # adjust based on your font size and page width
-            lines.append(' '.join(current_line[:-1]))
-            current_line = [current_line[-1]]
-    
-    if current_line:
-        lines.append(' '.join(current_line))
-    
-    for line in lines:
-        text_object.textLine(line)
-    
-    c.drawText(text_object)
-    
-    # Move to the next page
-    c.showPage()
-    
-    # Process responses in pairs (for layout purposes)
-    response_pairs = [responses[i:i+2] for i in range(0, len(responses), 2)]
-    
-    for pair_index, pair in enumerate(response_pairs):
-        y_position = height - 100  # Starting Y position
-        
-        for response in pair:
-            # Add user input and response images side by side
-            user_image_path = os.path.join(settings.MEDIA_ROOT, response.user_img_path)
-            ai_image_path = os.path.join(settings.MEDIA_ROOT, response.ai_img_path)
-            
-            # Add user text
-            c.setFont("Helvetica-Bold", 12)
-            c.drawString(50, y_position, f"{story.character_name}:")
-            
-            # Add user input text with word wrap
-            c.setFont("Helvetica", 10)
-            text_object = c.beginText(50, y_position - 20)
-            
-            words = response.user_input.split()
-            lines = []
-            current_line = []
-            
-            for word in words:
-                current_line.append(word)
-                if len(' '.join(current_line)) > 70:
-                    lines.append(' '.join(current_line[:-1]))
-                    current_line = [current_line[-1]]
-            
-            if current_line:
-                lines.append(' '.join(current_line))
-            
-            for line in lines:
-                text_object.textLine(line)
-            
-            c.drawText(text_object)
-            
-            # Determine where to place images based on text height
-            text_height = len(lines) * 12  # Approximate height of text block
-            image_y = y_position - text_height - 160  # Position images below text
-            
-            # Draw user image
-            if os.path.exists(user_image_path):
-                c.drawImage(user_image_path, 50, image_y, 200, 150)
-            
-            # Add AI response text
-            c.setFont("Helvetica-Bold", 12)
-            c.drawString(300, y_position, "AI:")
-            
-            # Add AI response text with word wrap
-            c.setFont("Helvetica", 10)
-            text_object = c.beginText(300, y_position - 20)
-            
-            words = response.ai_response.split()
-            lines = []
-            current_line = []
-            
-            for word in words:
-                current_line.append(word)
-                if len(' '.join(current_line)) > 70:
-                    lines.append(' '.join(current_line[:-1]))
-                    current_line = [current_line[-1]]
-            
-            if current_line:
-                lines.append(' '.join(current_line))
-            
-            for line in lines:
-                text_object.textLine(line)
-            
-            c.drawText(text_object)
-            
-            # Draw AI image
-            if os.path.exists(ai_image_path):
-                c.drawImage(ai_image_path, 300, image_y, 250, 150)
-            
-            # Update Y position for next response pair
-            y_position = image_y - 50
-            
-            # If we're running out of space on the page, create a new page
-            if y_position < 100:
-                c.showPage()
-                y_position = height - 100
-        
-        # After each pair, add a new page unless it's the last pair
-        if pair_index < len(response_pairs) - 1:
-            c.showPage()
-    
-    # Save the PDF
-    c.save()
-    
-    # Update the story's PDF path
-    story.pdf_path = os.path.join('pdfs', filename)
-    story.save()
-    
-    return story.pdf_path
+def generate_plot_image(plot_text, queued_at=None):
+    """Generate a 3-panel comic image for the plot using Replicate."""
+    return generate_image('plot', plot_text, queued_at=queued_at)
+
+
+def generate_user_image(user_input, character_name, queued_at=None):
+    """Generate an image for user input using Replicate."""
+    return generate_image('user', user_input, queued_at=queued_at, character_name=character_name)
+
+
+def generate_ai_image(ai_response, queued_at=None):
+    """Generate a 2-panel comic image for AI response using Replicate."""
+    return generate_image('ai', ai_response, queued_at=queued_at)
+
+
+async def agenerate_plot_image(plot_text, queued_at=None):
+    """Async version of generate_plot_image."""
+    return await agenerate_image('plot', plot_text, queued_at=queued_at)
+
+
+async def agenerate_user_image(user_input, character_name, queued_at=None):
+    """Async version of generate_user_image."""
+    return await agenerate_image('user', user_input, queued_at=queued_at, character_name=character_name)
+
+
+async def agenerate_ai_image(ai_response, queued_at=None):
+    """Async version of generate_ai_image."""
+    return await agenerate_image('ai', ai_response, queued_at=queued_at)
 
 
 def send_email(story):
@@ -644,9 +860,8 @@ def send_email(story):
     if not story.pdf_path:
         return False
     
-    pdf_path = os.path.join(settings.MEDIA_ROOT, story.pdf_path)
-    
-    if not os.path.exists(pdf_path):
+    storage = generated_storage()
+    if not storage.exists(story.pdf_path):
         return False
     
     subject = f"Your Comic Story: {story.character_name}'s {story.theme.name} Adventure"
@@ -668,14 +883,15 @@ AI Story Wall Team"""
     )
     
     # Attach the PDF
-    with open(pdf_path, 'rb') as f:
+    with storage.open(story.pdf_path, 'rb') as f:
         email.attach(f"{story.character_name}_comic.pdf", f.read(), 'application/pdf')
     
     # Send the email
-    email.send()
+    with metrics.timer('storyapp_email_send_seconds'):
+        email.send()
     
     # Mark email as sent
     story.email_sent = True
-    story.save()
+    story.save(update_fields=['email_sent'])
     
     return True